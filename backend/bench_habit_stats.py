@@ -0,0 +1,79 @@
+"""Latency of /api/habits/stats as the number of habits grows.
+
+Runs against the in-memory backend with a simulated PostgREST round trip so
+results reflect query count rather than network jitter:
+
+    python bench_habit_stats.py [round_trip_ms]
+"""
+import asyncio
+import os
+import sys
+import time
+from datetime import date, timedelta
+
+os.environ.setdefault("SUPABASE_URL", "http://localhost")
+os.environ.setdefault("SUPABASE_ANON_KEY", "bench")
+os.environ["DATA_BACKEND"] = "memory"
+
+import server  # noqa: E402
+
+USER_ID = "00000000-0000-0000-0000-000000000001"
+HABIT_COUNTS = [1, 5, 10, 20, 50]
+DAYS = 30
+RUNS = 20
+
+
+class CountingBackend(server.InMemoryBackend):
+    def __init__(self, latency: float):
+        super().__init__(latency=latency)
+        self.round_trips = 0
+
+    async def execute(self, query, access_token):
+        self.round_trips += 1
+        return await super().execute(query, access_token)
+
+
+def seed(backend: CountingBackend, habit_count: int) -> None:
+    today = date.today()
+    backend.tables["habits"] = [
+        {
+            "id": f"habit-{index}",
+            "user_id": USER_ID,
+            "title": f"Habit {index}",
+            "frequency": "weekly" if index % 3 == 0 else "daily",
+            "target_days": [0, 2, 4] if index % 3 == 0 else None,
+            "active": True,
+        }
+        for index in range(habit_count)
+    ]
+    backend.tables["habit_tracking"] = [
+        {
+            "id": f"track-{index}-{offset}",
+            "habit_id": f"habit-{index}",
+            "user_id": USER_ID,
+            "date": (today - timedelta(days=offset)).isoformat(),
+            "completed": offset % 2 == 0,
+        }
+        for index in range(habit_count)
+        for offset in range(DAYS)
+    ]
+
+
+async def main(round_trip_ms: float) -> None:
+    user = server.AuthenticatedUser(id=USER_ID)
+    print(f"{'habits':>6} {'round trips':>12} {'p50 ms':>8} {'max ms':>8}")
+    for habit_count in HABIT_COUNTS:
+        backend = CountingBackend(round_trip_ms / 1000)
+        seed(backend, habit_count)
+        db = server.DataSession(backend, "bench")
+        timings = []
+        for _ in range(RUNS):
+            started = time.perf_counter()
+            await server.get_habit_stats(days=DAYS, user=user, db=db)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        print(f"{habit_count:>6} {backend.round_trips // RUNS:>12} {timings[len(timings) // 2]:>8.1f} {timings[-1]:>8.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(float(sys.argv[1]) if len(sys.argv) > 1 else 20.0))
@@ -2,24 +2,52 @@ from __future__ import annotations
 
 from fastapi import FastAPI, HTTPException, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel, EmailStr, Field
-from typing import Optional, List, Dict, Any, Literal, AsyncGenerator, Tuple
-from datetime import datetime, date, time as dt_time, timedelta, timezone
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, EmailStr, Field, ValidationError
+from typing import Optional, List, Dict, Any, Literal, AsyncGenerator, Tuple, Set, Coroutine
+from datetime import datetime, date, time as dt_time, timedelta, timezone, tzinfo
 from supabase import create_client, Client
-from openai import OpenAI
+import openai
+from openai import AsyncOpenAI
 import os
 from dotenv import load_dotenv
 import json
+import base64
 import uuid
 import re
+import asyncio
+import inspect
+import random
+import hashlib
+import hmac
+import time
+import httpx
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from jose import JWTError, jwt
 from uuid import UUID
+from types import SimpleNamespace
 from cryptography.fernet import Fernet, InvalidToken
 import logging
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 load_dotenv()
 
-app = FastAPI(title="MindAthlete API", version="1.0.0")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Both hooks are defined at the end of the module, next to the workers they manage
+    await start_background_workers()
+    try:
+        yield
+    finally:
+        await close_data_backend()
+
+
+app = FastAPI(title="MindAthlete API", version="1.0.0", lifespan=lifespan)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("mindathlete.api")
@@ -41,18 +69,71 @@ supabase: Client = create_client(
 
 # Initialize OpenAI
 openai_api_key = os.getenv("OPENAI_API_KEY")
-openai_client = OpenAI(api_key=openai_api_key) if openai_api_key else None
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "20"))
+# Retries and deadlines belong to LLMExecutor; the SDK's own would multiply them behind its back
+openai_client = AsyncOpenAI(api_key=openai_api_key, max_retries=0, timeout=LLM_TIMEOUT_SECONDS) if openai_api_key else None
 
 USE_MOCK_AI = os.getenv("USE_MOCK_AI", "0") == "1"
 CHAT_MODEL = os.getenv("CHAT_MODEL", "gpt-4o-mini")
 RECOMMENDATION_MODEL = os.getenv("RECOMMENDATION_MODEL", "gpt-4o-mini")
 HABIT_PLAN_MODEL = os.getenv("HABIT_PLAN_MODEL", "gpt-4o-mini")
 CHAT_DAILY_FREE_LIMIT = int(os.getenv("CHAT_DAILY_FREE_LIMIT", "10"))
+CHAT_QUOTA_TRACKED_USERS = int(os.getenv("CHAT_QUOTA_TRACKED_USERS", "50000"))
+CHAT_QUOTA_RESYNC_SECONDS = int(os.getenv("CHAT_QUOTA_RESYNC_SECONDS", "300"))
 CHAT_RETENTION_DAYS = int(os.getenv("CHAT_RETENTION_DAYS", "90"))
 HABIT_PLAN_FREE_COOLDOWN_DAYS = int(os.getenv("HABIT_PLAN_FREE_COOLDOWN_DAYS", "21"))
 SPORTS_PSYCHOLOGY_BOOKING_URL = os.getenv("SPORTS_PSYCHOLOGY_BOOKING_URL")
 DATA_RETENTION_DAYS = int(os.getenv("DATA_RETENTION_DAYS", str(CHAT_RETENTION_DAYS)))
 CHAT_ENCRYPTION_KEY = os.getenv("CHAT_ENCRYPTION_KEY")
+SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+RETENTION_ENABLED = os.getenv("RETENTION_ENABLED", "1") == "1"
+RETENTION_INTERVAL_SECONDS = float(os.getenv("RETENTION_INTERVAL_SECONDS", "3600"))
+RETENTION_CHUNK_SIZE = int(os.getenv("RETENTION_CHUNK_SIZE", "500"))
+RETENTION_CHUNK_PAUSE_SECONDS = float(os.getenv("RETENTION_CHUNK_PAUSE_SECONDS", "0.5"))
+RETENTION_MAX_CHUNKS_PER_RUN = int(os.getenv("RETENTION_MAX_CHUNKS_PER_RUN", "200"))
+# Every uvicorn worker starts a retention loop; a lease in worker_leases lets one of them run at a time
+RETENTION_LEASE_SECONDS = float(os.getenv("RETENTION_LEASE_SECONDS", str(2 * RETENTION_INTERVAL_SECONDS)))
+INTERNAL_API_KEY = os.getenv("INTERNAL_API_KEY")
+ANALYTICS_BUFFER_ENABLED = os.getenv("ANALYTICS_BUFFER_ENABLED", "1") == "1"
+ANALYTICS_FLUSH_SIZE = int(os.getenv("ANALYTICS_FLUSH_SIZE", "200"))
+ANALYTICS_FLUSH_INTERVAL_SECONDS = float(os.getenv("ANALYTICS_FLUSH_INTERVAL_SECONDS", "2"))
+ANALYTICS_MAX_BUFFERED = int(os.getenv("ANALYTICS_MAX_BUFFERED", "20000"))
+ANALYTICS_OVERFLOW_POLICY = os.getenv("ANALYTICS_OVERFLOW_POLICY", "drop")  # "drop" or "spill"
+ANALYTICS_SPILL_PATH = os.getenv("ANALYTICS_SPILL_PATH", "analytics_spill.jsonl")
+ANALYTICS_MAX_BATCH_EVENTS = int(os.getenv("ANALYTICS_MAX_BATCH_EVENTS", "500"))
+ANALYTICS_ROLLUP_PAGE_SIZE = int(os.getenv("ANALYTICS_ROLLUP_PAGE_SIZE", "1000"))
+ANALYTICS_MAX_EVENT_AGE_HOURS = float(os.getenv("ANALYTICS_MAX_EVENT_AGE_HOURS", "168"))
+ANALYTICS_MAX_CLOCK_SKEW_SECONDS = float(os.getenv("ANALYTICS_MAX_CLOCK_SKEW_SECONDS", "300"))
+TIER_CACHE_TTL_SECONDS = int(os.getenv("TIER_CACHE_TTL_SECONDS", "300"))
+TIER_CACHE_SIZE = int(os.getenv("TIER_CACHE_SIZE", "10000"))
+RECOMMENDATION_CACHE_TTL_SECONDS = int(os.getenv("RECOMMENDATION_CACHE_TTL_SECONDS", "86400"))
+RECOMMENDATION_CACHE_SIZE = int(os.getenv("RECOMMENDATION_CACHE_SIZE", "5000"))
+HABIT_STREAK_TRACKED_HABITS = int(os.getenv("HABIT_STREAK_TRACKED_HABITS", "50000"))
+HABIT_STREAK_RESYNC_SECONDS = int(os.getenv("HABIT_STREAK_RESYNC_SECONDS", "900"))
+HABIT_HISTORY_PAGE_SIZE = int(os.getenv("HABIT_HISTORY_PAGE_SIZE", "1000"))
+HABIT_ROLLING_WINDOWS = (7, 30, 90)
+SCHEDULE_LOAD_TRACKED_USERS = int(os.getenv("SCHEDULE_LOAD_TRACKED_USERS", "50000"))
+SCHEDULE_LOAD_RESYNC_SECONDS = int(os.getenv("SCHEDULE_LOAD_RESYNC_SECONDS", "900"))
+EVENT_INDEX_TTL_SECONDS = int(os.getenv("EVENT_INDEX_TTL_SECONDS", "120"))
+EVENT_INDEX_TRACKED_USERS = int(os.getenv("EVENT_INDEX_TRACKED_USERS", "10000"))
+AGENDA_MAX_RANGE_DAYS = int(os.getenv("AGENDA_MAX_RANGE_DAYS", "62"))
+FREE_SLOT_CACHE_SIZE = int(os.getenv("FREE_SLOT_CACHE_SIZE", "20000"))
+FREE_SLOT_MIN_MINUTES = int(os.getenv("FREE_SLOT_MIN_MINUTES", "15"))
+DIARY_METRICS_TRACKED_USERS = int(os.getenv("DIARY_METRICS_TRACKED_USERS", "50000"))
+DIARY_METRICS_RESYNC_SECONDS = int(os.getenv("DIARY_METRICS_RESYNC_SECONDS", "900"))
+BULK_WRITE_MAX_ROWS = int(os.getenv("BULK_WRITE_MAX_ROWS", "400"))
+SYNC_PAGE_SIZE = int(os.getenv("SYNC_PAGE_SIZE", "500"))
+PAGE_MAX_LIMIT = int(os.getenv("PAGE_MAX_LIMIT", "100"))
+SYNC_CURSOR_LAG_SECONDS = float(os.getenv("SYNC_CURSOR_LAG_SECONDS", "5"))
+USER_CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("USER_CONTEXT_CACHE_TTL_SECONDS", "300"))
+USER_CONTEXT_CACHE_SIZE = int(os.getenv("USER_CONTEXT_CACHE_SIZE", "10000"))
+ETAG_CACHE_TTL_SECONDS = int(os.getenv("ETAG_CACHE_TTL_SECONDS", "60"))
+ETAG_CACHE_SIZE = int(os.getenv("ETAG_CACHE_SIZE", "50000"))
+CHAT_DECRYPT_WORKERS = int(os.getenv("CHAT_DECRYPT_WORKERS", "4"))
+CHAT_DECRYPT_BATCH_SIZE = int(os.getenv("CHAT_DECRYPT_BATCH_SIZE", "25"))
+CHAT_PAGE_CACHE_TTL_SECONDS = int(os.getenv("CHAT_PAGE_CACHE_TTL_SECONDS", "60"))
+CHAT_PAGE_CACHE_SIZE = int(os.getenv("CHAT_PAGE_CACHE_SIZE", "2000"))
+CHAT_PREVIEW_CHARS = int(os.getenv("CHAT_PREVIEW_CHARS", "120"))
 
 
 class EncryptionHelper:
@@ -85,8 +166,27 @@ class EncryptionHelper:
             logger.error("Failed to decrypt payload; returning masked content.")
             return "[unavailable]"
 
+    @property
+    def enabled(self) -> bool:
+        return self._fernet is not None
+
+    def decrypt_many(self, tokens: List[Optional[str]]) -> List[Optional[str]]:
+        return [self.decrypt(token) for token in tokens]
+
 
 encryption_helper = EncryptionHelper(CHAT_ENCRYPTION_KEY)
+# Dedicated so long conversations don't queue behind auth calls on the default to_thread pool
+decrypt_pool = ThreadPoolExecutor(max_workers=CHAT_DECRYPT_WORKERS, thread_name_prefix="chat-decrypt")
+
+
+async def decrypt_contents(tokens: List[Optional[str]]) -> List[Optional[str]]:
+    """Decrypts in fixed-size batches spread over decrypt_pool, keeping Fernet work off the event loop."""
+    if not encryption_helper.enabled or not tokens:
+        return list(tokens)
+    loop = asyncio.get_running_loop()
+    batches = [tokens[start:start + CHAT_DECRYPT_BATCH_SIZE] for start in range(0, len(tokens), CHAT_DECRYPT_BATCH_SIZE)]
+    results = await asyncio.gather(*(loop.run_in_executor(decrypt_pool, encryption_helper.decrypt_many, batch) for batch in batches))
+    return [content for batch in results for content in batch]
 
 EMAIL_PATTERN = re.compile(r"[\w\.-]+@[\w\.-]+")
 PHONE_PATTERN = re.compile(r"\+?\d[\d\s\-\(\)]{7,}\d")
@@ -96,6 +196,11 @@ def utc_now() -> datetime:
     return datetime.now(timezone.utc)
 
 
+def utc_today() -> date:
+    """The current UTC date, the day boundary used by tracking writes, quotas and retention."""
+    return utc_now().date()
+
+
 def sanitize_text(text: str) -> str:
     masked = EMAIL_PATTERN.sub("[email]", text)
     masked = PHONE_PATTERN.sub("[phone]", masked)
@@ -108,47 +213,705 @@ def isoformat(dt: datetime) -> str:
     return dt.isoformat()
 
 
-def determine_subscription_tier(user_id: str) -> str:
+# ============ DATA ACCESS ============
+
+DATA_BACKEND = os.getenv("DATA_BACKEND", "postgrest")
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", "100"))
+DB_MAX_KEEPALIVE = int(os.getenv("DB_MAX_KEEPALIVE", "20"))
+DB_MAX_CONCURRENCY = int(os.getenv("DB_MAX_CONCURRENCY", "64"))
+DB_TIMEOUT_SECONDS = float(os.getenv("DB_TIMEOUT_SECONDS", "10"))
+
+
+class DataAccessError(Exception):
+    def __init__(self, status_code: int, message: str):
+        super().__init__(f"{status_code}: {message}")
+        self.status_code = status_code
+        self.message = message
+
+
+class QueryResult:
+    def __init__(self, data: Optional[List[Dict[str, Any]]] = None, count: Optional[int] = None):
+        self.data = data if data is not None else []
+        self.count = count
+
+
+class TableQuery:
+    """Fluent query mirroring the supabase-py builder, executed through an async backend."""
+
+    def __init__(self, session: "DataSession", table: str):
+        self.session = session
+        self.table = table
+        self.method = "select"
+        self.columns = "*"
+        self.count: Optional[str] = None
+        self.head = False
+        self.payload: Any = None
+        self.on_conflict: Optional[str] = None
+        self.filters: List[Tuple[str, str, Any]] = []
+        self.orders: List[Tuple[str, bool]] = []
+        self.limit_value: Optional[int] = None
+
+    def select(self, columns: str = "*", count: Optional[str] = None, head: bool = False) -> "TableQuery":
+        self.method = "select"
+        self.columns = columns
+        self.count = count
+        self.head = head
+        return self
+
+    def insert(self, rows: Any) -> "TableQuery":
+        self.method = "insert"
+        self.payload = rows
+        return self
+
+    def upsert(self, rows: Any, on_conflict: Optional[str] = None) -> "TableQuery":
+        self.method = "upsert"
+        self.payload = rows
+        self.on_conflict = on_conflict
+        return self
+
+    def update(self, values: Dict[str, Any]) -> "TableQuery":
+        self.method = "update"
+        self.payload = values
+        return self
+
+    def delete(self, returning: str = "*") -> "TableQuery":
+        """`returning` narrows the columns sent back for the deleted rows."""
+        self.method = "delete"
+        self.columns = returning
+        return self
+
+    def _filter(self, column: str, op: str, value: Any) -> "TableQuery":
+        self.filters.append((column, op, value))
+        return self
+
+    def eq(self, column: str, value: Any) -> "TableQuery":
+        return self._filter(column, "eq", value)
+
+    def neq(self, column: str, value: Any) -> "TableQuery":
+        return self._filter(column, "neq", value)
+
+    def gt(self, column: str, value: Any) -> "TableQuery":
+        return self._filter(column, "gt", value)
+
+    def gte(self, column: str, value: Any) -> "TableQuery":
+        return self._filter(column, "gte", value)
+
+    def lt(self, column: str, value: Any) -> "TableQuery":
+        return self._filter(column, "lt", value)
+
+    def lte(self, column: str, value: Any) -> "TableQuery":
+        return self._filter(column, "lte", value)
+
+    def in_(self, column: str, values: List[Any]) -> "TableQuery":
+        return self._filter(column, "in", list(values))
+
+    def is_(self, column: str, value: Any) -> "TableQuery":
+        return self._filter(column, "is", value)
+
+    def ilike(self, column: str, pattern: str) -> "TableQuery":
+        return self._filter(column, "ilike", pattern)
+
+    def keyset_after(self, column: str, value: Any, tiebreak: str, tiebreak_value: Any, desc: bool = False) -> "TableQuery":
+        """Rows strictly past (value, tiebreak_value) when ordered by (column, tiebreak), ascending or descending."""
+        return self._filter(column, "keyset_lt" if desc else "keyset_gt", (value, tiebreak, tiebreak_value))
+
+    def order(self, column: str, desc: bool = False) -> "TableQuery":
+        self.orders.append((column, desc))
+        return self
+
+    def limit(self, value: int) -> "TableQuery":
+        self.limit_value = value
+        return self
+
+    async def execute(self) -> QueryResult:
+        return await self.session.backend.execute(self, self.session.access_token)
+
+
+class RpcQuery:
+    def __init__(self, session: "DataSession", function: str, params: Dict[str, Any]):
+        self.session = session
+        self.function = function
+        self.params = params
+
+    async def execute(self) -> QueryResult:
+        return await self.session.backend.call_rpc(self.function, self.params, self.session.access_token)
+
+
+class DataSession:
+    """Lightweight handle binding a backend to the caller's credentials."""
+
+    __slots__ = ("backend", "access_token")
+
+    def __init__(self, backend: "DataBackend", access_token: Optional[str] = None):
+        self.backend = backend
+        self.access_token = access_token
+
+    def table(self, name: str) -> TableQuery:
+        return TableQuery(self, name)
+
+    def rpc(self, function: str, params: Optional[Dict[str, Any]] = None) -> RpcQuery:
+        return RpcQuery(self, function, params or {})
+
+
+class DataBackend(ABC):
+    @abstractmethod
+    async def execute(self, query: TableQuery, access_token: Optional[str]) -> QueryResult:
+        ...
+
+    @abstractmethod
+    async def call_rpc(self, function: str, params: Dict[str, Any], access_token: Optional[str]) -> QueryResult:
+        ...
+
+    async def close(self) -> None:
+        return None
+
+
+def encode_filter(column: str, op: str, value: Any) -> List[Tuple[str, str]]:
+    if op in ("keyset_gt", "keyset_lt"):
+        bound, tiebreak, tiebreak_value = value
+        compare = op[-2:]
+        quoted = [quote_filter_item(item, force=True) for item in (bound, tiebreak_value)]
+        return [
+            # Postgres can't seek an index with the OR alone; this plain bound makes the scan start at the cursor
+            (column, encode_filter_value(f"{compare}e", bound)),
+            ("or", f"({column}.{compare}.{quoted[0]},and({column}.eq.{quoted[0]},{tiebreak}.{compare}.{quoted[1]}))"),
+        ]
+    return [(column, encode_filter_value(op, value))]
+
+
+def quote_filter_item(value: Any, force: bool = False) -> str:
+    """A value inside an in.(...) list or or=(...) tree, double-quoted when it holds PostgREST's reserved characters."""
+    text = encode_filter_value("eq", value)[3:]
+    if force or any(char in text for char in ',.:()"\\') or text != text.strip():
+        return '"' + text.replace("\\", "\\\\").replace('"', '\\"') + '"'
+    return text
+
+
+def encode_filter_value(op: str, value: Any) -> str:
+    if op == "in":
+        return "in.({})".format(",".join(quote_filter_item(item) for item in value))
+    if value is None:
+        return "is.null"
+    if isinstance(value, bool):
+        return f"{op}.{'true' if value else 'false'}"
+    if isinstance(value, (datetime, date)):
+        return f"{op}.{value.isoformat()}"
+    return f"{op}.{value}"
+
+
+class PostgrestBackend(DataBackend):
+    """Async PostgREST client sharing one keep-alive connection pool per worker."""
+
+    def __init__(self, base_url: str, api_key: str, max_connections: int = DB_MAX_CONNECTIONS,
+                 max_keepalive: int = DB_MAX_KEEPALIVE, max_concurrency: int = DB_MAX_CONCURRENCY,
+                 timeout: float = DB_TIMEOUT_SECONDS):
+        self.rest_url = base_url.rstrip("/") + "/rest/v1"
+        self.api_key = api_key
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive),
+            timeout=httpx.Timeout(timeout),
+            http2=False,
+        )
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    def _headers(self, access_token: Optional[str], prefer: List[str]) -> Dict[str, str]:
+        headers = {
+            "apikey": self.api_key,
+            "Authorization": f"Bearer {access_token or self.api_key}",
+            "Content-Type": "application/json",
+        }
+        if prefer:
+            headers["Prefer"] = ",".join(prefer)
+        return headers
+
+    async def _send(self, method: str, url: str, params: List[Tuple[str, str]], headers: Dict[str, str], body: Any = None) -> httpx.Response:
+        async with self._semaphore:
+            response = await self._client.request(
+                method,
+                url,
+                params=params,
+                headers=headers,
+                content=json.dumps(body, default=str) if body is not None else None,
+            )
+        if response.status_code >= 400:
+            raise DataAccessError(response.status_code, response.text)
+        return response
+
+    @staticmethod
+    def _parse_count(response: httpx.Response) -> Optional[int]:
+        content_range = response.headers.get("content-range")
+        if not content_range or "/" not in content_range:
+            return None
+        total = content_range.split("/")[-1]
+        return int(total) if total.isdigit() else None
+
+    async def execute(self, query: TableQuery, access_token: Optional[str]) -> QueryResult:
+        params: List[Tuple[str, str]] = [param for column, op, value in query.filters for param in encode_filter(column, op, value)]
+        prefer: List[str] = []
+        body: Any = None
+        if query.method == "select":
+            method = "HEAD" if query.head else "GET"
+            params.append(("select", query.columns))
+            if query.count:
+                prefer.append(f"count={query.count}")
+        elif query.method in ("insert", "upsert"):
+            method = "POST"
+            body = query.payload
+            prefer.append("return=representation")
+            if query.method == "upsert":
+                prefer.append("resolution=merge-duplicates")
+                if query.on_conflict:
+                    params.append(("on_conflict", query.on_conflict))
+        elif query.method == "update":
+            method = "PATCH"
+            body = query.payload
+            prefer.append("return=representation")
+        else:
+            method = "DELETE"
+            prefer.append("return=representation")
+            if query.columns != "*":
+                params.append(("select", query.columns))
+        if query.orders:
+            params.append(("order", ",".join(f"{column}.{'desc' if desc else 'asc'}" for column, desc in query.orders)))
+        if query.limit_value is not None:
+            params.append(("limit", str(query.limit_value)))
+
+        response = await self._send(method, f"{self.rest_url}/{query.table}", params, self._headers(access_token, prefer), body)
+        data = response.json() if response.content else []
+        if isinstance(data, dict):
+            data = [data]
+        return QueryResult(data, self._parse_count(response))
+
+    async def call_rpc(self, function: str, params: Dict[str, Any], access_token: Optional[str]) -> QueryResult:
+        response = await self._send("POST", f"{self.rest_url}/rpc/{function}", [], self._headers(access_token, []), params)
+        data = response.json() if response.content else None
+        if data is None:
+            return QueryResult([])
+        return QueryResult(data if isinstance(data, list) else [data])
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+
+class InMemoryBackend(DataBackend):
+    """In-process stand-in for PostgREST so the data layer can run offline."""
+
+    def __init__(self, unique_keys: Optional[Dict[str, List[str]]] = None, latency: float = 0.0):
+        self.tables: Dict[str, List[Dict[str, Any]]] = {}
+        self.rpcs: Dict[str, Any] = {
+            "append_chat_messages": InMemoryBackend._append_chat_messages,
+            "ingest_analytics_events": InMemoryBackend._ingest_analytics_events,
+            "release_purged_chat_messages": InMemoryBackend._release_purged_chat_messages,
+            "sync_clock": lambda backend, params: utc_now().isoformat(),
+            "try_acquire_worker_lease": InMemoryBackend._try_acquire_worker_lease,
+        }
+        self.latency = latency
+        self.unique_keys = unique_keys or {
+            "diary_entries": ["user_id", "date"],
+            "habit_tracking": ["habit_id", "date"],
+            "user_profiles": ["user_id"],
+            "analytics_daily_rollups": ["user_id", "day", "event_type"],
+        }
+        # Tables whose triggers stamp updated_at and record sync_tombstones on delete
+        self.versioned_tables = {"diary_entries", "habits", "habit_tracking", "schedules", "session_completions"}
+
+    def register_rpc(self, function: str, handler: Any) -> None:
+        self.rpcs[function] = handler
+
+    def _append_chat_messages(self, params: Dict[str, Any]) -> Optional[int]:
+        chat_id = str(params["p_chat_id"])
+        messages = self.tables.setdefault("chat_messages", [])
+        for message in params.get("p_messages") or []:
+            messages.append(self._prepare_row({**message, "chat_id": chat_id}))
+        for chat in self.tables.get("chats", []):
+            if chat.get("id") == chat_id:
+                chat["message_count"] = (chat.get("message_count") or 0) + len(params.get("p_messages") or [])
+                chat["last_message_at"] = utc_now().isoformat()
+                if params.get("p_preview") is not None:
+                    chat["last_message_preview"] = params["p_preview"]
+                if params.get("p_messages"):
+                    chat["last_message_role"] = params["p_messages"][-1].get("role")
+                chat["updated_at"] = chat["last_message_at"]
+                return chat["message_count"]
+        return None
+
+    def _release_purged_chat_messages(self, params: Dict[str, Any]) -> int:
+        counts = params.get("p_counts") or {}
+        touched = 0
+        for chat in self.tables.get("chats", []):
+            purged = counts.get(str(chat.get("id")))
+            if purged is None:
+                continue
+            chat["message_count"] = max((chat.get("message_count") or 0) - int(purged), 0)
+            if str(chat.get("last_message_at") or "") < str(params["p_cutoff"]):
+                chat["last_message_preview"] = None
+            touched += 1
+        return touched
+
+    def _try_acquire_worker_lease(self, params: Dict[str, Any]) -> bool:
+        leases = self.tables.setdefault("worker_leases", [])
+        now = utc_now()
+        expires_at = (now + timedelta(seconds=float(params["p_ttl_seconds"]))).isoformat()
+        for lease in leases:
+            if lease["name"] == params["p_name"]:
+                if lease["holder"] != params["p_holder"] and lease["expires_at"] >= now.isoformat():
+                    return False
+                lease.update(holder=params["p_holder"], expires_at=expires_at)
+                return True
+        leases.append({"name": params["p_name"], "holder": params["p_holder"], "expires_at": expires_at})
+        return True
+
+    def _ingest_analytics_events(self, params: Dict[str, Any]) -> int:
+        events = params.get("p_events") or []
+        rollups = self.tables.setdefault("analytics_daily_rollups", [])
+        for event in events:
+            row = self._prepare_row({**event, "timestamp": event.get("timestamp") or utc_now().isoformat()})
+            self.tables.setdefault("analytics_events", []).append(row)
+            key = {"user_id": row.get("user_id"), "day": str(row["timestamp"])[:10], "event_type": row.get("event_type")}
+            index = self._conflict_index(rollups, key, list(key))
+            if index is None:
+                rollups.append({**key, "event_count": 1, "updated_at": utc_now().isoformat()})
+            else:
+                rollups[index]["event_count"] += 1
+                rollups[index]["updated_at"] = utc_now().isoformat()
+        return len(events)
+
+    @staticmethod
+    def _comparable(value: Any) -> Any:
+        if isinstance(value, (datetime, date)):
+            return value.isoformat()
+        if isinstance(value, UUID):
+            return str(value)
+        return value
+
+    def _matches(self, row: Dict[str, Any], filters: List[Tuple[str, str, Any]]) -> bool:
+        for column, op, expected in filters:
+            actual = self._comparable(row.get(column))
+            if op == "in":
+                if actual not in [self._comparable(item) for item in expected]:
+                    return False
+                continue
+            if op in ("keyset_gt", "keyset_lt"):
+                bound, tiebreak, tiebreak_value = (self._comparable(item) for item in expected)
+                key = (actual, self._comparable(row.get(tiebreak)))
+                if None in key or (key <= (bound, tiebreak_value) if op == "keyset_gt" else key >= (bound, tiebreak_value)):
+                    return False
+                continue
+            expected = self._comparable(expected)
+            if op == "ilike":
+                regex = "^" + ".*".join(re.escape(part) for part in str(expected).split("%")) + "$"
+                if actual is None or not re.match(regex, str(actual), re.IGNORECASE):
+                    return False
+                continue
+            if op in ("eq", "is"):
+                matched = actual == expected
+            elif op == "neq":
+                matched = actual != expected
+            elif actual is None or expected is None:
+                matched = False
+            elif op == "gt":
+                matched = actual > expected
+            elif op == "gte":
+                matched = actual >= expected
+            elif op == "lt":
+                matched = actual < expected
+            elif op == "lte":
+                matched = actual <= expected
+            else:
+                raise DataAccessError(400, f"Unsupported filter operator {op}")
+            if not matched:
+                return False
+        return True
+
+    @staticmethod
+    def _project(row: Dict[str, Any], columns: str) -> Dict[str, Any]:
+        if columns.strip() == "*":
+            return dict(row)
+        return {column.strip(): row.get(column.strip()) for column in columns.split(",") if column.strip()}
+
+    def _prepare_row(self, row: Dict[str, Any]) -> Dict[str, Any]:
+        prepared = {key: self._comparable(value) for key, value in row.items()}
+        prepared.setdefault("id", str(uuid.uuid4()))
+        prepared.setdefault("created_at", utc_now().isoformat())
+        return prepared
+
+    def _conflict_index(self, rows: List[Dict[str, Any]], row: Dict[str, Any], keys: List[str]) -> Optional[int]:
+        for index, existing in enumerate(rows):
+            if all(existing.get(key) == row.get(key) for key in keys):
+                return index
+        return None
+
+    async def execute(self, query: TableQuery, access_token: Optional[str]) -> QueryResult:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        rows = self.tables.setdefault(query.table, [])
+
+        if query.method in ("insert", "upsert"):
+            payload = query.payload if isinstance(query.payload, list) else [query.payload]
+            keys = query.on_conflict.split(",") if query.on_conflict else self.unique_keys.get(query.table)
+            written: List[Dict[str, Any]] = []
+            for raw in payload:
+                row = self._prepare_row(raw)
+                if query.table in self.versioned_tables:
+                    row["updated_at"] = utc_now().isoformat()
+                index = self._conflict_index(rows, row, keys) if keys else None
+                if index is not None:
+                    owner = rows[index].get("user_id")
+                    if owner is not None and row.get("user_id") is not None and owner != row["user_id"]:
+                        # What row-level security does to an upsert that lands on another user's row
+                        raise DataAccessError(403, f"new row violates row-level security policy for table {query.table}")
+                    if query.method == "insert":
+                        raise DataAccessError(409, f"duplicate key value violates unique constraint on {query.table}")
+                    row.pop("id", None)
+                    if "created_at" not in raw:
+                        row.pop("created_at", None)
+                    rows[index].update(row)
+                    written.append(dict(rows[index]))
+                else:
+                    rows.append(row)
+                    written.append(dict(row))
+            return QueryResult(written)
+
+        matched = [row for row in rows if self._matches(row, query.filters)]
+        if query.method == "update":
+            for row in matched:
+                row.update({key: self._comparable(value) for key, value in query.payload.items()})
+                if query.table in self.versioned_tables:
+                    row["updated_at"] = utc_now().isoformat()
+            return QueryResult([dict(row) for row in matched])
+        if query.method == "delete":
+            self.tables[query.table] = [row for row in rows if not self._matches(row, query.filters)]
+            if query.table in self.versioned_tables:
+                self.tables.setdefault("sync_tombstones", []).extend(
+                    {
+                        "id": str(uuid.uuid4()),
+                        "user_id": row.get("user_id"),
+                        "table_name": query.table,
+                        "row_id": row.get("id"),
+                        "deleted_at": utc_now().isoformat(),
+                    }
+                    for row in matched
+                )
+            return QueryResult([self._project(row, query.columns) for row in matched])
+
+        for column, desc in reversed(query.orders):
+            matched.sort(key=lambda row: (row.get(column) is None, row.get(column)), reverse=desc)
+        total = len(matched)
+        if query.limit_value is not None:
+            matched = matched[:query.limit_value]
+        data = [] if query.head else [self._project(row, query.columns) for row in matched]
+        return QueryResult(data, total if query.count else None)
+
+    async def call_rpc(self, function: str, params: Dict[str, Any], access_token: Optional[str]) -> QueryResult:
+        handler = self.rpcs.get(function)
+        if handler is None:
+            raise DataAccessError(404, f"Function {function} not found")
+        result = handler(self, params)
+        if asyncio.iscoroutine(result):
+            result = await result
+        if result is None:
+            return QueryResult([])
+        return QueryResult(result if isinstance(result, list) else [result])
+
+
+def create_data_backend() -> DataBackend:
+    if DATA_BACKEND == "memory":
+        logger.info("Using in-memory data backend.")
+        return InMemoryBackend()
+    return PostgrestBackend(os.getenv("SUPABASE_URL") or "", os.getenv("SUPABASE_ANON_KEY") or "")
+
+
+data_backend = create_data_backend()
+
+
+# ============ CACHING ============
+
+class TTLCache:
+    """In-process LRU cache whose entries expire after a TTL or at an explicit timestamp."""
+
+    def __init__(self, max_size: int, ttl_seconds: float = 0):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Any, Tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: Any) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at <= time.time():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Any, value: Any, expires_at: Optional[float] = None) -> None:
+        if expires_at is None:
+            expires_at = time.time() + self.ttl_seconds
+        if expires_at <= time.time() or self.max_size <= 0:
+            return
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: Any) -> bool:
+        return self._entries.pop(key, None) is not None
+
+    def invalidate_where(self, predicate: Any) -> int:
+        stale = [key for key in self._entries if predicate(key)]
+        for key in stale:
+            del self._entries[key]
+        return len(stale)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+tier_cache = TTLCache(TIER_CACHE_SIZE, TIER_CACHE_TTL_SECONDS)
+recommendation_cache = TTLCache(RECOMMENDATION_CACHE_SIZE, RECOMMENDATION_CACHE_TTL_SECONDS)
+
+
+async def determine_subscription_tier(db: DataSession, user_id: str) -> str:
+    cached = tier_cache.get(user_id)
+    if cached:
+        return cached
     try:
-        response = supabase.table("entitlements").select("*").eq("user_id", user_id).eq("active", True).execute()
-        for entitlement in response.data or []:
-            product = (entitlement or {}).get("product", "")
-            if product and "premium" in product.lower():
-                return "premium"
+        response = await db.table("entitlements") \
+            .select("id") \
+            .eq("user_id", user_id) \
+            .eq("active", True) \
+            .ilike("product", "%premium%") \
+            .limit(1) \
+            .execute()
     except Exception as exc:
         logger.warning("Failed to determine subscription tier for %s: %s", user_id, exc)
-    return "free"
+        return "free"
+    tier = "premium" if response.data else "free"
+    tier_cache.put(user_id, tier)
+    return tier
+
+
+def invalidate_subscription_tier(user_id: str) -> None:
+    tier_cache.invalidate(user_id)
+
+
+class ChatQuotaTracker:
+    """Per-user count of today's user chat messages, seeded from one server-side count and bumped on write.
+
+    Counters are re-seeded after `resync_seconds` so writes made by other workers are picked up.
+    """
+
+    def __init__(self, limit: int, max_users: int, resync_seconds: int):
+        self.limit = limit
+        self.max_users = max_users
+        self.resync_seconds = resync_seconds
+        self._counters: OrderedDict[str, Tuple[date, float, int]] = OrderedDict()
+        self._seed_locks: Dict[str, asyncio.Lock] = {}
+        self._seed_waiters: Dict[str, int] = {}
+
+    def _current(self, user_id: str) -> Optional[int]:
+        entry = self._counters.get(user_id)
+        if entry is None:
+            return None
+        day, seeded_at, count = entry
+        if day != utc_today() or time.time() - seeded_at > self.resync_seconds:
+            return None
+        self._counters.move_to_end(user_id)
+        return count
+
+    async def _seed(self, db: DataSession, user_id: str) -> int:
+        lock = self._seed_locks.setdefault(user_id, asyncio.Lock())
+        self._seed_waiters[user_id] = self._seed_waiters.get(user_id, 0) + 1
+        try:
+            async with lock:
+                current = self._current(user_id)
+                if current is not None:
+                    return current
+                start_of_day = utc_now().replace(hour=0, minute=0, second=0, microsecond=0)
+                response = await db.table("chat_messages") \
+                    .select("id", count="exact", head=True) \
+                    .eq("user_id", user_id) \
+                    .eq("role", "user") \
+                    .gte("created_at", start_of_day.isoformat()) \
+                    .execute()
+                count = response.count or 0
+                self._counters[user_id] = (start_of_day.date(), time.time(), count)
+                self._counters.move_to_end(user_id)
+                while len(self._counters) > self.max_users:
+                    self._counters.popitem(last=False)
+                return count
+        finally:
+            # A released lock can still have queued waiters; drop it only once the last caller is out.
+            waiters = self._seed_waiters[user_id] - 1
+            if waiters:
+                self._seed_waiters[user_id] = waiters
+            else:
+                self._seed_waiters.pop(user_id, None)
+                self._seed_locks.pop(user_id, None)
+
+    async def usage(self, db: DataSession, user_id: str) -> int:
+        current = self._current(user_id)
+        if current is not None:
+            return current
+        return await self._seed(db, user_id)
+
+    def record(self, user_id: str) -> None:
+        entry = self._counters.get(user_id)
+        if entry is None:
+            return
+        day, seeded_at, count = entry
+        if day == utc_today():
+            self._counters[user_id] = (day, seeded_at, count + 1)
+
+
+chat_quota = ChatQuotaTracker(CHAT_DAILY_FREE_LIMIT, CHAT_QUOTA_TRACKED_USERS, CHAT_QUOTA_RESYNC_SECONDS)
 
 
-def ensure_chat_quota(user_id: str, tier: str) -> None:
+async def ensure_chat_quota(db: DataSession, user_id: str, tier: str, reserve: bool = True) -> None:
+    """Rejects free users over the daily limit; with `reserve` the turn is counted right away.
+
+    Counting before generation, with no await between check and record, keeps concurrent requests
+    from all passing the same check while their messages are still being written.
+    """
     if tier == "premium":
         return
-    start_of_day = utc_now().replace(hour=0, minute=0, second=0, microsecond=0)
     try:
-        response = supabase.table("chat_messages") \
-            .select("id") \
-            .eq("user_id", user_id) \
-            .eq("role", "user") \
-            .gte("created_at", start_of_day.isoformat()) \
-            .execute()
-        total = len(response.data or [])
+        total = await chat_quota.usage(db, user_id)
         if total >= CHAT_DAILY_FREE_LIMIT:
             raise HTTPException(
                 status_code=402,
                 detail=f"Daily chat limit reached. Upgrade to premium for unlimited conversations."
             )
+        if reserve:
+            chat_quota.record(user_id)
     except HTTPException:
         raise
     except Exception as exc:
         logger.error("Quota check failed for %s: %s", user_id, exc)
 
 
-def enforce_habit_plan_cooldown(user_id: str, tier: str) -> None:
+async def enforce_habit_plan_cooldown(db: DataSession, user_id: str, tier: str) -> None:
     if tier == "premium":
         return
     cutoff = utc_now() - timedelta(days=HABIT_PLAN_FREE_COOLDOWN_DAYS)
     try:
-        response = supabase.table("habit_plans") \
+        response = await db.table("habit_plans") \
             .select("id, created_at") \
             .eq("user_id", user_id) \
             .eq("source", "AI") \
@@ -167,16 +930,377 @@ def enforce_habit_plan_cooldown(user_id: str, tier: str) -> None:
         logger.error("Habit plan cooldown check failed for %s: %s", user_id, exc)
 
 
-def apply_retention_policies(user_id: str) -> None:
-    cutoff = utc_now() - timedelta(days=DATA_RETENTION_DAYS)
+RETENTION_TABLES: List[Tuple[str, str]] = [
+    ("chat_messages", "created_at"),
+    ("recommendations", "created_at"),
+    ("analytics_events", "timestamp"),
+    ("escalations", "created_at"),
+    # Clients whose sync cursor predates this window are sent a full reset instead of tombstones
+    ("sync_tombstones", "deleted_at"),
+]
+
+
+class RetentionWorker:
+    """Purges rows older than DATA_RETENTION_DAYS across all users in bounded, rate-limited chunks."""
+
+    def __init__(self, db: DataSession, retention_days: int, chunk_size: int, chunk_pause: float,
+                 max_chunks_per_run: int, interval: float, lease_seconds: Optional[float] = None):
+        self.db = db
+        self.retention_days = retention_days
+        self.chunk_size = chunk_size
+        self.chunk_pause = chunk_pause
+        self.max_chunks_per_run = max_chunks_per_run
+        self.interval = interval
+        self.lease_seconds = lease_seconds or 2 * interval
+        self.holder = f"{os.uname().nodename}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.skipped_runs = 0
+        self.checkpoints: Dict[str, Optional[str]] = {}
+        self.deleted: Dict[str, int] = {table: 0 for table, _ in RETENTION_TABLES}
+        self.errors = 0
+        self.runs = 0
+        self.last_run_at: Optional[str] = None
+        self.last_run_seconds: Optional[float] = None
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    async def _release_chat_messages(self, rows: List[Dict[str, Any]], cutoff: str) -> None:
+        """Keeps chats in step with purged messages: lowers message_count and drops a preview whose message is gone."""
+        counts: Dict[str, int] = {}
+        for row in rows:
+            if row.get("chat_id"):
+                counts[str(row["chat_id"])] = counts.get(str(row["chat_id"]), 0) + 1
+        if not counts:
+            return
+        try:
+            await self.db.rpc("release_purged_chat_messages", {"p_counts": counts, "p_cutoff": cutoff}).execute()
+        except DataAccessError as exc:
+            if exc.status_code != 404:
+                raise
+            logger.warning("release_purged_chat_messages RPC unavailable; updating chats one by one.")
+            for chat_id, purged in counts.items():
+                current = await self.db.table("chats").select("message_count, last_message_at").eq("id", chat_id).limit(1).execute()
+                if not current.data:
+                    continue
+                update: Dict[str, Any] = {"message_count": max((current.data[0].get("message_count") or 0) - purged, 0)}
+                last_message_at = parse_utc_datetime(current.data[0].get("last_message_at"))
+                if last_message_at is None or last_message_at < parse_utc_datetime(cutoff):
+                    update["last_message_preview"] = None
+                await self.db.table("chats").update(update).eq("id", chat_id).execute()
+
+    async def _acquire_lease(self) -> bool:
+        """Whether this process should run: only the holder of the "retention" lease purges."""
+        try:
+            result = await self.db.rpc("try_acquire_worker_lease", {
+                "p_name": "retention",
+                "p_holder": self.holder,
+                "p_ttl_seconds": int(self.lease_seconds),
+            }).execute()
+        except DataAccessError as exc:
+            if exc.status_code != 404:
+                raise
+            logger.warning("try_acquire_worker_lease RPC unavailable; every worker runs retention.")
+            return True
+        return bool(result.data and result.data[0])
+
+    async def _purge_chunk(self, table: str, column: str, cutoff: str) -> int:
+        """Deletes the next chunk by time range rather than by id list, which keeps the URL short.
+
+        The chunk's upper bound comes from an index-only read of its timestamps; rows tied with the
+        last one are deleted together, so a chunk can slightly exceed chunk_size.
+        """
+        query = self.db.table(table).select(column).lt(column, cutoff)
+        checkpoint = self.checkpoints.get(table)
+        if checkpoint:
+            query = query.gte(column, checkpoint)
+        batch = await query.order(column).limit(self.chunk_size).execute()
+        if not batch.data:
+            return 0
+        upper = batch.data[-1].get(column)
+        delete = self.db.table(table).delete(returning="chat_id" if table == "chat_messages" else "id") \
+            .lt(column, cutoff) \
+            .lte(column, upper)
+        if checkpoint:
+            delete = delete.gte(column, checkpoint)
+        removed = await delete.execute()
+        if table == "chat_messages":
+            await self._release_chat_messages(removed.data, cutoff)
+        self.checkpoints[table] = upper
+        self.deleted[table] += len(removed.data)
+        return len(removed.data)
+
+    async def run_once(self) -> Dict[str, int]:
+        async with self._lock:
+            if not await self._acquire_lease():
+                self.skipped_runs += 1
+                return {}
+            started = time.monotonic()
+            cutoff = (utc_now() - timedelta(days=self.retention_days)).isoformat()
+            purged: Dict[str, int] = {}
+            chunks = 0
+            for table, column in RETENTION_TABLES:
+                purged[table] = 0
+                try:
+                    while chunks < self.max_chunks_per_run:
+                        removed = await self._purge_chunk(table, column, cutoff)
+                        chunks += 1
+                        purged[table] += removed
+                        if removed < self.chunk_size:
+                            self.checkpoints.pop(table, None)
+                            break
+                        await asyncio.sleep(self.chunk_pause)
+                except Exception as exc:
+                    self.errors += 1
+                    logger.warning("Retention purge of %s stopped: %s", table, exc)
+            self.runs += 1
+            self.last_run_at = utc_now().isoformat()
+            self.last_run_seconds = round(time.monotonic() - started, 3)
+            logger.info("Retention run purged %s", purged)
+            return purged
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except Exception as exc:
+                self.errors += 1
+                logger.error("Retention run failed: %s", exc)
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self._task is not None,
+            "runs": self.runs,
+            "skipped_runs": self.skipped_runs,
+            "errors": self.errors,
+            "deleted": dict(self.deleted),
+            "checkpoints": dict(self.checkpoints),
+            "last_run_at": self.last_run_at,
+            "last_run_seconds": self.last_run_seconds,
+        }
+
+
+retention_worker = RetentionWorker(
+    DataSession(data_backend, SUPABASE_SERVICE_ROLE_KEY),
+    DATA_RETENTION_DAYS,
+    RETENTION_CHUNK_SIZE,
+    RETENTION_CHUNK_PAUSE_SECONDS,
+    RETENTION_MAX_CHUNKS_PER_RUN,
+    RETENTION_INTERVAL_SECONDS,
+    RETENTION_LEASE_SECONDS,
+)
+
+
+async def write_analytics_events(db: DataSession, rows: List[Dict[str, Any]]) -> None:
+    """Inserts events and bumps their daily rollups in one RPC; without the RPC only the raw rows are written."""
     try:
-        supabase.table("chat_messages") \
-            .delete() \
-            .eq("user_id", user_id) \
-            .lt("created_at", cutoff.isoformat()) \
-            .execute()
-    except Exception as exc:
-        logger.warning("Retention cleanup skipped for %s: %s", user_id, exc)
+        await db.rpc("ingest_analytics_events", {"p_events": rows}).execute()
+    except DataAccessError as exc:
+        if exc.status_code != 404:
+            raise
+        logger.warning("ingest_analytics_events RPC unavailable; analytics rollups are not being updated.")
+        await db.table("analytics_events").insert(rows).execute()
+
+
+class AnalyticsBuffer:
+    """Coalesces analytics events across requests and writes them with bulk inserts.
+
+    A flush happens once `flush_size` events are waiting or every `flush_interval` seconds. At most
+    `max_buffered` events are held in memory; beyond that new events are dropped, or with the "spill"
+    policy appended to a JSONL file that is replayed once the buffer has room again.
+    """
+
+    def __init__(self, db: DataSession, flush_size: int, flush_interval: float, max_buffered: int,
+                 overflow_policy: str, spill_path: str):
+        self.db = db
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.overflow_policy = overflow_policy
+        self.spill_path = spill_path
+        self.accepted = 0
+        self.written = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.errors = 0
+        self.rejected = 0
+        self.flushes = 0
+        self._pending: deque = deque()
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def enqueue(self, rows: List[Dict[str, Any]]) -> int:
+        room = max(self.max_buffered - len(self._pending), 0)
+        accepted, overflow = rows[:room], rows[room:]
+        self._pending.extend(accepted)
+        self.accepted += len(accepted)
+        kept = len(accepted) + (self._overflow(overflow) if overflow else 0)
+        if len(self._pending) >= self.flush_size:
+            self._wakeup.set()
+        return kept
+
+    def _overflow(self, rows: List[Dict[str, Any]]) -> int:
+        """Spills or drops rows that do not fit in memory; returns how many were kept on disk."""
+        if self.overflow_policy == "spill":
+            try:
+                with open(self.spill_path, "a", encoding="utf-8") as spill:
+                    for row in rows:
+                        spill.write(json.dumps(row, default=str) + "\n")
+                self.spilled += len(rows)
+                return len(rows)
+            except OSError as exc:
+                logger.warning("Analytics spill failed: %s", exc)
+        self.dropped += len(rows)
+        return 0
+
+    @staticmethod
+    def _claim_spill(spill_path: str) -> Tuple[List[Dict[str, Any]], int]:
+        """Moves the spill file aside and reads it; runs in a worker thread and only touches the file.
+
+        The rename comes first so events spilled meanwhile start a fresh file instead of racing the read.
+        A claimed file left behind by a failed read is picked up again on the next replay.
+        """
+        claimed = spill_path + ".replay"
+        if not os.path.exists(claimed):
+            if not os.path.exists(spill_path):
+                return [], 0
+            os.replace(spill_path, claimed)
+        rows: List[Dict[str, Any]] = []
+        corrupt = 0
+        with open(claimed, "r", encoding="utf-8") as spill:
+            for line in spill:
+                if not line.strip():
+                    continue
+                try:
+                    rows.append(json.loads(line))
+                except ValueError:
+                    corrupt += 1
+        os.remove(claimed)
+        return rows, corrupt
+
+    async def _replay_spill(self) -> None:
+        if self.overflow_policy != "spill" or len(self._pending) >= self.max_buffered:
+            return
+        try:
+            rows, corrupt = await asyncio.to_thread(self._claim_spill, self.spill_path)
+        except OSError as exc:
+            logger.warning("Analytics spill replay failed: %s", exc)
+            return
+        # Back on the event loop: only here are the queue and counters touched
+        self.spilled -= len(rows) + corrupt
+        self.dropped += corrupt
+        room = max(self.max_buffered - len(self._pending), 0)
+        self._pending.extend(rows[:room])
+        if rows[room:]:
+            self._overflow(rows[room:])
+
+    @staticmethod
+    def _is_retryable(exc: Exception) -> bool:
+        """Transport failures and 5xx (plus 408/429) may succeed later; other errors will fail again."""
+        if isinstance(exc, httpx.TransportError):
+            return True
+        return isinstance(exc, DataAccessError) and (exc.status_code >= 500 or exc.status_code in (408, 429))
+
+    async def flush(self) -> int:
+        async with self._lock:
+            written = 0
+            while self._pending:
+                batch = [self._pending.popleft() for _ in range(min(self.flush_size, len(self._pending)))]
+                try:
+                    await write_analytics_events(self.db, batch)
+                except asyncio.CancelledError:
+                    self._pending.extendleft(reversed(batch))
+                    raise
+                except Exception as exc:
+                    self.errors += 1
+                    if not self._is_retryable(exc):
+                        # A rejected batch would fail on every retry and block everything queued behind it
+                        self.rejected += len(batch)
+                        logger.error("Analytics batch of %s events rejected, dropping it: %s", len(batch), exc)
+                        continue
+                    logger.warning("Analytics flush of %s events failed: %s", len(batch), exc)
+                    # Put the batch back in front; anything that no longer fits follows the overflow policy
+                    room = max(self.max_buffered - len(self._pending), 0)
+                    self._pending.extendleft(reversed(batch[:room]))
+                    if batch[room:]:
+                        self._overflow(batch[room:])
+                    break
+                written += len(batch)
+            self.written += written
+            self.flushes += 1
+            if not self._pending:
+                await self._replay_spill()
+            return written
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as exc:
+                self.errors += 1
+                logger.error("Analytics flush loop error: %s", exc)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self._pending:
+            self._overflow(list(self._pending))
+            self._pending.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "buffered": len(self._pending),
+            "accepted": self.accepted,
+            "written": self.written,
+            "dropped": self.dropped,
+            "spilled": self.spilled,
+            "errors": self.errors,
+            "rejected": self.rejected,
+            "flushes": self.flushes,
+        }
+
+
+analytics_buffer = AnalyticsBuffer(
+    DataSession(data_backend, SUPABASE_SERVICE_ROLE_KEY),
+    ANALYTICS_FLUSH_SIZE,
+    ANALYTICS_FLUSH_INTERVAL_SECONDS,
+    ANALYTICS_MAX_BUFFERED,
+    ANALYTICS_OVERFLOW_POLICY,
+    ANALYTICS_SPILL_PATH,
+)
 
 
 def extract_response_text(response: Any) -> str:
@@ -221,83 +1345,1384 @@ def parse_datetime(value: Optional[str]) -> Optional[datetime]:
         return None
 
 
-def fetch_events_for_day(user_id: str, target_date: date) -> List[Dict[str, Any]]:
-    day_start = datetime.combine(target_date, dt_time.min, tzinfo=timezone.utc)
-    day_end = day_start + timedelta(days=1)
+def parse_date(value: Any) -> Optional[date]:
+    if isinstance(value, date):
+        return value
+    if not value:
+        return None
     try:
-        response = supabase.table("events") \
-            .select("*") \
-            .eq("user_id", user_id) \
-            .gte("starts_at", day_start.isoformat()) \
-            .lt("starts_at", day_end.isoformat()) \
-            .order("starts_at", desc=False) \
-            .execute()
-        events: List[Dict[str, Any]] = []
-        for event in response.data or []:
-            events.append({
-                "id": event.get("id"),
-                "title": event.get("title"),
-                "kind": event.get("kind"),
-                "starts_at": parse_datetime(event.get("starts_at")),
-                "ends_at": parse_datetime(event.get("ends_at")) or parse_datetime(event.get("starts_at")),
-                "notes": event.get("notes"),
-            })
-        return events
+        return date.fromisoformat(str(value)[:10])
+    except ValueError:
+        return None
+
+
+RECURRING_FREQUENCIES = ("daily", "weekly", "biweekly", "monthly")
+WEEKDAY_KEYS = {"mon": 0, "tue": 1, "wed": 2, "thu": 3, "fri": 4, "sat": 5, "sun": 6}
+MIN_OCCURRENCE_DURATION = timedelta(seconds=60)
+
+
+def sunday_week_start(day: date) -> date:
+    """Start of the week containing `day`; weeks start on Sunday as in the iOS Gregorian calendar."""
+    return day - timedelta(days=(day.weekday() + 1) % 7)
+
+
+def add_months(value: datetime, months: int) -> datetime:
+    month_index = value.month - 1 + months
+    year, month = value.year + month_index // 12, month_index % 12 + 1
+    next_month = date(year + month // 12, month % 12 + 1, 1)
+    last_day = (next_month - timedelta(days=1)).day
+    return value.replace(year=year, month=month, day=min(value.day, last_day))
+
+
+def parse_utc_datetime(value: Optional[str]) -> Optional[datetime]:
+    parsed = parse_datetime(value)
+    if parsed is None:
+        return None
+    return parsed.replace(tzinfo=timezone.utc) if parsed.tzinfo is None else parsed.astimezone(timezone.utc)
+
+
+def normalize_event(row: Dict[str, Any]) -> Dict[str, Any]:
+    starts_at = parse_utc_datetime(row.get("starts_at"))
+    ends_at = parse_utc_datetime(row.get("ends_at")) or starts_at
+    end_date = parse_utc_datetime(row.get("end_date"))
+    return {
+        "id": row.get("id"),
+        "title": row.get("title"),
+        "kind": row.get("kind"),
+        "starts_at": starts_at,
+        "ends_at": ends_at,
+        "notes": row.get("notes"),
+        "frequency": row.get("frequency") or "none",
+        "repeat_days": row.get("repeat_days") or [],
+        "end_date": end_date,
+        "override_parent_id": row.get("override_parent_id"),
+        "is_override": bool(row.get("is_override")),
+    }
+
+
+def expand_recurrence(master: Dict[str, Any], window_start: datetime, window_end: datetime,
+                      zone: tzinfo = timezone.utc) -> List[datetime]:
+    """Start times (UTC) of a recurring master's generated occurrences that fall in [window_start, window_end).
+
+    Mirrors AgendaRecurrenceEngine on iOS: the master itself is not part of the result, occurrences run
+    until `end_date` inclusive, weekly/biweekly series use `repeat_days` (or the master's weekday) with
+    biweekly counting weeks from the master's week, and monthly series clamp to the end of short months.
+    Series without an `end_date` are expanded indefinitely instead of for a fixed horizon. Days, weekdays
+    and week parity are those of the user's `zone`, and occurrences keep the master's local wall-clock
+    time across DST changes.
+    """
+    frequency = master.get("frequency")
+    start = master.get("starts_at")
+    horizon = master.get("end_date")
+    if frequency not in RECURRING_FREQUENCIES or start is None:
+        return []
+    if horizon is not None and horizon <= start:
+        return []
+
+    local_start = start.astimezone(zone)
+
+    def in_series(candidate: datetime) -> bool:
+        return candidate > start and (horizon is None or candidate <= horizon)
+
+    def at_local_time(day: date) -> datetime:
+        return datetime.combine(day, local_start.time(), tzinfo=zone).astimezone(timezone.utc)
+
+    starts: List[datetime] = []
+    if frequency == "daily":
+        # Rounded down: a DST shift can put the first occurrence in the window one step earlier
+        step = max(1, (window_start - start) // timedelta(days=1))
+        while True:
+            candidate = at_local_time(local_start.date() + timedelta(days=step))
+            if candidate >= window_end or not in_series(candidate):
+                break
+            if candidate >= window_start:
+                starts.append(candidate)
+            step += 1
+    elif frequency in ("weekly", "biweekly"):
+        weekdays = {WEEKDAY_KEYS.get(str(day)[:3].lower()) for day in master.get("repeat_days") or []}
+        weekdays.discard(None)
+        if not weekdays:
+            weekdays = {local_start.weekday()}
+        base_week = sunday_week_start(local_start.date())
+        day = max(local_start.date() + timedelta(days=1), window_start.astimezone(zone).date() - timedelta(days=1))
+        last_day = window_end.astimezone(zone).date() + timedelta(days=1)
+        while day <= last_day:
+            weeks_between = (sunday_week_start(day) - base_week).days // 7
+            if day.weekday() in weekdays and (frequency == "weekly" or weeks_between % 2 == 0):
+                candidate = at_local_time(day)
+                if window_start <= candidate < window_end and in_series(candidate):
+                    starts.append(candidate)
+            day += timedelta(days=1)
+    else:
+        months = max(1, (window_start.year - local_start.year) * 12 + window_start.month - local_start.month - 1)
+        while True:
+            candidate = add_months(local_start, months).astimezone(timezone.utc)
+            if candidate >= window_end or not in_series(candidate):
+                break
+            if candidate >= window_start:
+                starts.append(candidate)
+            months += 1
+    return starts
+
+
+def month_start(value: datetime) -> datetime:
+    return datetime(value.year, value.month, 1, tzinfo=timezone.utc)
+
+
+class UserAgenda:
+    """One user's events with recurring series expanded into occurrences a month at a time.
+
+    Concrete rows (one-off events, masters and the per-occurrence rows the app stores with
+    `override_parent_id`) and generated occurrences are bucketed by the month they start in, so a
+    range query only touches the months it spans. A stored row for a series replaces the generated
+    occurrence on the same local day of `zone`.
+    """
+
+    def __init__(self, rows: List[Dict[str, Any]], zone: tzinfo = timezone.utc):
+        self.zone = zone
+        self.masters: List[Dict[str, Any]] = []
+        self.concrete: Dict[datetime, List[Dict[str, Any]]] = {}
+        self.overridden: Dict[str, set] = {}
+        self.max_duration = timedelta(0)
+        self._months: Dict[datetime, List[Dict[str, Any]]] = {}
+        for row in rows:
+            event = normalize_event(row)
+            if event["starts_at"] is None:
+                continue
+            parent_id = event["override_parent_id"]
+            recurring = event["frequency"] in RECURRING_FREQUENCIES and not parent_id
+            if recurring:
+                self.masters.append(event)
+            if parent_id:
+                self.overridden.setdefault(str(parent_id), set()).add(event["starts_at"].astimezone(zone).date())
+            self.concrete.setdefault(month_start(event["starts_at"]), []).append(
+                self._occurrence(event, event["starts_at"], event["ends_at"], parent_id or (event["id"] if recurring else None), False)
+            )
+            self.max_duration = max(self.max_duration, event["ends_at"] - event["starts_at"])
+            if recurring:
+                self.max_duration = max(self.max_duration, MIN_OCCURRENCE_DURATION)
+
+    @staticmethod
+    def _occurrence(event: Dict[str, Any], starts_at: datetime, ends_at: datetime, master_id: Optional[str], generated: bool) -> Dict[str, Any]:
+        return {
+            "id": f"{master_id}:{starts_at.isoformat()}" if generated else event["id"],
+            "master_id": master_id,
+            "title": event["title"],
+            "kind": event["kind"],
+            "starts_at": starts_at,
+            "ends_at": ends_at,
+            "notes": event["notes"],
+            "is_override": event["is_override"] and not generated,
+            "generated": generated,
+        }
+
+    def _month(self, key: datetime) -> List[Dict[str, Any]]:
+        cached = self._months.get(key)
+        if cached is not None:
+            return cached
+        window_end = add_months(key, 1)
+        occurrences = list(self.concrete.get(key, []))
+        for master in self.masters:
+            duration = max(MIN_OCCURRENCE_DURATION, master["ends_at"] - master["starts_at"])
+            skipped = self.overridden.get(str(master["id"]), set())
+            for starts_at in expand_recurrence(master, key, window_end, self.zone):
+                if starts_at.astimezone(self.zone).date() not in skipped:
+                    occurrences.append(self._occurrence(master, starts_at, starts_at + duration, master["id"], True))
+        occurrences.sort(key=lambda occurrence: occurrence["starts_at"])
+        self._months[key] = occurrences
+        return occurrences
+
+    def occurrences(self, range_start: datetime, range_end: datetime) -> List[Dict[str, Any]]:
+        """Occurrences overlapping [range_start, range_end), ordered by start."""
+        found: List[Dict[str, Any]] = []
+        key = month_start(range_start - self.max_duration)
+        while key < range_end:
+            for occurrence in self._month(key):
+                if occurrence["starts_at"] >= range_end:
+                    break
+                if occurrence["ends_at"] > range_start or occurrence["starts_at"] >= range_start:
+                    found.append(occurrence)
+            key = add_months(key, 1)
+        return found
+
+
+# Events are written by the app straight to Supabase, so the index can only expire
+agenda_cache = TTLCache(EVENT_INDEX_TRACKED_USERS, EVENT_INDEX_TTL_SECONDS)
+
+
+user_timezone_cache = TTLCache(EVENT_INDEX_TRACKED_USERS, EVENT_INDEX_TTL_SECONDS)
+
+EVENT_COLUMNS = "id, title, kind, starts_at, ends_at, notes, frequency, repeat_days, end_date, override_parent_id, is_override"
+
+
+def parse_timezone(name: Optional[str]) -> Optional[tzinfo]:
+    """The IANA zone called `name`, None when no name is given; unknown names raise ValueError."""
+    if not name:
+        return None
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"Unknown time zone: {name}")
+
+
+async def resolve_user_timezone(db: DataSession, user_id: str, requested: Optional[str] = None) -> tzinfo:
+    """Zone the user's agenda days are computed in: the request's `tz`, else the profile's timezone, else UTC."""
+    zone = parse_timezone(requested)
+    if zone is not None:
+        return zone
+    zone = user_timezone_cache.get(user_id)
+    if zone is not None:
+        return zone
+    try:
+        response = await db.table("user_profiles").select("timezone").eq("user_id", user_id).limit(1).execute()
+        zone = parse_timezone(response.data[0].get("timezone") if response.data else None) or timezone.utc
+    except Exception as exc:
+        logger.warning("Falling back to UTC for %s: %s", user_id, exc)
+        zone = timezone.utc
+    user_timezone_cache.put(user_id, zone)
+    return zone
+
+
+def local_day_start(day: date, zone: tzinfo) -> datetime:
+    """Midnight of `day` in `zone`, as UTC; consecutive days are not always 24 hours apart."""
+    return datetime.combine(day, dt_time.min, tzinfo=zone).astimezone(timezone.utc)
+
+
+async def load_user_agenda(db: DataSession, user_id: str, range_start: datetime, range_end: datetime,
+                           zone: tzinfo = timezone.utc) -> UserAgenda:
+    """The user's agenda for [range_start, range_end): rows overlapping the range plus every recurring master.
+
+    Only `occurrences` within that range are complete; rows outside it are never read.
+    """
+    key = (user_id, str(zone), range_start, range_end)
+    agenda = agenda_cache.get(key)
+    if agenda is not None:
+        return agenda
+
+    def events():
+        return db.table("events").select(EVENT_COLUMNS).eq("user_id", user_id)
+
+    overlapping, open_ended, masters = await asyncio.gather(
+        events().lt("starts_at", range_end.isoformat()).gte("ends_at", range_start.isoformat()).execute(),
+        events().is_("ends_at", None).gte("starts_at", range_start.isoformat()).lt("starts_at", range_end.isoformat()).execute(),
+        events().in_("frequency", list(RECURRING_FREQUENCIES)).is_("override_parent_id", None)
+            .lt("starts_at", range_end.isoformat()).execute(),
+    )
+    rows = {row["id"]: row for result in (overlapping, open_ended, masters) for row in result.data or []}
+    agenda = UserAgenda(list(rows.values()), zone)
+    agenda_cache.put(key, agenda)
+    return agenda
+
+
+async def fetch_events_for_day(db: DataSession, user_id: str, target_date: date,
+                               zone: tzinfo = timezone.utc) -> List[Dict[str, Any]]:
+    day_start = local_day_start(target_date, zone)
+    day_end = local_day_start(target_date + timedelta(days=1), zone)
+    try:
+        agenda = await load_user_agenda(db, user_id, day_start, day_end, zone)
+        return agenda.occurrences(day_start, day_end)
     except Exception as exc:
         logger.error("Failed to load events for %s on %s: %s", user_id, target_date, exc)
         return []
 
 
-def compute_free_slots(events: List[Dict[str, Any]], day_start: datetime, day_end: datetime) -> List[Tuple[datetime, datetime]]:
-    cursor = day_start
+SLEEP_CYCLE = timedelta(minutes=90)
+
+
+def merge_intervals(intervals: List[Tuple[datetime, datetime]]) -> List[Tuple[datetime, datetime]]:
+    merged: List[Tuple[datetime, datetime]] = []
+    for start, end in sorted(interval for interval in intervals if interval[1] > interval[0]):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def subtract_intervals(windows: List[Tuple[datetime, datetime]], busy: List[Tuple[datetime, datetime]]) -> List[Tuple[datetime, datetime]]:
+    """Parts of `windows` not covered by `busy`; both must be sorted and merged, so one sweep suffices."""
     free: List[Tuple[datetime, datetime]] = []
-    for event in sorted(events, key=lambda e: e.get("starts_at") or day_start):
-        start = event.get("starts_at") or day_start
-        end = event.get("ends_at") or start
-        if start > cursor:
-            free.append((cursor, min(start, day_end)))
-        cursor = max(cursor, end if end else cursor)
-    if cursor < day_end:
-        free.append((cursor, day_end))
-    return [slot for slot in free if (slot[1] - slot[0]).total_seconds() >= 15 * 60]
+    first = 0
+    for start, end in windows:
+        while first < len(busy) and busy[first][1] <= start:
+            first += 1
+        cursor = start
+        index = first
+        while index < len(busy) and busy[index][0] < end:
+            if busy[index][0] > cursor:
+                free.append((cursor, busy[index][0]))
+            cursor = max(cursor, busy[index][1])
+            index += 1
+        if cursor < end:
+            free.append((cursor, end))
+    return free
+
+
+def availability_windows(blocks: List[Tuple[datetime, datetime]], range_start: datetime, range_end: datetime,
+                         zone: tzinfo = timezone.utc) -> List[Tuple[datetime, datetime]]:
+    """Day by day (local to `zone`), the user's availability blocks when that day has any and the whole day otherwise (as the app does)."""
+    merged = merge_intervals([(max(start, range_start), min(end, range_end)) for start, end in blocks])
+    windows: List[Tuple[datetime, datetime]] = []
+    index = 0
+    day_start = range_start
+    while day_start < range_end:
+        day_end = min(local_day_start(day_start.astimezone(zone).date() + timedelta(days=1), zone), range_end)
+        while index < len(merged) and merged[index][1] <= day_start:
+            index += 1
+        declared = []
+        cursor = index
+        while cursor < len(merged) and merged[cursor][0] < day_end:
+            declared.append((max(merged[cursor][0], day_start), min(merged[cursor][1], day_end)))
+            cursor += 1
+        windows.extend(declared or [(day_start, day_end)])
+        day_start = day_end
+    return merge_intervals(windows)
+
+
+def sleep_windows(sleep_prefs: Optional[Dict[str, Any]], range_start: datetime, range_end: datetime,
+                  zone: tzinfo = timezone.utc) -> List[Tuple[datetime, datetime]]:
+    """Nightly sleep ending at target_wake_time (a wall-clock time in `zone`) and lasting `cycles` 90-minute cycles."""
+    if not sleep_prefs or parse_clock(sleep_prefs.get("target_wake_time")) is None:
+        return []
+    wake_minute = parse_clock(sleep_prefs.get("target_wake_time"))
+    wake_offset, wake_minute = divmod(wake_minute, MINUTES_PER_DAY)
+    wake_clock = dt_time(wake_minute // 60, wake_minute % 60)
+    duration = SLEEP_CYCLE * (sleep_prefs.get("cycles") or 5)
+    windows = []
+    day = range_start.astimezone(zone).date() - timedelta(days=1)
+    while day <= range_end.astimezone(zone).date() + timedelta(days=1):
+        wake = datetime.combine(day + timedelta(days=wake_offset), wake_clock, tzinfo=zone).astimezone(timezone.utc)
+        windows.append((wake - duration, wake))
+        day += timedelta(days=1)
+    return windows
+
+
+def compute_free_slots(events: List[Dict[str, Any]], range_start: datetime, range_end: datetime,
+                       availability: Optional[List[Tuple[datetime, datetime]]] = None,
+                       sleep_prefs: Optional[Dict[str, Any]] = None,
+                       min_minutes: int = FREE_SLOT_MIN_MINUTES,
+                       zone: tzinfo = timezone.utc) -> List[Tuple[datetime, datetime]]:
+    """Free intervals in [range_start, range_end), which may span several days.
+
+    Events and sleep are padded by the user's buffer_minutes, merged and swept against the
+    availability windows, so a dense month costs one sort plus a linear pass.
+    """
+    buffer = timedelta(minutes=(sleep_prefs or {}).get("buffer_minutes") or 0)
+    busy = [
+        (event["starts_at"] - buffer, (event.get("ends_at") or event["starts_at"]) + buffer)
+        for event in events
+        if event.get("starts_at")
+    ]
+    busy.extend((start - buffer, end + buffer) for start, end in sleep_windows(sleep_prefs, range_start, range_end, zone))
+    windows = availability_windows(availability or [], range_start, range_end, zone)
+    minimum = timedelta(minutes=min_minutes)
+    return [slot for slot in subtract_intervals(windows, merge_intervals(busy)) if slot[1] - slot[0] >= minimum]
+
+
+free_slot_cache = TTLCache(FREE_SLOT_CACHE_SIZE, EVENT_INDEX_TTL_SECONDS)
+
+
+async def find_free_slots(db: DataSession, user_id: str, range_start: datetime, range_end: datetime,
+                          min_minutes: int = FREE_SLOT_MIN_MINUTES,
+                          exclude_kinds: Tuple[str, ...] = (),
+                          zone: tzinfo = timezone.utc) -> List[Tuple[datetime, datetime]]:
+    """Free slots for the range, cached until the TTL or until the user's sleep_prefs or availability_blocks change.
+
+    Those rows are written by the app straight to Supabase, so they are read on every call (two small
+    queries) and their contents are part of the cache key; only events can be up to the agenda TTL stale.
+    """
+    blocks, prefs = await asyncio.gather(
+        db.table("availability_blocks")
+            .select("start_at, end_at")
+            .eq("user_id", user_id)
+            .lt("start_at", range_end.isoformat())
+            .gt("end_at", range_start.isoformat())
+            .execute(),
+        db.table("sleep_prefs").select("target_wake_time, cycles, buffer_minutes, updated_at").eq("user_id", user_id).execute()
+    )
+    inputs = payload_etag([blocks.data, prefs.data])
+    key = (user_id, str(zone), range_start, range_end, min_minutes, tuple(sorted(exclude_kinds)), inputs)
+    cached = free_slot_cache.get(key)
+    if cached is not None:
+        return cached
+    agenda = await load_user_agenda(db, user_id, range_start, range_end, zone)
+    events = [event for event in agenda.occurrences(range_start, range_end) if event.get("kind") not in exclude_kinds]
+    availability = [
+        (parse_utc_datetime(block.get("start_at")), parse_utc_datetime(block.get("end_at")))
+        for block in blocks.data
+        if block.get("start_at") and block.get("end_at")
+    ]
+    slots = compute_free_slots(events, range_start, range_end, availability, prefs.data[0] if prefs.data else None, min_minutes, zone)
+    free_slot_cache.put(key, slots)
+    return slots
+
+
+def scheduled_days(habit: Dict[str, Any], window_start: date, days: int) -> int:
+    """Number of days in the window on which the habit is due (weekly habits only count their target_days)."""
+    if days <= 0:
+        return 0
+    if habit.get("frequency") != "weekly":
+        return days
+    target_days = set(habit.get("target_days") or [])
+    if not target_days:
+        return max(1, -(-days // 7))
+    full_weeks, remainder = divmod(days, 7)
+    tail = sum(1 for offset in range(remainder) if (window_start + timedelta(days=offset)).weekday() in target_days)
+    return full_weeks * len(target_days) + tail
+
+
+def repeat_weekly(pattern: int, weeks: int) -> int:
+    """Concatenate a 7-bit weekday pattern `weeks` times using O(log weeks) shifts."""
+    result, block, width = 0, pattern, 7
+    while weeks:
+        if weeks & 1:
+            result = (result << width) | block
+        block |= block << width
+        width *= 2
+        weeks >>= 1
+    return result
+
+
+class HabitHistory:
+    """Completed days of one habit packed into an int bitset.
+
+    Bit `i` stands for `origin + i` days and `origin` is always a Monday, so weekday masks line up
+    with the bits and every streak or window query is a handful of shifts, masks and popcounts.
+    """
+
+    __slots__ = ("origin", "bits", "loaded_at", "_longest")
+
+    def __init__(self, origin: date, loaded_at: float):
+        self.origin = origin - timedelta(days=origin.weekday())
+        self.bits = 0
+        self.loaded_at = loaded_at
+        self._longest: Optional[Tuple[Tuple[Any, ...], int]] = None
+
+    def set_day(self, day: date, completed: bool) -> None:
+        if day < self.origin:
+            shift = -(-(self.origin - day).days // 7) * 7
+            self.bits <<= shift
+            self.origin -= timedelta(days=shift)
+        mask = 1 << (day - self.origin).days
+        updated = self.bits | mask if completed else self.bits & ~mask
+        if updated != self.bits:
+            self.bits = updated
+            self._longest = None
+
+    def completed_between(self, start: date, end: date) -> int:
+        low = max((start - self.origin).days, 0)
+        high = (end - self.origin).days
+        if high < low:
+            return 0
+        return ((self.bits >> low) & ((1 << (high - low + 1)) - 1)).bit_count()
+
+    def _slots(self, habit: Dict[str, Any], today: date) -> Tuple[int, int, int, str]:
+        """Completed and due slot masks up to today plus the index of the current slot.
+
+        Daily habits have one slot per day, weekly habits with target_days one slot per target weekday
+        and weekly habits without target_days one slot per week, anchored on its Monday.
+        """
+        span = (today - self.origin).days + 1
+        if span <= 0:
+            return 0, 0, -1, "days"
+        window = (1 << span) - 1
+        completed = self.bits & window
+        weeks = -(-span // 7)
+        target_days = {day for day in habit.get("target_days") or [] if 0 <= day <= 6}
+        if habit.get("frequency") != "weekly":
+            return completed, window, span - 1, "days"
+        if target_days:
+            due = repeat_weekly(sum(1 << day for day in target_days), weeks) & window
+            return completed & due, due, span - 1, "days"
+        mondays = repeat_weekly(1, weeks)
+        folded = completed
+        for offset in range(1, 7):
+            folded |= completed >> offset
+        return folded & mondays, mondays, (span - 1) - (span - 1) % 7, "weeks"
+
+    def streaks(self, habit: Dict[str, Any], today: date) -> Tuple[int, int, str]:
+        completed, due, current, unit = self._slots(habit, today)
+        # The current slot only counts as missed once it is over
+        end = current - 1 if (due >> current) & 1 and not (completed >> current) & 1 else current
+        misses = due & ~completed & ((1 << (end + 1)) - 1)
+        current_streak = (completed >> misses.bit_length()).bit_count()
+
+        key = (habit.get("frequency"), tuple(sorted(habit.get("target_days") or [])), end)
+        if self._longest is None or self._longest[0] != key:
+            longest, high, remaining = 0, end + 1, misses
+            while True:
+                low = remaining.bit_length()
+                longest = max(longest, ((completed >> low) & ((1 << max(high - low, 0)) - 1)).bit_count())
+                if not remaining:
+                    break
+                high = low - 1
+                remaining ^= 1 << high
+            self._longest = (key, longest)
+        return current_streak, max(self._longest[1], current_streak), unit
+
+    def summary(self, habit: Dict[str, Any], today: date) -> Dict[str, Any]:
+        current_streak, longest_streak, unit = self.streaks(habit, today)
+        rates = {}
+        for days in HABIT_ROLLING_WINDOWS:
+            window_start = today - timedelta(days=days - 1)
+            due_days = scheduled_days(habit, window_start, days)
+            completed = self.completed_between(window_start, today)
+            rates[f"{days}d"] = round(min(100.0, completed / due_days * 100), 1) if due_days > 0 else 0
+        return {
+            "current_streak": current_streak,
+            "longest_streak": longest_streak,
+            "streak_unit": unit,
+            "completion_rates": rates,
+        }
 
 
-class AgendaRecommendationAgent:
-    def __init__(self, client: Optional[OpenAI], model: str, use_mock: bool):
+class HabitStreakIndex:
+    """Per-habit completion bitsets, rebuilt lazily from habit_tracking and patched on every tracking write.
+
+    Histories are re-read after `resync_seconds` so writes handled by other workers are picked up.
+    """
+
+    def __init__(self, max_habits: int, resync_seconds: int, page_size: int):
+        self.max_habits = max_habits
+        self.resync_seconds = resync_seconds
+        self.page_size = page_size
+        self.hits = 0
+        self.rebuilds = 0
+        self._histories: OrderedDict[str, HabitHistory] = OrderedDict()
+
+    def _fresh(self, habit_id: str) -> Optional[HabitHistory]:
+        history = self._histories.get(habit_id)
+        if history is None or time.time() - history.loaded_at > self.resync_seconds:
+            return None
+        self._histories.move_to_end(habit_id)
+        return history
+
+    async def histories(self, db: DataSession, user_id: str, habit_ids: List[str]) -> Dict[str, HabitHistory]:
+        found: Dict[str, HabitHistory] = {}
+        missing: List[str] = []
+        for habit_id in habit_ids:
+            history = self._fresh(habit_id)
+            if history is None:
+                missing.append(habit_id)
+            else:
+                found[habit_id] = history
+        self.hits += len(found)
+        if missing:
+            found.update(await self._rebuild(db, user_id, missing))
+        return found
+
+    async def _rebuild(self, db: DataSession, user_id: str, habit_ids: List[str]) -> Dict[str, HabitHistory]:
+        loaded_at = time.time()
+        today = utc_today()
+        rebuilt = {habit_id: HabitHistory(today, loaded_at) for habit_id in habit_ids}
+        cursor: Optional[str] = None
+        strict = False
+        while True:
+            query = db.table("habit_tracking") \
+                .select("habit_id, date") \
+                .eq("user_id", user_id) \
+                .in_("habit_id", habit_ids) \
+                .eq("completed", True)
+            if cursor is not None:
+                query = query.gt("date", cursor) if strict else query.gte("date", cursor)
+            page = await query.order("date").limit(self.page_size).execute()
+            for row in page.data:
+                history = rebuilt.get(row.get("habit_id"))
+                day = parse_date(row.get("date"))
+                if history is not None and day is not None:
+                    history.set_day(day, True)
+            if len(page.data) < self.page_size:
+                break
+            # Pages overlap on their boundary date; setting a bit twice is harmless
+            last = page.data[-1]["date"]
+            strict = last == cursor
+            cursor = last
+        self.rebuilds += len(rebuilt)
+        for habit_id, history in rebuilt.items():
+            self._histories[habit_id] = history
+            self._histories.move_to_end(habit_id)
+        while len(self._histories) > self.max_habits:
+            self._histories.popitem(last=False)
+        return rebuilt
+
+    def record(self, habit_id: str, day: date, completed: bool) -> None:
+        history = self._histories.get(habit_id)
+        if history is not None:
+            history.set_day(day, completed)
+
+    def invalidate(self, habit_id: str) -> None:
+        self._histories.pop(habit_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._histories),
+            "max_size": self.max_habits,
+            "hits": self.hits,
+            "rebuilds": self.rebuilds,
+        }
+
+
+habit_streaks = HabitStreakIndex(HABIT_STREAK_TRACKED_HABITS, HABIT_STREAK_RESYNC_SECONDS, HABIT_HISTORY_PAGE_SIZE)
+
+
+def compute_habit_stats(habits: List[Dict[str, Any]], histories: Dict[str, HabitHistory], today: date, days: int) -> List[Dict[str, Any]]:
+    window_start = today - timedelta(days=max(days, 1) - 1)
+    stats = []
+    for habit in habits:
+        history = histories.get(habit["id"]) or HabitHistory(today, time.time())
+        completed_count = history.completed_between(window_start, today)
+        due_days = scheduled_days(habit, window_start, days)
+        completion_rate = min(100.0, completed_count / due_days * 100) if due_days > 0 else 0
+        stats.append({
+            "habit_id": habit["id"],
+            "title": habit["title"],
+            "completion_rate": round(completion_rate, 1),
+            "completed_count": completed_count,
+            "scheduled_days": due_days,
+            "total_days": days,
+            **history.summary(habit, today)
+        })
+    return stats
+
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+SCHEDULE_LOAD_TYPES = ("academic", "training", "other")
+
+
+def parse_clock(value: Any) -> Optional[int]:
+    """Minutes after midnight for an "HH:MM" (or "HH:MM:SS") string."""
+    try:
+        hours, minutes = str(value).split(":")[:2]
+        total = int(hours) * 60 + int(minutes)
+    except (TypeError, ValueError):
+        return None
+    return total if 0 <= total <= MINUTES_PER_DAY else None
+
+
+def format_clock(minute_of_week: int) -> str:
+    minute_of_day = minute_of_week % MINUTES_PER_DAY
+    return f"{minute_of_day // 60:02d}:{minute_of_day % 60:02d}"
+
+
+def schedule_intervals(schedule: Dict[str, Any]) -> List[Tuple[int, int]]:
+    """Minute-of-week intervals covered by a weekly block.
+
+    A block whose end is earlier than its start runs past midnight into the next day, and a Sunday
+    block doing so is split at the week boundary. An end of 24:00 closes the block at midnight.
+    """
+    day = schedule.get("day_of_week")
+    start = parse_clock(schedule.get("start_time"))
+    end = parse_clock(schedule.get("end_time"))
+    if not isinstance(day, int) or not 0 <= day <= 6 or start is None or end is None:
+        return []
+    duration = end - start if end > start else (end - start) % MINUTES_PER_DAY
+    if duration == 0:
+        return []
+    begin = day * MINUTES_PER_DAY + start
+    finish = begin + duration
+    if finish <= MINUTES_PER_WEEK:
+        return [(begin, finish)]
+    return [(begin, MINUTES_PER_WEEK), (0, finish - MINUTES_PER_WEEK)]
+
+
+class WeeklyLoad:
+    """One user's weekly schedule: per-day minute totals by block type plus the blocks needed to keep them current."""
+
+    __slots__ = ("blocks", "minutes", "loaded_at", "_overlaps")
+
+    def __init__(self, loaded_at: float):
+        self.blocks: Dict[str, Tuple[str, List[Tuple[int, int]]]] = {}
+        self.minutes: Dict[str, List[int]] = {kind: [0] * 7 for kind in SCHEDULE_LOAD_TYPES}
+        self.loaded_at = loaded_at
+        self._overlaps: Optional[List[Dict[str, Any]]] = None
+
+    def _apply(self, kind: str, intervals: List[Tuple[int, int]], sign: int) -> None:
+        totals = self.minutes[kind]
+        for begin, finish in intervals:
+            cursor = begin
+            while cursor < finish:
+                day = cursor // MINUTES_PER_DAY
+                day_end = min(finish, (day + 1) * MINUTES_PER_DAY)
+                totals[day] += sign * (day_end - cursor)
+                cursor = day_end
+
+    def upsert(self, schedule: Dict[str, Any]) -> None:
+        schedule_id = str(schedule.get("id"))
+        self.remove(schedule_id)
+        kind = schedule.get("type") if schedule.get("type") in ("academic", "training") else "other"
+        intervals = schedule_intervals(schedule)
+        self.blocks[schedule_id] = (kind, intervals)
+        self._apply(kind, intervals, 1)
+        self._overlaps = None
+
+    def remove(self, schedule_id: str) -> None:
+        block = self.blocks.pop(str(schedule_id), None)
+        if block is not None:
+            self._apply(block[0], block[1], -1)
+            self._overlaps = None
+
+    def hours(self, kind: str) -> float:
+        return sum(self.minutes[kind]) / 60
+
+    def days(self) -> List[Dict[str, Any]]:
+        breakdown = []
+        for day in range(7):
+            academic = self.minutes["academic"][day] / 60
+            training = self.minutes["training"][day] / 60
+            breakdown.append({
+                "day_of_week": day,
+                "academic_hours": round(academic, 1),
+                "training_hours": round(training, 1),
+                "total_hours": round(academic + training, 1)
+            })
+        return breakdown
+
+    def overlaps(self) -> List[Dict[str, Any]]:
+        """Stretches of the week covered by two or more blocks, found with a sweep over interval endpoints."""
+        if self._overlaps is not None:
+            return self._overlaps
+        points: List[Tuple[int, int, str]] = []
+        for schedule_id, (_, intervals) in self.blocks.items():
+            for begin, finish in intervals:
+                points.append((begin, 1, schedule_id))
+                points.append((finish, -1, schedule_id))
+        # Ends sort before starts at the same minute, so back-to-back blocks do not overlap
+        points.sort(key=lambda point: (point[0], point[1]))
+        active: Dict[str, int] = {}
+        overlaps: List[Dict[str, Any]] = []
+        region_start: Optional[int] = None
+        region_ids: set = set()
+        for minute, delta, schedule_id in points:
+            if delta < 0:
+                active[schedule_id] -= 1
+                if not active[schedule_id]:
+                    del active[schedule_id]
+                if region_start is not None and len(active) < 2:
+                    if minute > region_start:
+                        overlaps.append({
+                            "day_of_week": region_start // MINUTES_PER_DAY,
+                            "start_time": format_clock(region_start),
+                            "end_time": format_clock(minute),
+                            "minutes": minute - region_start,
+                            "schedule_ids": sorted(region_ids)
+                        })
+                    region_start = None
+            else:
+                active[schedule_id] = active.get(schedule_id, 0) + 1
+                if len(active) >= 2:
+                    if region_start is None:
+                        region_start = minute
+                        region_ids = set()
+                    region_ids.update(active)
+        self._overlaps = overlaps
+        return overlaps
+
+
+class ScheduleLoadIndex:
+    """Per-user WeeklyLoad, built from one schedules query and patched by the schedule write endpoints.
+
+    Entries are re-read after `resync_seconds` so writes handled by other workers are picked up.
+    """
+
+    def __init__(self, max_users: int, resync_seconds: int):
+        self.max_users = max_users
+        self.resync_seconds = resync_seconds
+        self.hits = 0
+        self.rebuilds = 0
+        self._loads: OrderedDict[str, WeeklyLoad] = OrderedDict()
+
+    def _fresh(self, user_id: str) -> Optional[WeeklyLoad]:
+        load = self._loads.get(user_id)
+        if load is None or time.time() - load.loaded_at > self.resync_seconds:
+            return None
+        self._loads.move_to_end(user_id)
+        return load
+
+    async def get(self, db: DataSession, user_id: str) -> WeeklyLoad:
+        load = self._fresh(user_id)
+        if load is not None:
+            self.hits += 1
+            return load
+        loaded_at = time.time()
+        response = await db.table("schedules") \
+            .select("id, day_of_week, start_time, end_time, type") \
+            .eq("user_id", user_id) \
+            .execute()
+        load = WeeklyLoad(loaded_at)
+        for schedule in response.data:
+            load.upsert(schedule)
+        self.rebuilds += 1
+        self._loads[user_id] = load
+        self._loads.move_to_end(user_id)
+        while len(self._loads) > self.max_users:
+            self._loads.popitem(last=False)
+        return load
+
+    def record(self, user_id: str, schedule: Optional[Dict[str, Any]]) -> None:
+        load = self._loads.get(user_id)
+        if load is None:
+            return
+        if schedule and schedule.get("id") is not None:
+            load.upsert(schedule)
+        else:
+            self.invalidate(user_id)
+
+    def discard(self, user_id: str, schedule_id: str) -> None:
+        load = self._loads.get(user_id)
+        if load is not None:
+            load.remove(schedule_id)
+
+    def invalidate(self, user_id: str) -> None:
+        self._loads.pop(user_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._loads),
+            "max_size": self.max_users,
+            "hits": self.hits,
+            "rebuilds": self.rebuilds,
+        }
+
+
+schedule_loads = ScheduleLoadIndex(SCHEDULE_LOAD_TRACKED_USERS, SCHEDULE_LOAD_RESYNC_SECONDS)
+
+
+DIARY_METRICS = ("mood", "energy", "stress")
+DIARY_WINDOWS = (7, 30, 90)
+DIARY_HORIZON_DAYS = 2 * max(DIARY_WINDOWS)
+DIARY_EPOCH = date(2020, 1, 1).toordinal()
+
+
+class WindowSums:
+    """Count and least-squares sums of one date window; x is days since DIARY_EPOCH."""
+
+    __slots__ = ("count", "x", "xx", "y", "xy")
+
+    def __init__(self):
+        self.count = 0
+        self.x = 0
+        self.xx = 0
+        self.y = [0.0] * len(DIARY_METRICS)
+        self.xy = [0.0] * len(DIARY_METRICS)
+
+    def add(self, ordinal: int, values: Tuple[float, ...], sign: int) -> None:
+        x = ordinal - DIARY_EPOCH
+        self.count += sign
+        self.x += sign * x
+        self.xx += sign * x * x
+        for index, value in enumerate(values):
+            self.y[index] += sign * value
+            self.xy[index] += sign * x * value
+
+    def averages(self) -> Optional[List[float]]:
+        return [total / self.count for total in self.y] if self.count else None
+
+    def slopes(self) -> Optional[List[float]]:
+        denominator = self.count * self.xx - self.x * self.x
+        if self.count < 2 or denominator == 0:
+            return None
+        return [(self.count * self.xy[index] - self.x * self.y[index]) / denominator for index in range(len(DIARY_METRICS))]
+
+
+class DiaryMetrics:
+    """Running sums of one user's mood/energy/stress over the last 7/30/90 days and the windows before them.
+
+    Writes adjust every window containing the entry's date, and a new day slides each window by
+    removing the days that left it and adding those that entered, so reads never touch the entries.
+    """
+
+    __slots__ = ("today", "entries", "windows", "loaded_at")
+
+    def __init__(self, today: date, loaded_at: float):
+        self.today = today
+        self.entries: Dict[int, Tuple[float, ...]] = {}
+        self.windows: Dict[Tuple[int, int], WindowSums] = {
+            (width, back): WindowSums() for width in DIARY_WINDOWS for back in (0, 1)
+        }
+        self.loaded_at = loaded_at
+
+    def _bounds(self, today: date, width: int, back: int) -> Tuple[int, int]:
+        last = today.toordinal() - back * width
+        return last - width + 1, last
+
+    def _apply(self, ordinal: int, values: Tuple[float, ...], sign: int) -> None:
+        for (width, back), sums in self.windows.items():
+            first, last = self._bounds(self.today, width, back)
+            if first <= ordinal <= last:
+                sums.add(ordinal, values, sign)
+
+    def set_entry(self, day: date, values: Tuple[float, ...]) -> None:
+        ordinal = day.toordinal()
+        if ordinal <= self.today.toordinal() - DIARY_HORIZON_DAYS:
+            return
+        previous = self.entries.get(ordinal)
+        if previous is not None:
+            self._apply(ordinal, previous, -1)
+        self.entries[ordinal] = values
+        self._apply(ordinal, values, 1)
+
+    def advance(self, today: date) -> None:
+        if today <= self.today:
+            return
+        if (today - self.today).days >= DIARY_HORIZON_DAYS:
+            self.today = today
+            self.windows = {key: WindowSums() for key in self.windows}
+            self.entries = {ordinal: values for ordinal, values in self.entries.items() if ordinal > today.toordinal() - DIARY_HORIZON_DAYS}
+            for ordinal, values in self.entries.items():
+                self._apply(ordinal, values, 1)
+            return
+        for (width, back), sums in self.windows.items():
+            old_first, old_last = self._bounds(self.today, width, back)
+            new_first, new_last = self._bounds(today, width, back)
+            for ordinal in range(old_first, min(old_last, new_first - 1) + 1):
+                if ordinal in self.entries:
+                    sums.add(ordinal, self.entries[ordinal], -1)
+            for ordinal in range(max(new_first, old_last + 1), new_last + 1):
+                if ordinal in self.entries:
+                    sums.add(ordinal, self.entries[ordinal], 1)
+        self.today = today
+        for ordinal in [ordinal for ordinal in self.entries if ordinal <= today.toordinal() - DIARY_HORIZON_DAYS]:
+            del self.entries[ordinal]
+
+    def window(self, width: int) -> Dict[str, Any]:
+        current = self.windows[(width, 0)]
+        previous = self.windows[(width, 1)]
+        averages = current.averages()
+        previous_averages = previous.averages()
+        slopes = current.slopes()
+        summary: Dict[str, Any] = {"entries_count": current.count}
+        for index, metric in enumerate(DIARY_METRICS):
+            summary[f"avg_{metric}"] = round(averages[index], 2) if averages else None
+            summary[f"delta_{metric}"] = round(averages[index] - previous_averages[index], 2) if averages and previous_averages else None
+            summary[f"slope_{metric}"] = round(slopes[index], 3) if slopes else None
+        return summary
+
+
+class DiaryMetricsIndex:
+    """Per-user DiaryMetrics, rebuilt from the numeric diary columns and patched by create_diary_entry.
+
+    Entries are re-read after `resync_seconds` so writes handled by other workers are picked up.
+    """
+
+    def __init__(self, max_users: int, resync_seconds: int):
+        self.max_users = max_users
+        self.resync_seconds = resync_seconds
+        self.hits = 0
+        self.rebuilds = 0
+        self._metrics: OrderedDict[str, DiaryMetrics] = OrderedDict()
+
+    async def get(self, db: DataSession, user_id: str) -> DiaryMetrics:
+        today = utc_today()
+        metrics = self._metrics.get(user_id)
+        if metrics is not None and time.time() - metrics.loaded_at <= self.resync_seconds:
+            self._metrics.move_to_end(user_id)
+            metrics.advance(today)
+            self.hits += 1
+            return metrics
+        loaded_at = time.time()
+        response = await db.table("diary_entries") \
+            .select("date, mood, energy, stress") \
+            .eq("user_id", user_id) \
+            .gt("date", (today - timedelta(days=DIARY_HORIZON_DAYS)).isoformat()) \
+            .execute()
+        metrics = DiaryMetrics(today, loaded_at)
+        for row in response.data:
+            day = parse_date(row.get("date"))
+            if day is not None:
+                metrics.set_entry(day, tuple(float(row.get(metric) or 0) for metric in DIARY_METRICS))
+        self.rebuilds += 1
+        self._metrics[user_id] = metrics
+        self._metrics.move_to_end(user_id)
+        while len(self._metrics) > self.max_users:
+            self._metrics.popitem(last=False)
+        return metrics
+
+    def record(self, user_id: str, entry: Dict[str, Any]) -> None:
+        metrics = self._metrics.get(user_id)
+        day = parse_date(entry.get("date"))
+        if metrics is None or day is None:
+            return
+        metrics.advance(utc_today())
+        metrics.set_entry(day, tuple(float(entry.get(metric) or 0) for metric in DIARY_METRICS))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._metrics),
+            "max_size": self.max_users,
+            "hits": self.hits,
+            "rebuilds": self.rebuilds,
+        }
+
+
+diary_metrics = DiaryMetricsIndex(DIARY_METRICS_TRACKED_USERS, DIARY_METRICS_RESYNC_SECONDS)
+
+
+class UserContextSnapshot:
+    """Profile, weekly load, last week's mood and habit completion used to personalise AI recommendations."""
+
+    __slots__ = ("profile", "total_hours", "training_hours", "academic_hours", "avg_mood", "avg_energy",
+                 "avg_stress", "habit_completion_rate", "built_at")
+
+    def __init__(self, profile: Dict[str, Any], load: WeeklyLoad, diary: DiaryMetrics,
+                 habits: List[Dict[str, Any]], habit_tracking: List[Dict[str, Any]]):
+        self.profile = profile
+        self.training_hours = load.hours("training")
+        # Anything that is not training counts towards the academic side here
+        self.academic_hours = load.hours("academic") + load.hours("other")
+        self.total_hours = self.training_hours + self.academic_hours
+
+        week = diary.window(7)
+        self.avg_mood = week["avg_mood"] if week["entries_count"] else 3
+        self.avg_energy = week["avg_energy"] if week["entries_count"] else 3
+        self.avg_stress = week["avg_stress"] if week["entries_count"] else 3
+
+        self.habit_completion_rate = 0
+        if habits and habit_tracking:
+            completed = sum(1 for t in habit_tracking if t["completed"])
+            total_possible = len(habits) * 7
+            self.habit_completion_rate = (completed / total_possible * 100) if total_possible > 0 else 0
+        self.built_at = time.time()
+
+    @classmethod
+    async def build(cls, db: DataSession, user_id: str) -> "UserContextSnapshot":
+        week_ago = (utc_today() - timedelta(days=7)).isoformat()
+        profile, load, diary, habits, habit_tracking = await asyncio.gather(
+            db.table("user_profiles").select("*").eq("user_id", user_id).execute(),
+            schedule_loads.get(db, user_id),
+            diary_metrics.get(db, user_id),
+            db.table("habits").select("id").eq("user_id", user_id).eq("active", True).execute(),
+            db.table("habit_tracking").select("completed").eq("user_id", user_id).gte("date", week_ago).execute()
+        )
+        return cls(profile.data[0] if profile.data else {}, load, diary, habits.data, habit_tracking.data)
+
+    @property
+    def load_level(self) -> str:
+        return "alto" if self.total_hours > 40 else "moderado" if self.total_hours > 30 else "equilibrado"
+
+    @property
+    def mood_trend(self) -> str:
+        return "positiva" if self.avg_mood > 3.5 else "estable" if self.avg_mood > 2.5 else "requiere atención"
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "mood": self.avg_mood,
+            "energy": self.avg_energy,
+            "stress": self.avg_stress,
+            "total_hours": self.total_hours,
+            "habit_completion": self.habit_completion_rate
+        }
+
+
+user_context_cache = TTLCache(USER_CONTEXT_CACHE_SIZE, USER_CONTEXT_CACHE_TTL_SECONDS)
+# Invalidation times, so a snapshot whose build overlapped a write is not cached
+user_context_invalidations = TTLCache(USER_CONTEXT_CACHE_SIZE, USER_CONTEXT_CACHE_TTL_SECONDS)
+
+
+async def load_user_context(db: DataSession, user_id: str) -> UserContextSnapshot:
+    cached = user_context_cache.get(user_id)
+    if cached is not None:
+        return cached
+    started_at = time.time()
+    snapshot = await UserContextSnapshot.build(db, user_id)
+    invalidated_at = user_context_invalidations.get(user_id)
+    if invalidated_at is None or invalidated_at < started_at:
+        user_context_cache.put(user_id, snapshot)
+    return snapshot
+
+
+def invalidate_user_context(user_id: str) -> None:
+    user_context_cache.invalidate(user_id)
+    user_context_invalidations.put(user_id, time.time())
+
+
+def heuristic_recommendation(snapshot: UserContextSnapshot) -> str:
+    """Local recommendation from the snapshot metrics, used with USE_MOCK_AI or while the model is unavailable."""
+    metrics = snapshot.metrics()
+    sport = snapshot.profile.get("sport") or "tu deporte"
+    steps: List[str] = []
+    if metrics["stress"] >= 3.5:
+        steps.append("Antes de tu próximo entrenamiento, haz 4 minutos de respiración cuadrada (4-4-4-4).")
+    if metrics["energy"] <= 2.5:
+        steps.append("Prioriza 7-9 horas de sueño esta semana y agenda una siesta corta en tu primer bloque libre.")
+    if metrics["total_hours"] > 40:
+        steps.append("Tu carga semanal es alta: reserva dos bloques de 30 minutos sin pantallas para recuperarte.")
+    if metrics["habit_completion"] < 50:
+        steps.append("Elige un solo hábito clave y complétalo cada día antes de sumar otros.")
+    steps.extend([
+        f"Visualiza durante 5 minutos una ejecución exitosa en {sport} antes de entrenar.",
+        "Escribe al final del día un logro concreto y un aspecto a mejorar.",
+        "Define un objetivo específico y medible para tu sesión principal de mañana.",
+    ])
+    numbered = "\n".join(f"{index}. {step}" for index, step in enumerate(steps[:3], start=1))
+    return (
+        f"Esta semana tu carga es {snapshot.load_level} y tu tendencia de ánimo es {snapshot.mood_trend}.\n\n"
+        f"Pasos recomendados:\n{numbered}\n\n"
+        "Pequeños pasos constantes sostienen el rendimiento: vas por buen camino."
+    )
+
+
+def build_event_context(events: List[Dict[str, Any]], target_date: date) -> List[Dict[str, Any]]:
+    day_start = datetime.combine(target_date, dt_time.min, tzinfo=timezone.utc)
+    return [
+        {
+            "title": event.get("title"),
+            "kind": event.get("kind"),
+            "start": (event.get("starts_at") or day_start).isoformat(),
+            "end": (event.get("ends_at") or day_start).isoformat(),
+            "notes": event.get("notes"),
+        }
+        for event in events
+    ]
+
+
+# ============ LLM EXECUTION ============
+
+LLM_MAX_CONCURRENCY_PER_MODEL = int(os.getenv("LLM_MAX_CONCURRENCY_PER_MODEL", "8"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BASE_SECONDS = float(os.getenv("LLM_RETRY_BASE_SECONDS", "0.5"))
+LLM_BREAKER_FAILURE_THRESHOLD = int(os.getenv("LLM_BREAKER_FAILURE_THRESHOLD", "5"))
+LLM_BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+LLM_FAULT_LATENCY_MS = int(os.getenv("LLM_FAULT_LATENCY_MS", "0"))
+LLM_FAULT_RATE = float(os.getenv("LLM_FAULT_RATE", "0"))
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class SimulatedLLMFault(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Opens after consecutive upstream failures; after `reset_seconds` lets a single trial call through."""
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_seconds:
+            return "open"
+        return "half_open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._trial_in_flight = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+    def release_trial(self) -> None:
+        """Frees the half-open slot of a trial that ended without an outcome (cancelled, or its stream closed early)."""
+        self._trial_in_flight = False
+
+
+class LLMFaultSimulator:
+    """Injects latency and random failures in front of every LLM call (mock or real)."""
+
+    def __init__(self, latency_seconds: float = 0.0, failure_rate: float = 0.0):
+        self.latency_seconds = latency_seconds
+        self.failure_rate = failure_rate
+
+    @property
+    def enabled(self) -> bool:
+        return self.latency_seconds > 0 or self.failure_rate > 0
+
+    async def apply(self) -> None:
+        if self.latency_seconds:
+            await asyncio.sleep(self.latency_seconds)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise SimulatedLLMFault("Injected LLM fault")
+
+
+def is_retryable_llm_error(exc: BaseException) -> bool:
+    return isinstance(exc, (
+        asyncio.TimeoutError,
+        SimulatedLLMFault,
+        openai.APIConnectionError,
+        openai.RateLimitError,
+        openai.InternalServerError,
+    ))
+
+
+class LLMExecutor:
+    """Shared async gateway to the model API: per-model concurrency, deadlines, jittered retries and breakers."""
+
+    def __init__(self, client: Optional[AsyncOpenAI], max_concurrency: int, timeout: float, max_retries: int,
+                 retry_base: float, simulator: Optional[LLMFaultSimulator] = None,
+                 failure_threshold: int = LLM_BREAKER_FAILURE_THRESHOLD, reset_seconds: float = LLM_BREAKER_RESET_SECONDS):
         self.client = client
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_base = retry_base
+        self.simulator = simulator or LLMFaultSimulator()
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def _semaphore(self, model: str) -> asyncio.Semaphore:
+        if model not in self._semaphores:
+            self._semaphores[model] = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphores[model]
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        if model not in self._breakers:
+            self._breakers[model] = CircuitBreaker(self.failure_threshold, self.reset_seconds)
+        return self._breakers[model]
+
+    async def _invoke(self, call: Any) -> Any:
+        await self.simulator.apply()
+        result = call(self.client)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    async def _backoff(self, attempt: int) -> None:
+        await asyncio.sleep(self.retry_base * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    async def run(self, model: str, call: Any) -> Any:
+        """Runs `call(client)` under the model's limits; raises CircuitOpenError while the upstream is unhealthy."""
+        breaker = self.breaker(model)
+        trial = breaker.state == "half_open"
+        if not breaker.allow():
+            raise CircuitOpenError(f"Circuit open for {model}")
+        attempt = 0
+        try:
+            while True:
+                try:
+                    async with self._semaphore(model):
+                        result = await asyncio.wait_for(self._invoke(call), self.timeout)
+                    breaker.record_success()
+                    return result
+                except Exception as exc:
+                    if not is_retryable_llm_error(exc):
+                        breaker.record_success()
+                        raise
+                    if attempt >= self.max_retries:
+                        breaker.record_failure()
+                        raise
+                    logger.warning("LLM call to %s failed (attempt %s): %s", model, attempt + 1, exc)
+                await self._backoff(attempt)
+                attempt += 1
+        finally:
+            if trial:
+                breaker.release_trial()
+
+    async def stream(self, model: str, call: Any) -> AsyncGenerator[Any, None]:
+        """Like `run` for streaming calls; the deadline applies to the first event and each gap between events."""
+        breaker = self.breaker(model)
+        trial = breaker.state == "half_open"
+        if not breaker.allow():
+            raise CircuitOpenError(f"Circuit open for {model}")
+        try:
+            async with self._semaphore(model):
+                attempt = 0
+                while True:
+                    try:
+                        source = await asyncio.wait_for(self._invoke(call), self.timeout)
+                        iterator = source.__aiter__()
+                        first = await asyncio.wait_for(iterator.__anext__(), self.timeout)
+                        break
+                    except StopAsyncIteration:
+                        breaker.record_success()
+                        return
+                    except Exception as exc:
+                        if not is_retryable_llm_error(exc):
+                            breaker.record_success()
+                            raise
+                        if attempt >= self.max_retries:
+                            breaker.record_failure()
+                            raise
+                        logger.warning("LLM stream to %s failed (attempt %s): %s", model, attempt + 1, exc)
+                    await self._backoff(attempt)
+                    attempt += 1
+
+                yield first
+                while True:
+                    try:
+                        event = await asyncio.wait_for(iterator.__anext__(), self.timeout)
+                    except StopAsyncIteration:
+                        break
+                    except Exception as exc:
+                        if is_retryable_llm_error(exc):
+                            breaker.record_failure()
+                        raise
+                    yield event
+                breaker.record_success()
+        finally:
+            # Cancellation and early close (GeneratorExit at a yield) bypass the handlers above
+            if trial:
+                breaker.release_trial()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            model: {"state": breaker.state, "consecutive_failures": breaker.failures}
+            for model, breaker in self._breakers.items()
+        }
+
+
+llm_executor = LLMExecutor(
+    openai_client,
+    LLM_MAX_CONCURRENCY_PER_MODEL,
+    LLM_TIMEOUT_SECONDS,
+    LLM_MAX_RETRIES,
+    LLM_RETRY_BASE_SECONDS,
+    LLMFaultSimulator(LLM_FAULT_LATENCY_MS / 1000, LLM_FAULT_RATE),
+)
+
+
+class AgendaRecommendationAgent:
+    def __init__(self, executor: LLMExecutor, model: str, use_mock: bool):
+        self.executor = executor
         self.model = model
-        self.use_mock = use_mock or client is None
+        self.use_mock = use_mock or executor.client is None
 
-    def generate(self, user_id: str, target_date: date, tier: str, events: List[Dict[str, Any]]) -> DailyRecommendationResponse:
-        day_start = datetime.combine(target_date, dt_time.min, tzinfo=timezone.utc)
-        day_end = day_start + timedelta(days=1)
-        free_slots = compute_free_slots(events, day_start, day_end)
-        event_context = [
-            {
-                "title": event.get("title"),
-                "kind": event.get("kind"),
-                "start": (event.get("starts_at") or day_start).isoformat(),
-                "end": (event.get("ends_at") or day_start).isoformat(),
-                "notes": event.get("notes"),
-            }
-            for event in events
+    def _mock_response(self, tier: str, events: List[Dict[str, Any]], event_context: List[Dict[str, Any]]) -> DailyRecommendationResponse:
+        recommendations = [
+            "Programa una respiración cuadrada de 4 minutos en tu primer bloque libre.",
+            "Visualiza el entrenamiento clave del día y escribe un objetivo específico."
         ]
+        if any(e.get("kind") == "competencia" for e in events):
+            recommendations.append("Prepara un ritual de precompetencia 60 minutos antes del evento.")
+        rationale = "Basado en tu agenda y tier {}, priorizamos micro-recuperación y foco competitivo.".format(tier)
+        return DailyRecommendationResponse(
+            recommendations=recommendations,
+            rationale=rationale,
+            event_context=event_context,
+            escalate=False,
+            model_version="mock-2024.11"
+        )
 
-        if self.use_mock:
-            recommendations = [
-                "Programa una respiración cuadrada de 4 minutos en tu primer bloque libre.",
-                "Visualiza el entrenamiento clave del día y escribe un objetivo específico."
-            ]
-            if any(e.get("kind") == "competencia" for e in events):
-                recommendations.append("Prepara un ritual de precompetencia 60 minutos antes del evento.")
-            rationale = "Basado en tu agenda y tier {}, priorizamos micro-recuperación y foco competitivo.".format(tier)
-            return DailyRecommendationResponse(
-                recommendations=recommendations,
-                rationale=rationale,
-                event_context=event_context,
-                escalate=False,
-                model_version="mock-2024.11"
-            )
+    async def generate(self, user_id: str, target_date: date, tier: str, events: List[Dict[str, Any]],
+                       free_slots: Optional[List[Tuple[datetime, datetime]]] = None) -> DailyRecommendationResponse:
+        if free_slots is None:
+            day_start = datetime.combine(target_date, dt_time.min, tzinfo=timezone.utc)
+            free_slots = compute_free_slots(events, day_start, day_start + timedelta(days=1))
+        event_context = build_event_context(events, target_date)
 
         payload = {
             "date": target_date.isoformat(),
@@ -322,13 +2747,15 @@ class AgendaRecommendationAgent:
         )
 
         try:
-            response = self.client.responses.create(
+            if self.use_mock:
+                return await self.executor.run(self.model, lambda client: self._mock_response(tier, events, event_context))
+            response = await self.executor.run(self.model, lambda client: client.responses.create(
                 model=self.model,
                 input=[
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": json.dumps(payload, ensure_ascii=False)}
                 ],
-            )
+            ))
             content = extract_response_text(response)
             data = {}
             if content:
@@ -363,11 +2790,93 @@ class AgendaRecommendationAgent:
             return fallback
 
 
+REPLY_KEY_PATTERN = re.compile(r'"reply"\s*:\s*"')
+JSON_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class ReplyStreamParser:
+    """Incrementally extracts the "reply" string from a streamed JSON envelope.
+
+    Outputs that do not look like JSON are passed through verbatim.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.plain: Optional[bool] = None
+        self._cursor: Optional[int] = None
+        self._closed = False
+
+    def feed(self, chunk: str) -> str:
+        self.buffer += chunk
+        if self.plain is None:
+            stripped = self.buffer.lstrip()
+            if not stripped:
+                return ""
+            self.plain = not stripped.startswith(("{", "`"))
+            if self.plain:
+                return self.buffer
+        if self.plain:
+            return chunk
+        if self._closed:
+            return ""
+        if self._cursor is None:
+            match = REPLY_KEY_PATTERN.search(self.buffer)
+            if not match:
+                return ""
+            self._cursor = match.end()
+        return self._decode()
+
+    def _decode(self) -> str:
+        out: List[str] = []
+        buffer = self.buffer
+        index = self._cursor
+        while index < len(buffer):
+            char = buffer[index]
+            if char == '"':
+                self._closed = True
+                index += 1
+                break
+            if char != "\\":
+                out.append(char)
+                index += 1
+                continue
+            if index + 1 >= len(buffer):
+                break
+            escape = buffer[index + 1]
+            if escape != "u":
+                out.append(JSON_ESCAPES.get(escape, escape))
+                index += 2
+                continue
+            width = 6
+            if index + 6 <= len(buffer) and 0xD800 <= int(buffer[index + 2:index + 6], 16) <= 0xDBFF:
+                width = 12
+            if index + width > len(buffer):
+                break
+            out.append(json.loads('"' + buffer[index:index + width] + '"'))
+            index += width
+        self._cursor = index
+        return "".join(out)
+
+    def result(self) -> Dict[str, Any]:
+        text = self.buffer.strip()
+        if not self.plain:
+            text = re.sub(r"^```(?:json)?\s*|\s*```$", "", text)
+            try:
+                payload = json.loads(text)
+                if isinstance(payload, dict):
+                    return payload
+                logger.warning("Chat agent returned non-dict payload: %s", payload)
+                return {"reply": str(payload), "escalate": False, "habit_hint": None}
+            except json.JSONDecodeError:
+                logger.warning("Chat agent returned non-JSON content: %s", text)
+        return {"reply": text, "escalate": False, "habit_hint": None}
+
+
 class CoachChatAgent:
-    def __init__(self, client: Optional[OpenAI], model: str, use_mock: bool):
-        self.client = client
+    def __init__(self, executor: LLMExecutor, model: str, use_mock: bool):
+        self.executor = executor
         self.model = model
-        self.use_mock = use_mock or client is None
+        self.use_mock = use_mock or executor.client is None
 
     def _system_prompt(self, tone: Optional[str]) -> str:
         tone_descriptor = tone or "empathetic"
@@ -380,7 +2889,19 @@ class CoachChatAgent:
             "Si no puedes cumplir la solicitud, indica un mensaje empático y marca \\\"escalate\\\": false."
         ).format(tone_descriptor)
 
-    def generate_reply(self, messages: List[CoachChatMessage], tone: Optional[str], target_goal: Optional[str]) -> Dict[str, Any]:
+    async def _mock_stream(self, messages: List[CoachChatMessage]) -> AsyncGenerator[Any, None]:
+        reply = (
+            "Gracias por compartirlo. Prueba el protocolo de respiración triangular durante 3 minutos "
+            "antes de tu siguiente sesión y registra cómo te sientes."
+        )
+        escalate = any("ansiedad" in msg.content.lower() for msg in messages if msg.role == "user")
+        habit_hint = "Respiración triangular antes de entrenar" if escalate else None
+        envelope = json.dumps({"reply": reply, "escalate": escalate, "habit_hint": habit_hint}, ensure_ascii=False)
+        for chunk in chunk_text(envelope, size=24):
+            yield SimpleNamespace(type="response.output_text.delta", delta=chunk)
+
+    async def stream_reply(self, messages: List[CoachChatMessage], tone: Optional[str], target_goal: Optional[str]) -> AsyncGenerator[Dict[str, Any], None]:
+        """Yields {"delta": text} events as the model streams, then one {"final": payload} event."""
         conversation_payload = [
             {"role": message.role, "content": sanitize_text(message.content)}
             for message in messages
@@ -388,71 +2909,73 @@ class CoachChatAgent:
         if target_goal:
             conversation_payload.append({"role": "user", "content": f"Objetivo declarado: {target_goal}"})
 
-        if self.use_mock:
-            reply = (
-                "Gracias por compartirlo. Prueba el protocolo de respiración triangular durante 3 minutos "
-                "antes de tu siguiente sesión y registra cómo te sientes."
-            )
-            escalate = any("ansiedad" in msg.content.lower() for msg in messages if msg.role == "user")
-            habit_hint = "Respiración triangular antes de entrenar" if escalate else None
-            return {"reply": reply, "escalate": escalate, "habit_hint": habit_hint, "model": "mock-2024.11"}
-
+        parser = ReplyStreamParser()
+        streamed: List[str] = []
         try:
-            response = self.client.responses.create(
-                model=self.model,
-                input=[
-                    {"role": "system", "content": self._system_prompt(tone)},
-                    *conversation_payload
-                ],
-                max_output_tokens=600
-            )
-            content = extract_response_text(response)
-            payload: Dict[str, Any] = {}
-            if content:
-                try:
-                    payload = json.loads(content)
-                except json.JSONDecodeError:
-                    logger.warning("Chat agent returned non-JSON content: %s", content)
-                    payload = {"reply": content, "escalate": False, "habit_hint": None}
-            if not isinstance(payload, dict):
-                logger.warning("Chat agent returned non-dict payload: %s", payload)
-                payload = {"reply": str(payload), "escalate": False, "habit_hint": None}
-            payload["model"] = self.model
-            return payload
+            if self.use_mock:
+                source = self.executor.stream(self.model, lambda client: self._mock_stream(messages))
+            else:
+                source = self.executor.stream(self.model, lambda client: client.responses.create(
+                    model=self.model,
+                    input=[
+                        {"role": "system", "content": self._system_prompt(tone)},
+                        *conversation_payload
+                    ],
+                    max_output_tokens=600,
+                    stream=True
+                ))
+            async for event in source:
+                if getattr(event, "type", None) != "response.output_text.delta":
+                    continue
+                delta = parser.feed(event.delta)
+                if delta:
+                    streamed.append(delta)
+                    yield {"delta": delta}
+            payload = parser.result()
+            if not streamed and payload.get("reply"):
+                yield {"delta": payload["reply"]}
+            payload["model"] = "mock-2024.11" if self.use_mock else self.model
+            yield {"final": payload}
         except Exception as exc:
-            logger.error("Chat agent failure: %s", exc, exc_info=True)
-            return {
-                "reply": "Estoy teniendo dificultades técnicas. Respira profundo y volvamos a intentarlo en unos minutos.",
-                "escalate": False,
-                "habit_hint": None,
-                "model": "fallback-heuristic"
-            }
+            logger.error("Chat agent failure: %s", exc, exc_info=not isinstance(exc, CircuitOpenError))
+            if streamed:
+                yield {"final": {"reply": "".join(streamed), "escalate": False, "habit_hint": None, "model": self.model}}
+                return
+            fallback = "Estoy teniendo dificultades técnicas. Respira profundo y volvamos a intentarlo en unos minutos."
+            yield {"delta": fallback}
+            yield {"final": {"reply": fallback, "escalate": False, "habit_hint": None, "model": "fallback-heuristic"}}
+
+    async def generate_reply(self, messages: List[CoachChatMessage], tone: Optional[str], target_goal: Optional[str]) -> Dict[str, Any]:
+        result: Dict[str, Any] = {}
+        async for event in self.stream_reply(messages, tone, target_goal):
+            result = event.get("final", result)
+        return result
 
 
 class HabitPlanAgent:
-    def __init__(self, client: Optional[OpenAI], model: str, use_mock: bool):
-        self.client = client
+    def __init__(self, executor: LLMExecutor, model: str, use_mock: bool):
+        self.executor = executor
         self.model = model
-        self.use_mock = use_mock or client is None
+        self.use_mock = use_mock or executor.client is None
 
-    def generate(self, timeframe: str, context: Dict[str, Any], tier: str) -> HabitPlanResponse:
+    def _mock_plan(self) -> HabitPlanResponse:
+        habits = [
+            HabitPlanItem(title="Respiración 4-7-8", recommended_start_date=date.today(), frequency="daily", rationale="Bajar activación pre-entrenamiento"),
+            HabitPlanItem(title="Diario de gratitud", recommended_start_date=date.today(), frequency="daily", rationale="Reforzar enfoque positivo"),
+            HabitPlanItem(title="Visualización guiada", recommended_start_date=date.today() + timedelta(days=2), frequency="3x week", rationale="Preparar competencias próximas")
+        ]
+        return HabitPlanResponse(
+            habits=habits,
+            summary="Plan breve generado localmente por falta de modelo."
+        )
+
+    async def generate(self, timeframe: str, context: Dict[str, Any], tier: str) -> HabitPlanResponse:
         payload = {
             "timeframe": timeframe,
             "context": context,
             "tier": tier
         }
 
-        if self.use_mock:
-            habits = [
-                HabitPlanItem(title="Respiración 4-7-8", recommended_start_date=date.today(), frequency="daily", rationale="Bajar activación pre-entrenamiento"),
-                HabitPlanItem(title="Diario de gratitud", recommended_start_date=date.today(), frequency="daily", rationale="Reforzar enfoque positivo"),
-                HabitPlanItem(title="Visualización guiada", recommended_start_date=date.today() + timedelta(days=2), frequency="3x week", rationale="Preparar competencias próximas")
-            ]
-            return HabitPlanResponse(
-                habits=habits,
-                summary="Plan breve generado localmente por falta de modelo."
-            )
-
         system_prompt = (
             "Eres el agente planificador de hábitos de MindAthlete. Crea planes accionables, "
             "máximo 5 hábitos, con título, fecha recomendada, frecuencia y racional. "
@@ -461,14 +2984,16 @@ class HabitPlanAgent:
         )
 
         try:
-            response = self.client.responses.create(
+            if self.use_mock:
+                return await self.executor.run(self.model, lambda client: self._mock_plan())
+            response = await self.executor.run(self.model, lambda client: client.responses.create(
                 model=self.model,
                 input=[
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": json.dumps(payload, ensure_ascii=False)}
                 ],
                 max_output_tokens=700
-            )
+            ))
             content = extract_response_text(response)
             data: Dict[str, Any] = {}
             if content:
@@ -548,16 +3073,16 @@ class EscalationAgent:
         )
 
 
-agenda_agent = AgendaRecommendationAgent(openai_client, RECOMMENDATION_MODEL, USE_MOCK_AI)
-chat_agent = CoachChatAgent(openai_client, CHAT_MODEL, USE_MOCK_AI)
-habit_plan_agent = HabitPlanAgent(openai_client, HABIT_PLAN_MODEL, USE_MOCK_AI)
+agenda_agent = AgendaRecommendationAgent(llm_executor, RECOMMENDATION_MODEL, USE_MOCK_AI)
+chat_agent = CoachChatAgent(llm_executor, CHAT_MODEL, USE_MOCK_AI)
+habit_plan_agent = HabitPlanAgent(llm_executor, HABIT_PLAN_MODEL, USE_MOCK_AI)
 escalation_agent = EscalationAgent()
 
 
-def get_or_create_chat(user_id: str, chat_id: Optional[UUID], title: Optional[str] = None) -> UUID:
+async def get_or_create_chat(db: DataSession, user_id: str, chat_id: Optional[UUID], title: Optional[str] = None) -> UUID:
     if chat_id:
         try:
-            response = supabase.table("chats") \
+            response = await db.table("chats") \
                 .select("id") \
                 .eq("id", str(chat_id)) \
                 .eq("user_id", user_id) \
@@ -575,7 +3100,7 @@ def get_or_create_chat(user_id: str, chat_id: Optional[UUID], title: Optional[st
         "is_active": True
     }
     try:
-        result = supabase.table("chats").insert(insert_payload).execute()
+        result = await db.table("chats").insert(insert_payload).execute()
         if result.data:
             return UUID(result.data[0]["id"])
     except Exception as exc:
@@ -583,35 +3108,107 @@ def get_or_create_chat(user_id: str, chat_id: Optional[UUID], title: Optional[st
     raise HTTPException(status_code=500, detail="No se pudo iniciar una conversación.")
 
 
-def record_chat_message(chat_id: UUID, user_id: str, role: str, content: str, metadata: Optional[Dict[str, Any]] = None) -> None:
-    encrypted_content = encryption_helper.encrypt(sanitize_text(content))
-    payload = {
-        "chat_id": str(chat_id),
+def build_chat_preview(content: str) -> Optional[str]:
+    return encryption_helper.encrypt(sanitize_text(content)[:CHAT_PREVIEW_CHARS])
+
+
+def build_chat_message(user_id: str, role: str, content: str, metadata: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    return {
         "user_id": user_id,
         "role": role,
-        "content": encrypted_content,
+        "content": encryption_helper.encrypt(sanitize_text(content)),
         "metadata": metadata,
         "created_at": utc_now().isoformat()
     }
+
+
+async def append_chat_messages_fallback(db: DataSession, chat_id: UUID, messages: List[Dict[str, Any]],
+                                        preview: Optional[str] = None) -> None:
+    await db.table("chat_messages").insert([{**message, "chat_id": str(chat_id)} for message in messages]).execute()
+    current = await db.table("chats").select("message_count").eq("id", str(chat_id)).limit(1).execute()
+    message_count = (current.data[0].get("message_count") or 0) if current.data else 0
+    update = {
+        "last_message_at": utc_now().isoformat(),
+        "message_count": message_count + len(messages),
+        "last_message_role": messages[-1]["role"],
+        "updated_at": utc_now().isoformat()
+    }
+    if preview is not None:
+        update["last_message_preview"] = preview
+    await db.table("chats") \
+        .update(update) \
+        .eq("id", str(chat_id)) \
+        .execute()
+
+
+async def record_chat_messages(db: DataSession, chat_id: UUID, messages: List[Dict[str, Any]],
+                               preview: Optional[str] = None) -> None:
+    """Persists a turn's messages and updates the chat's count, last_message_at and preview in one round trip.
+
+    `preview` is the output of build_chat_preview for the turn's last message.
+    """
+    if not messages:
+        return
+    user_id = messages[0]["user_id"]
     try:
-        supabase.table("chat_messages").insert(payload).execute()
-        count_response = supabase.table("chat_messages") \
-            .select("id") \
-            .eq("chat_id", str(chat_id)) \
-            .execute()
-        supabase.table("chats") \
-            .update({
-                "last_message_at": utc_now().isoformat(),
-                "message_count": len(count_response.data or []),
-                "updated_at": utc_now().isoformat()
-            }) \
-            .eq("id", str(chat_id)) \
-            .execute()
+        try:
+            await db.rpc("append_chat_messages", {"p_chat_id": str(chat_id), "p_messages": messages, "p_preview": preview}).execute()
+        except DataAccessError as exc:
+            if exc.status_code != 404:
+                raise
+            logger.warning("append_chat_messages RPC unavailable; falling back to batched insert.")
+            await append_chat_messages_fallback(db, chat_id, messages, preview)
     except Exception as exc:
-        logger.error("Failed to persist chat message for %s: %s", user_id, exc)
+        logger.error("Failed to persist chat messages for %s: %s", user_id, exc)
+
+
+async def backfill_chat_previews(db: DataSession, batch_size: int = 200) -> int:
+    """Fills last_message_preview for chats created before previews existed; returns how many were set.
+
+    SQL cannot truncate encrypted content, so the migration leaves these NULL and this decrypts each
+    chat's latest message once and stores only the truncated, re-encrypted preview.
+    """
+    filled = 0
+    after: Optional[str] = None
+    while True:
+        query = db.table("chats").select("id").is_("last_message_preview", None).gt("message_count", 0)
+        if after is not None:
+            query = query.gt("id", after)
+        chats = await query.order("id").limit(batch_size).execute()
+        for chat in chats.data:
+            latest = await db.table("chat_messages") \
+                .select("content") \
+                .eq("chat_id", str(chat["id"])) \
+                .order("created_at", desc=True) \
+                .limit(1) \
+                .execute()
+            if not latest.data:
+                continue
+            content = (await decrypt_contents([latest.data[0].get("content")]))[0]
+            if content:
+                await db.table("chats").update({"last_message_preview": build_chat_preview(content)}).eq("id", str(chat["id"])).execute()
+                filled += 1
+        if len(chats.data) < batch_size:
+            return filled
+        after = str(chats.data[-1]["id"])
 
 
-def record_habit_plan(user_id: str, plan: HabitPlanResponse, timeframe: str) -> None:
+# Chat turns persisted after their response; held here so the tasks are not garbage collected mid-write
+chat_turn_writes: Set[asyncio.Task] = set()
+
+
+def persist_in_background(write: Coroutine[Any, Any, None]) -> None:
+    """Runs `write` on its own task, so it completes even if the request that started it is cancelled."""
+    task = asyncio.create_task(write)
+    chat_turn_writes.add(task)
+    task.add_done_callback(chat_turn_writes.discard)
+
+
+async def record_chat_message(db: DataSession, chat_id: UUID, user_id: str, role: str, content: str, metadata: Optional[Dict[str, Any]] = None) -> None:
+    await record_chat_messages(db, chat_id, [build_chat_message(user_id, role, content, metadata)], build_chat_preview(content))
+
+
+async def record_habit_plan(db: DataSession, user_id: str, plan: HabitPlanResponse, timeframe: str) -> None:
     plan_payload = {
         "habits": [
             {
@@ -635,12 +3232,12 @@ def record_habit_plan(user_id: str, plan: HabitPlanResponse, timeframe: str) ->
         "updated_at": utc_now().isoformat()
     }
     try:
-        supabase.table("habit_plans").insert(payload).execute()
+        await db.table("habit_plans").insert(payload).execute()
     except Exception as exc:
         logger.error("Failed to store habit plan for %s: %s", user_id, exc)
 
 
-def record_escalation(user_id: str, request: EscalationRequest, decision: EscalationResponse) -> None:
+async def record_escalation(db: DataSession, user_id: str, request: EscalationRequest, decision: EscalationResponse) -> None:
     payload = {
         "user_id": user_id,
         "reason": request.reason or request.context.get("reason", "auto_flag"),
@@ -652,22 +3249,85 @@ def record_escalation(user_id: str, request: EscalationRequest, decision: Escala
         "source": request.context.get("source")
     }
     try:
-        supabase.table("escalations").insert(payload).execute()
+        await db.table("escalations").insert(payload).execute()
+    except Exception as exc:
+        logger.error("Failed to persist escalation for %s: %s", user_id, exc)
+
+
+def recommendation_cache_key(user_id: str, target_date: date, tier: str, include_competitions: bool,
+                             include_training: bool, event_context: List[Dict[str, Any]],
+                             free_slots: Optional[List[Tuple[datetime, datetime]]] = None) -> str:
+    fingerprint = hashlib.sha256(
+        json.dumps([event_context, free_slots], sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+    ).hexdigest()
+    return "|".join([
+        user_id,
+        target_date.isoformat(),
+        tier,
+        "c1" if include_competitions else "c0",
+        "t1" if include_training else "t0",
+        fingerprint,
+    ])
+
+
+def recommendation_context(target_date: date, cache_key: Optional[str]) -> str:
+    context: Dict[str, Any] = {"date": target_date.isoformat()}
+    if cache_key:
+        context["cache_key"] = cache_key
+    return json.dumps(context, ensure_ascii=False, sort_keys=True)
+
+
+async def load_cached_recommendation(db: DataSession, user_id: str, target_date: date, cache_key: str) -> Optional[DailyRecommendationResponse]:
+    cached = recommendation_cache.get(cache_key)
+    if cached:
+        return cached
+    try:
+        response = await db.table("recommendations") \
+            .select("reason") \
+            .eq("user_id", user_id) \
+            .eq("context", recommendation_context(target_date, cache_key)) \
+            .order("created_at", desc=True) \
+            .limit(1) \
+            .execute()
     except Exception as exc:
-        logger.error("Failed to persist escalation for %s: %s", user_id, exc)
+        logger.warning("Recommendation cache lookup failed for %s: %s", user_id, exc)
+        return None
+    reason = (response.data[0].get("reason") if response.data else None) or {}
+    if not reason.get("recommendations"):
+        return None
+    recommendation = DailyRecommendationResponse(
+        recommendations=reason["recommendations"],
+        rationale=reason.get("rationale"),
+        event_context=reason.get("event_context") or [],
+        escalate=bool(reason.get("escalate")),
+        model_version=reason.get("model_version") or "manual"
+    )
+    recommendation_cache.put(cache_key, recommendation)
+    return recommendation
 
 
-def record_daily_recommendation(user_id: str, target_date: date, recommendation: DailyRecommendationResponse) -> None:
+async def record_daily_recommendation(db: DataSession, user_id: str, target_date: date, recommendation: DailyRecommendationResponse,
+                                      cache_key: Optional[str] = None) -> None:
+    if recommendation.model_version == "fallback-heuristic":
+        cache_key = None
+    if cache_key:
+        recommendation_cache.put(cache_key, recommendation)
     try:
         first_message = recommendation.recommendations[0] if recommendation.recommendations else None
         payload = {
             "user_id": user_id,
-            "context": json.dumps({"date": target_date.isoformat()}, ensure_ascii=False),
-            "reason": {"rationale": recommendation.rationale, "event_context": recommendation.event_context},
+            "context": recommendation_context(target_date, cache_key),
+            "reason": {
+                "rationale": recommendation.rationale,
+                "event_context": recommendation.event_context,
+                "recommendations": recommendation.recommendations,
+                "escalate": recommendation.escalate,
+                "model_version": recommendation.model_version
+            },
             "message": first_message,
             "created_at": utc_now().isoformat()
         }
-        supabase.table("recommendations").insert(payload).execute()
+        await db.table("recommendations").insert(payload).execute()
     except Exception as exc:
         logger.warning("Failed to store recommendation for %s: %s", user_id, exc)
 
@@ -692,6 +3352,7 @@ class UserProfile(BaseModel):
     stress_factors: Optional[List[str]] = None
     training_frequency: Optional[int] = None
     questionnaire_data: Optional[Dict[str, Any]] = None
+    timezone: Optional[str] = None  # IANA name, e.g. "America/Santiago"
 
 class QuestionnaireData(BaseModel):
     sport: str
@@ -727,6 +3388,9 @@ class DiaryEntry(BaseModel):
     notes: Optional[str] = None
     highlights: Optional[List[str]] = None
 
+class DiaryEntryBatch(BaseModel):
+    entries: List[DiaryEntry]
+
 class Habit(BaseModel):
     title: str
     description: Optional[str] = None
@@ -739,12 +3403,34 @@ class HabitTracking(BaseModel):
     date: str  # YYYY-MM-DD
     notes: Optional[str] = None
 
+class HabitTrackingBatchItem(HabitTracking):
+    habit_id: str
+
+class HabitTrackingBatch(BaseModel):
+    entries: List[HabitTrackingBatchItem]
+
 class SessionCompletion(BaseModel):
     session_type: str  # "focus", "calm", "recovery", "pre-competition"
     duration: int  # minutes
     rating: Optional[int] = None  # 1-5
     notes: Optional[str] = None
 
+class SyncedSessionCompletion(SessionCompletion):
+    id: UUID  # generated on the device so replays are idempotent
+    completed_at: datetime = Field(default_factory=utc_now)
+
+class SyncedScheduleBlock(ScheduleBlock):
+    id: UUID
+
+class SyncMutation(BaseModel):
+    table: Literal["diary_entries", "habit_tracking", "session_completions", "schedules"]
+    op: Literal["upsert", "delete"] = "upsert"
+    data: Dict[str, Any]
+
+class SyncRequest(BaseModel):
+    cursor: Optional[str] = None
+    mutations: List[SyncMutation] = []
+
 class AIRecommendationRequest(BaseModel):
     context: Optional[str] = None
     force_refresh: Optional[bool] = False
@@ -752,6 +3438,11 @@ class AIRecommendationRequest(BaseModel):
 class AnalyticsEvent(BaseModel):
     event_type: str
     event_data: Optional[Dict[str, Any]] = None
+    timestamp: Optional[datetime] = None  # client time for events batched on device
+
+
+class AnalyticsEventBatch(BaseModel):
+    events: List[AnalyticsEvent]
 
 
 class RecommendationEventContext(BaseModel):
@@ -820,29 +3511,253 @@ class EscalationResponse(BaseModel):
     booking_url: Optional[str] = None
     message: Optional[str] = None
 
+
+class EntitlementInvalidationRequest(BaseModel):
+    user_id: str
+
+
+class AuthenticatedUser(BaseModel):
+    id: str
+    email: Optional[str] = None
+    phone: Optional[str] = None
+    role: Optional[str] = None
+    aud: Optional[str] = None
+    app_metadata: Dict[str, Any] = Field(default_factory=dict)
+    user_metadata: Dict[str, Any] = Field(default_factory=dict)
+
+    @classmethod
+    def from_claims(cls, claims: Dict[str, Any]) -> "AuthenticatedUser":
+        audience = claims.get("aud")
+        return cls(
+            id=claims["sub"],
+            email=claims.get("email"),
+            phone=claims.get("phone") or None,
+            role=claims.get("role"),
+            aud=audience[0] if isinstance(audience, list) and audience else audience,
+            app_metadata=claims.get("app_metadata") or {},
+            user_metadata=claims.get("user_metadata") or {},
+        )
+
+    @classmethod
+    def from_remote(cls, user: Any) -> "AuthenticatedUser":
+        return cls(
+            id=str(user.id),
+            email=getattr(user, "email", None),
+            phone=getattr(user, "phone", None) or None,
+            role=getattr(user, "role", None),
+            aud=getattr(user, "aud", None),
+            app_metadata=getattr(user, "app_metadata", None) or {},
+            user_metadata=getattr(user, "user_metadata", None) or {},
+        )
+
 # ============ AUTH HELPERS ============
 
-async def get_current_user(authorization: Optional[str] = Header(None)):
+SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
+SUPABASE_JWKS_URL = os.getenv("SUPABASE_JWKS_URL") or (
+    (os.getenv("SUPABASE_URL") or "").rstrip("/") + "/auth/v1/.well-known/jwks.json"
+)
+SUPABASE_JWT_AUDIENCE = os.getenv("SUPABASE_JWT_AUDIENCE", "authenticated")
+AUTH_REMOTE_FALLBACK = os.getenv("AUTH_REMOTE_FALLBACK", "1") == "1"
+AUTH_TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "10000"))
+AUTH_JWKS_REFRESH_SECONDS = int(os.getenv("AUTH_JWKS_REFRESH_SECONDS", "300"))
+
+
+# Algorithm assumed for JWKS keys that do not declare their own "alg"
+JWKS_DEFAULT_ALGORITHMS = {"RSA": "RS256", "EC": "ES256"}
+
+
+class TokenVerifier:
+    """Verifies Supabase access tokens locally with the project secret (HS*) or its JWKS (RS*/ES*)."""
+
+    def __init__(self, secret: Optional[str], jwks_url: Optional[str], audience: str):
+        self.secret = secret
+        self.jwks_url = jwks_url
+        self.audience = audience
+        self._jwks: Dict[str, Dict[str, Any]] = {}
+        self._jwks_fetched_at = 0.0
+        self._jwks_lock = asyncio.Lock()
+
+    async def _refresh_jwks(self) -> None:
+        async with self._jwks_lock:
+            if time.time() - self._jwks_fetched_at < AUTH_JWKS_REFRESH_SECONDS:
+                return
+            self._jwks_fetched_at = time.time()
+            try:
+                async with httpx.AsyncClient(timeout=5) as client:
+                    response = await client.get(self.jwks_url)
+                    response.raise_for_status()
+                self._jwks = {key.get("kid"): key for key in response.json().get("keys", [])}
+            except Exception as exc:
+                logger.warning("Failed to refresh JWKS from %s: %s", self.jwks_url, exc)
+
+    async def _signing_key(self, header: Dict[str, Any]) -> Tuple[Optional[Any], Optional[str]]:
+        """The key for this token and the one algorithm it may be signed with; never taken from the header alone."""
+        if header.get("alg", "").startswith("HS"):
+            return self.secret, "HS256" if self.secret else None
+        if not self.jwks_url:
+            return None, None
+        kid = header.get("kid")
+        if kid not in self._jwks:
+            await self._refresh_jwks()
+        key = self._jwks.get(kid)
+        if key is None:
+            return None, None
+        return key, key.get("alg") or JWKS_DEFAULT_ALGORITHMS.get(key.get("kty"))
+
+    async def verify(self, token: str) -> Optional[Dict[str, Any]]:
+        """Returns verified claims, or None when no local key material can check this token."""
+        header = jwt.get_unverified_header(token)
+        key, algorithm = await self._signing_key(header)
+        if key is None:
+            return None
+        if algorithm is None or header.get("alg") != algorithm:
+            raise JWTError(f"Token algorithm {header.get('alg')!r} is not accepted for this key")
+        return jwt.decode(token, key, algorithms=[algorithm], audience=self.audience)
+
+
+token_cache = TTLCache(AUTH_TOKEN_CACHE_SIZE)
+token_verifier = TokenVerifier(SUPABASE_JWT_SECRET, SUPABASE_JWKS_URL, SUPABASE_JWT_AUDIENCE)
+
+
+def token_cache_key(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+async def authenticate_token(token: str) -> AuthenticatedUser:
+    cache_key = token_cache_key(token)
+    cached = token_cache.get(cache_key)
+    if cached:
+        return cached
+
+    claims = await token_verifier.verify(token)
+    if claims is not None:
+        user = AuthenticatedUser.from_claims(claims)
+        token_cache.put(cache_key, user, float(claims.get("exp") or 0))
+        return user
+
+    if not AUTH_REMOTE_FALLBACK:
+        raise HTTPException(status_code=401, detail="Token cannot be verified locally")
+    response = await asyncio.to_thread(supabase.auth.get_user, token)
+    if not response or not response.user:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    user = AuthenticatedUser.from_remote(response.user)
+    token_cache.put(cache_key, user, float(jwt.get_unverified_claims(token).get("exp") or 0))
+    return user
+
+
+async def get_bearer_token(authorization: Optional[str] = Header(None)) -> str:
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Missing or invalid authorization header")
-    
-    token = authorization.replace("Bearer ", "")
-    
+    return authorization.replace("Bearer ", "")
+
+
+async def get_current_user(token: str = Depends(get_bearer_token)) -> AuthenticatedUser:
     try:
-        user = supabase.auth.get_user(token)
-        if not user:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        supabase.postgrest.auth(token)
-        return user.user
+        return await authenticate_token(token)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=401, detail=f"Authentication failed: {str(e)}")
 
+
+async def require_internal_key(x_internal_key: Optional[str] = Header(None)) -> None:
+    if not INTERNAL_API_KEY:
+        raise HTTPException(status_code=503, detail="Internal API is not configured")
+    if not x_internal_key or not hmac.compare_digest(x_internal_key, INTERNAL_API_KEY):
+        raise HTTPException(status_code=403, detail="Invalid internal key")
+
+
+async def get_data_session(token: str = Depends(get_bearer_token), user = Depends(get_current_user)) -> DataSession:
+    """Request-scoped session carrying the caller's JWT; shares the backend's connection pool."""
+    return DataSession(data_backend, token)
+
+# ============ PAGINATION ============
+
+def encode_opaque_cursor(payload: Any) -> str:
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_opaque_cursor(cursor: str) -> Any:
+    """Inverse of encode_opaque_cursor; raises ValueError for anything it did not produce."""
+    return json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+
+
+async def fetch_keyset_page(query: TableQuery, column: str, limit: int, cursor: Optional[str],
+                            desc: bool = True) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """One page ordered by (column, id), resuming after `cursor`; returns the rows and the next cursor.
+
+    The query must select both `column` and `id`. Each page is an index range scan past the last row
+    seen, so its cost does not grow with depth the way OFFSET does.
+    """
+    if cursor:
+        try:
+            value, row_id = decode_opaque_cursor(cursor)
+        except (ValueError, TypeError) as exc:
+            raise HTTPException(status_code=400, detail="Invalid cursor") from exc
+        query = query.keyset_after(column, value, "id", row_id, desc=desc)
+    limit = min(max(limit, 1), PAGE_MAX_LIMIT)
+    # One extra row tells whether another page exists without a count query
+    page = await query.order(column, desc=desc).order("id", desc=desc).limit(limit + 1).execute()
+    rows = page.data[:limit]
+    if len(page.data) <= limit:
+        return rows, None
+    return rows, encode_opaque_cursor([rows[-1][column], rows[-1]["id"]])
+
+# ============ CONDITIONAL RESPONSES ============
+
+# Last ETag served per (user_id, resource). A matching If-None-Match is answered from here without
+# querying; writes on this worker drop the entry and the TTL bounds staleness from other workers.
+etag_cache = TTLCache(ETAG_CACHE_SIZE, ETAG_CACHE_TTL_SECONDS)
+# Invalidation times, so an ETag computed while a write was landing is not remembered
+etag_invalidations = TTLCache(ETAG_CACHE_SIZE, ETAG_CACHE_TTL_SECONDS)
+
+
+def payload_etag(payload: Any) -> str:
+    encoded = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str).encode()
+    return '"' + hashlib.sha256(encoded).hexdigest()[:32] + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    # Weak comparison, as RFC 9110 specifies for If-None-Match
+    candidates = {candidate.strip()[2:] if candidate.strip().startswith("W/") else candidate.strip() for candidate in if_none_match.split(",")}
+    return "*" in candidates or etag in candidates
+
+
+def invalidate_etags(user_id: str, *resources: str) -> None:
+    for resource in resources:
+        etag_cache.invalidate((user_id, resource))
+        etag_invalidations.put((user_id, resource), time.time())
+
+
+async def conditional_json(if_none_match: Optional[str], user_id: str, resource: str, build: Any,
+                           variant: str = "") -> Response:
+    """Serves `build()` with an ETag, or 304 when the client already holds it.
+
+    `variant` captures inputs that change the payload without a write, such as the date.
+    """
+    headers = {"Cache-Control": "private, no-cache"}
+    cached = etag_cache.get((user_id, resource))
+    if cached is not None and cached[0] == variant and etag_matches(if_none_match, cached[1]):
+        return Response(status_code=304, headers={**headers, "ETag": cached[1]})
+    started_at = time.time()
+    payload = jsonable_encoder(await build())
+    etag = payload_etag(payload)
+    invalidated_at = etag_invalidations.get((user_id, resource))
+    if invalidated_at is None or invalidated_at < started_at:
+        etag_cache.put((user_id, resource), (variant, etag))
+    headers["ETag"] = etag
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(payload, headers=headers)
+
 # ============ AUTH ENDPOINTS ============
 
 @app.post("/api/auth/signup")
 async def signup(data: SignupRequest):
     try:
-        response = supabase.auth.sign_up({
+        response = await asyncio.to_thread(supabase.auth.sign_up, {
             "email": data.email,
             "password": data.password
         })
@@ -858,7 +3773,8 @@ async def signup(data: SignupRequest):
                 "created_at": datetime.now().isoformat()
             }
             
-            supabase.table("user_profiles").insert(profile_data).execute()
+            db = DataSession(data_backend, response.session.access_token if response.session else None)
+            await db.table("user_profiles").insert(profile_data).execute()
             
             return {
                 "user": response.user,
@@ -874,7 +3790,7 @@ async def signup(data: SignupRequest):
 @app.post("/api/auth/login")
 async def login(data: LoginRequest):
     try:
-        response = supabase.auth.sign_in_with_password({
+        response = await asyncio.to_thread(supabase.auth.sign_in_with_password, {
             "email": data.email,
             "password": data.password
         })
@@ -888,33 +3804,41 @@ async def login(data: LoginRequest):
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
 @app.get("/api/auth/me")
-async def get_me(user = Depends(get_current_user)):
-    try:
-        profile = supabase.table("user_profiles").select("*").eq("user_id", user.id).execute()
+async def get_me(if_none_match: Optional[str] = Header(None), user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
+    async def build() -> Dict[str, Any]:
+        profile = await db.table("user_profiles").select("*").eq("user_id", user.id).execute()
         
         return {
             "user": user,
             "profile": profile.data[0] if profile.data else None
         }
+    
+    try:
+        # Claims come from the token, so a refreshed token with new metadata is a new variant
+        return await conditional_json(if_none_match, user.id, "me", build, variant=payload_etag(jsonable_encoder(user)))
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 # ============ PROFILE ENDPOINTS ============
 
 @app.put("/api/profile")
-async def update_profile(profile_data: UserProfile, user = Depends(get_current_user)):
+async def update_profile(profile_data: UserProfile, user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
     try:
         update_data = profile_data.model_dump(exclude_unset=True)
+        parse_timezone(update_data.get("timezone"))
         update_data["updated_at"] = datetime.now().isoformat()
         
-        result = supabase.table("user_profiles").update(update_data).eq("user_id", user.id).execute()
+        result = await db.table("user_profiles").update(update_data).eq("user_id", user.id).execute()
+        invalidate_etags(user.id, "me")
+        user_timezone_cache.invalidate(user.id)
         
+        invalidate_user_context(user.id)
         return {"message": "Profile updated", "profile": result.data[0] if result.data else None}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/api/profile/questionnaire")
-async def save_questionnaire(questionnaire: QuestionnaireData, user = Depends(get_current_user)):
+async def save_questionnaire(questionnaire: QuestionnaireData, user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
     try:
         update_data = {
             "sport": questionnaire.sport,
@@ -927,8 +3851,10 @@ async def save_questionnaire(questionnaire: QuestionnaireData, user = Depends(ge
             "updated_at": datetime.now().isoformat()
         }
         
-        result = supabase.table("user_profiles").update(update_data).eq("user_id", user.id).execute()
+        result = await db.table("user_profiles").update(update_data).eq("user_id", user.id).execute()
+        invalidate_etags(user.id, "me")
         
+        invalidate_user_context(user.id)
         return {"message": "Questionnaire saved", "profile": result.data[0] if result.data else None}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -936,65 +3862,64 @@ async def save_questionnaire(questionnaire: QuestionnaireData, user = Depends(ge
 # ============ SCHEDULE ENDPOINTS ============
 
 @app.get("/api/schedules")
-async def get_schedules(user = Depends(get_current_user)):
-    try:
-        result = supabase.table("schedules").select("*").eq("user_id", user.id).execute()
+async def get_schedules(if_none_match: Optional[str] = Header(None), user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
+    async def build() -> Dict[str, Any]:
+        result = await db.table("schedules").select("*").eq("user_id", user.id).execute()
         return {"schedules": result.data}
+    
+    try:
+        return await conditional_json(if_none_match, user.id, "schedules", build)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/api/schedules")
-async def create_schedule(schedule: ScheduleBlock, user = Depends(get_current_user)):
+async def create_schedule(schedule: ScheduleBlock, user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
     try:
         schedule_data = schedule.model_dump()
         schedule_data["user_id"] = user.id
         schedule_data["created_at"] = datetime.now().isoformat()
         
-        result = supabase.table("schedules").insert(schedule_data).execute()
+        result = await db.table("schedules").insert(schedule_data).execute()
         
+        schedule_loads.record(user.id, result.data[0] if result.data else None)
+        invalidate_user_context(user.id)
+        invalidate_etags(user.id, "schedules")
         return {"message": "Schedule created", "schedule": result.data[0] if result.data else None}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.put("/api/schedules/{schedule_id}")
-async def update_schedule(schedule_id: str, schedule: ScheduleUpdate, user = Depends(get_current_user)):
+async def update_schedule(schedule_id: str, schedule: ScheduleUpdate, user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
     try:
         update_data = schedule.model_dump(exclude_unset=True)
         update_data["updated_at"] = datetime.now().isoformat()
         
-        result = supabase.table("schedules").update(update_data).eq("id", schedule_id).eq("user_id", user.id).execute()
+        result = await db.table("schedules").update(update_data).eq("id", schedule_id).eq("user_id", user.id).execute()
         
+        schedule_loads.record(user.id, result.data[0] if result.data else None)
+        invalidate_user_context(user.id)
+        invalidate_etags(user.id, "schedules")
         return {"message": "Schedule updated", "schedule": result.data[0] if result.data else None}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.delete("/api/schedules/{schedule_id}")
-async def delete_schedule(schedule_id: str, user = Depends(get_current_user)):
+async def delete_schedule(schedule_id: str, user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
     try:
-        supabase.table("schedules").delete().eq("id", schedule_id).eq("user_id", user.id).execute()
+        await db.table("schedules").delete().eq("id", schedule_id).eq("user_id", user.id).execute()
+        schedule_loads.discard(user.id, schedule_id)
+        invalidate_user_context(user.id)
+        invalidate_etags(user.id, "schedules")
         return {"message": "Schedule deleted"}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.get("/api/schedules/weekly-load")
-async def get_weekly_load(user = Depends(get_current_user)):
+async def get_weekly_load(user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
     try:
-        schedules = supabase.table("schedules").select("*").eq("user_id", user.id).execute()
-        
-        academic_hours = 0
-        training_hours = 0
-        
-        for schedule in schedules.data:
-            # Calculate duration
-            start = datetime.strptime(schedule["start_time"], "%H:%M")
-            end = datetime.strptime(schedule["end_time"], "%H:%M")
-            duration = (end - start).seconds / 3600
-            
-            if schedule["type"] == "academic":
-                academic_hours += duration
-            elif schedule["type"] == "training":
-                training_hours += duration
-        
+        load = await schedule_loads.get(db, user.id)
+        academic_hours = load.hours("academic")
+        training_hours = load.hours("training")
         total_hours = academic_hours + training_hours
         
         # Determine load level
@@ -1009,47 +3934,139 @@ async def get_weekly_load(user = Depends(get_current_user)):
             "training_hours": round(training_hours, 1),
             "total_hours": round(total_hours, 1),
             "load_level": load_level,
-            "balance_ratio": round(academic_hours / training_hours, 2) if training_hours > 0 else 0
+            "balance_ratio": round(academic_hours / training_hours, 2) if training_hours > 0 else 0,
+            "days": load.days(),
+            "overlaps": load.overlaps()
+        }
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# ============ AGENDA ENDPOINTS ============
+
+def serialize_occurrence(occurrence: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        **occurrence,
+        "starts_at": occurrence["starts_at"].isoformat(),
+        "ends_at": occurrence["ends_at"].isoformat(),
+    }
+
+
+@app.get("/api/agenda/occurrences")
+async def get_agenda_occurrences(start: date, end: Optional[date] = None, tz: Optional[str] = None,
+                                 user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
+    """Events and expanded recurring occurrences overlapping [start, end); `end` defaults to one week later.
+
+    Days are local to `tz` (an IANA name), falling back to the profile's timezone and then UTC.
+    """
+    end = end or start + timedelta(days=7)
+    if end <= start or (end - start).days > AGENDA_MAX_RANGE_DAYS:
+        raise HTTPException(status_code=400, detail=f"Range must span between 1 and {AGENDA_MAX_RANGE_DAYS} days")
+    try:
+        zone = await resolve_user_timezone(db, user.id, tz)
+        range_start, range_end = local_day_start(start, zone), local_day_start(end, zone)
+        agenda = await load_user_agenda(db, user.id, range_start, range_end, zone)
+        occurrences = agenda.occurrences(range_start, range_end)
+        return {
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "occurrences": [serialize_occurrence(occurrence) for occurrence in occurrences]
+        }
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/agenda/free-slots")
+async def get_agenda_free_slots(start: date, end: Optional[date] = None, min_minutes: int = FREE_SLOT_MIN_MINUTES,
+                                tz: Optional[str] = None,
+                                user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
+    """Free time in [start, end) after events, sleep and buffers, within the user's availability blocks.
+
+    Days are local to `tz` (an IANA name), falling back to the profile's timezone and then UTC.
+    """
+    end = end or start + timedelta(days=7)
+    if end <= start or (end - start).days > AGENDA_MAX_RANGE_DAYS:
+        raise HTTPException(status_code=400, detail=f"Range must span between 1 and {AGENDA_MAX_RANGE_DAYS} days")
+    try:
+        zone = await resolve_user_timezone(db, user.id, tz)
+        slots = await find_free_slots(
+            db,
+            user.id,
+            local_day_start(start, zone),
+            local_day_start(end, zone),
+            max(min_minutes, 1),
+            zone=zone
+        )
+        return {
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "slots": [
+                {
+                    "start": slot[0].isoformat(),
+                    "end": slot[1].isoformat(),
+                    "minutes": int((slot[1] - slot[0]).total_seconds() // 60)
+                }
+                for slot in slots
+            ],
+            "total_minutes": int(sum((slot[1] - slot[0]).total_seconds() for slot in slots) // 60)
         }
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 # ============ DIARY ENDPOINTS ============
 
+DIARY_ENTRY_COLUMNS = "id, date, mood, energy, stress, notes, highlights, created_at, updated_at"
+
 @app.get("/api/diary/entries")
-async def get_diary_entries(limit: int = 30, user = Depends(get_current_user)):
+async def get_diary_entries(limit: int = 30, cursor: Optional[str] = None, user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
+    """Newest first; pass `next_cursor` back as `cursor` for older entries."""
     try:
-        result = supabase.table("diary_entries").select("*").eq("user_id", user.id).order("date", desc=True).limit(limit).execute()
-        return {"entries": result.data}
+        query = db.table("diary_entries").select(DIARY_ENTRY_COLUMNS).eq("user_id", user.id)
+        entries, next_cursor = await fetch_keyset_page(query, "date", limit, cursor)
+        return {"entries": entries, "next_cursor": next_cursor}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/api/diary/entries")
-async def create_diary_entry(entry: DiaryEntry, user = Depends(get_current_user)):
+async def create_diary_entry(entry: DiaryEntry, user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
     try:
         entry_data = entry.model_dump()
         entry_data["user_id"] = user.id
-        entry_data["created_at"] = datetime.now().isoformat()
+        entry_data["updated_at"] = datetime.now().isoformat()
         
-        # Check if entry exists for this date
-        existing = supabase.table("diary_entries").select("*").eq("user_id", user.id).eq("date", entry.date).execute()
-        
-        if existing.data:
-            # Update existing
-            entry_data["updated_at"] = datetime.now().isoformat()
-            result = supabase.table("diary_entries").update(entry_data).eq("id", existing.data[0]["id"]).execute()
-        else:
-            # Create new
-            result = supabase.table("diary_entries").insert(entry_data).execute()
+        # Insert or overwrite the day's entry in one statement; created_at keeps its original value
+        result = await db.table("diary_entries").upsert(entry_data, on_conflict="user_id,date").execute()
         
+        diary_metrics.record(user.id, entry_data)
+        invalidate_user_context(user.id)
         return {"message": "Diary entry saved", "entry": result.data[0] if result.data else None}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+@app.post("/api/diary/entries/bulk")
+async def create_diary_entries(batch: DiaryEntryBatch, user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
+    if len(batch.entries) > BULK_WRITE_MAX_ROWS:
+        raise HTTPException(status_code=413, detail=f"A batch can hold at most {BULK_WRITE_MAX_ROWS} entries")
+    try:
+        updated_at = datetime.now().isoformat()
+        # Postgres rejects an upsert that hits the same row twice, so the last entry per date wins
+        rows = {entry.date: {**entry.model_dump(), "user_id": user.id, "updated_at": updated_at} for entry in batch.entries}
+        if not rows:
+            return {"message": "Diary entries saved", "saved": 0, "entries": []}
+        
+        result = await db.table("diary_entries").upsert(list(rows.values()), on_conflict="user_id,date").execute()
+        
+        for row in rows.values():
+            diary_metrics.record(user.id, row)
+        invalidate_user_context(user.id)
+        return {"message": "Diary entries saved", "saved": len(result.data), "entries": result.data}
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.get("/api/diary/entries/{entry_date}")
-async def get_diary_entry(entry_date: str, user = Depends(get_current_user)):
+async def get_diary_entry(entry_date: str, user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
     try:
-        result = supabase.table("diary_entries").select("*").eq("user_id", user.id).eq("date", entry_date).execute()
+        result = await db.table("diary_entries").select("*").eq("user_id", user.id).eq("date", entry_date).execute()
         
         if result.data:
             return {"entry": result.data[0]}
@@ -1059,313 +4076,684 @@ async def get_diary_entry(entry_date: str, user = Depends(get_current_user)):
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.get("/api/diary/weekly-summary")
-async def get_weekly_summary(user = Depends(get_current_user)):
+async def get_weekly_summary(user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
     try:
-        # Get last 7 days
-        week_ago = (datetime.now() - timedelta(days=7)).date().isoformat()
+        metrics = await diary_metrics.get(db, user.id)
+        week = metrics.window(7)
         
-        result = supabase.table("diary_entries").select("*").eq("user_id", user.id).gte("date", week_ago).execute()
-        
-        if not result.data:
+        if not week["entries_count"]:
             return {"summary": {"avg_mood": 0, "avg_energy": 0, "avg_stress": 0, "entries_count": 0}}
         
-        entries = result.data
-        avg_mood = sum(e["mood"] for e in entries) / len(entries)
-        avg_energy = sum(e["energy"] for e in entries) / len(entries)
-        avg_stress = sum(e["stress"] for e in entries) / len(entries)
+        avg_mood = week["avg_mood"]
         
         return {
             "summary": {
                 "avg_mood": round(avg_mood, 1),
-                "avg_energy": round(avg_energy, 1),
-                "avg_stress": round(avg_stress, 1),
-                "entries_count": len(entries),
+                "avg_energy": round(week["avg_energy"], 1),
+                "avg_stress": round(week["avg_stress"], 1),
+                "entries_count": week["entries_count"],
                 "trend": "improving" if avg_mood > 3.5 else "stable" if avg_mood > 2.5 else "needs_attention"
             }
         }
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+@app.get("/api/diary/metrics")
+async def get_diary_metrics(user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
+    """7/30/90-day averages, change versus the preceding window and per-day trend slope."""
+    try:
+        metrics = await diary_metrics.get(db, user.id)
+        return {"metrics": {f"{width}d": metrics.window(width) for width in DIARY_WINDOWS}}
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 # ============ HABITS ENDPOINTS ============
 
 @app.get("/api/habits")
-async def get_habits(user = Depends(get_current_user)):
+async def get_habits(if_none_match: Optional[str] = Header(None), user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
+    today = utc_today()
+    
+    async def build() -> Dict[str, Any]:
+        result = await db.table("habits").select("*").eq("user_id", user.id).eq("active", True).execute()
+        habits = result.data
+        try:
+            histories = await habit_streaks.histories(db, user.id, [habit["id"] for habit in habits])
+            habits = [
+                {**habit, **histories[habit["id"]].summary(habit, today)} if habit["id"] in histories else habit
+                for habit in habits
+            ]
+        except Exception as exc:
+            logger.warning("Failed to load habit streaks for %s: %s", user.id, exc)
+        return {"habits": habits}
+    
     try:
-        result = supabase.table("habits").select("*").eq("user_id", user.id).eq("active", True).execute()
-        return {"habits": result.data}
+        # Streaks and completion rates roll over at midnight even without writes
+        return await conditional_json(if_none_match, user.id, "habits", build, variant=today.isoformat())
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/api/habits")
-async def create_habit(habit: Habit, user = Depends(get_current_user)):
+async def create_habit(habit: Habit, user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
     try:
         habit_data = habit.model_dump()
         habit_data["user_id"] = user.id
         habit_data["active"] = True
         habit_data["created_at"] = datetime.now().isoformat()
         
-        result = supabase.table("habits").insert(habit_data).execute()
+        result = await db.table("habits").insert(habit_data).execute()
         
+        invalidate_user_context(user.id)
+        invalidate_etags(user.id, "habits")
         return {"message": "Habit created", "habit": result.data[0] if result.data else None}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.put("/api/habits/{habit_id}")
-async def update_habit(habit_id: str, habit: Habit, user = Depends(get_current_user)):
+async def update_habit(habit_id: str, habit: Habit, user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
     try:
         update_data = habit.model_dump(exclude_unset=True)
         update_data["updated_at"] = datetime.now().isoformat()
         
-        result = supabase.table("habits").update(update_data).eq("id", habit_id).eq("user_id", user.id).execute()
+        result = await db.table("habits").update(update_data).eq("id", habit_id).eq("user_id", user.id).execute()
         
+        invalidate_user_context(user.id)
+        invalidate_etags(user.id, "habits")
         return {"message": "Habit updated", "habit": result.data[0] if result.data else None}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/api/habits/{habit_id}/track")
-async def track_habit(habit_id: str, tracking: HabitTracking, user = Depends(get_current_user)):
+async def track_habit(habit_id: str, tracking: HabitTracking, user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
     try:
         tracking_data = tracking.model_dump()
         tracking_data["habit_id"] = habit_id
         tracking_data["user_id"] = user.id
-        tracking_data["created_at"] = datetime.now().isoformat()
         
-        # Check if tracking exists for this date
-        existing = supabase.table("habit_tracking").select("*").eq("habit_id", habit_id).eq("date", tracking.date).execute()
+        # RLS only lets the upsert touch rows, and habits, owned by the caller
+        result = await db.table("habit_tracking").upsert(tracking_data, on_conflict="habit_id,date").execute()
         
-        if existing.data:
-            result = supabase.table("habit_tracking").update(tracking_data).eq("id", existing.data[0]["id"]).execute()
-        else:
-            result = supabase.table("habit_tracking").insert(tracking_data).execute()
+        tracked_day = parse_date(tracking.date)
+        if tracked_day is not None:
+            habit_streaks.record(habit_id, tracked_day, tracking.completed)
         
+        invalidate_user_context(user.id)
+        invalidate_etags(user.id, "habits")
         return {"message": "Habit tracked", "tracking": result.data[0] if result.data else None}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-@app.get("/api/habits/stats")
-async def get_habit_stats(days: int = 30, user = Depends(get_current_user)):
+@app.post("/api/habits/track/bulk")
+async def track_habits(batch: HabitTrackingBatch, user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
+    if len(batch.entries) > BULK_WRITE_MAX_ROWS:
+        raise HTTPException(status_code=413, detail=f"A batch can hold at most {BULK_WRITE_MAX_ROWS} entries")
     try:
-        start_date = (datetime.now() - timedelta(days=days)).date().isoformat()
+        # Last entry per (habit, date) wins; see create_diary_entries
+        rows = {(item.habit_id, item.date): {**item.model_dump(), "user_id": user.id} for item in batch.entries}
+        if not rows:
+            return {"message": "Habits tracked", "saved": 0, "tracking": []}
         
-        habits = supabase.table("habits").select("*").eq("user_id", user.id).eq("active", True).execute()
+        result = await db.table("habit_tracking").upsert(list(rows.values()), on_conflict="habit_id,date").execute()
         
-        stats = []
-        for habit in habits.data:
-            tracking = supabase.table("habit_tracking").select("*").eq("habit_id", habit["id"]).gte("date", start_date).execute()
-            
-            completed_count = sum(1 for t in tracking.data if t["completed"])
-            completion_rate = (completed_count / days) * 100 if days > 0 else 0
-            
-            stats.append({
-                "habit_id": habit["id"],
-                "title": habit["title"],
-                "completion_rate": round(completion_rate, 1),
-                "completed_count": completed_count,
-                "total_days": days
-            })
+        for row in rows.values():
+            tracked_day = parse_date(row["date"])
+            if tracked_day is not None:
+                habit_streaks.record(row["habit_id"], tracked_day, row["completed"])
         
-        return {"stats": stats}
+        invalidate_user_context(user.id)
+        invalidate_etags(user.id, "habits")
+        return {"message": "Habits tracked", "saved": len(result.data), "tracking": result.data}
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/habits/stats")
+async def get_habit_stats(days: int = 30, user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
+    try:
+        today = utc_today()
+        habits = await db.table("habits").select("id, title, frequency, target_days").eq("user_id", user.id).eq("active", True).execute()
+        
+        # Completions come from the per-habit bitsets; tracking rows are only read to rebuild stale ones
+        histories = await habit_streaks.histories(db, user.id, [habit["id"] for habit in habits.data])
+        
+        return {"stats": compute_habit_stats(habits.data, histories, today, days)}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 # ============ AI COACH ENDPOINTS ============
 
 @app.post("/api/recommendations/daily", response_model=DailyRecommendationResponse)
-async def generate_daily_recommendation_endpoint(payload: DailyRecommendationRequest, user = Depends(get_current_user)):
+async def generate_daily_recommendation_endpoint(payload: DailyRecommendationRequest, tz: Optional[str] = None,
+                                                 user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
     if payload.user_id and payload.user_id != user.id:
         raise HTTPException(status_code=403, detail="No autorizado para solicitar datos de otro usuario.")
     target_date = payload.date
-    tier = determine_subscription_tier(user.id)
-    apply_retention_policies(user.id)
-    events = fetch_events_for_day(user.id, target_date)
+    try:
+        zone = await resolve_user_timezone(db, user.id, tz)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    tier = await determine_subscription_tier(db, user.id)
+    events = await fetch_events_for_day(db, user.id, target_date, zone)
+    excluded_kinds = []
     if payload.include_competitions is False:
-        events = [event for event in events if event.get("kind") != "competencia"]
+        excluded_kinds.append("competencia")
     if payload.include_training is False:
-        events = [event for event in events if event.get("kind") != "entreno"]
-    recommendation = agenda_agent.generate(user.id, target_date, tier, events)
-    record_daily_recommendation(user.id, target_date, recommendation)
+        excluded_kinds.append("entreno")
+    events = [event for event in events if event.get("kind") not in excluded_kinds]
+    try:
+        free_slots = await find_free_slots(
+            db,
+            user.id,
+            local_day_start(target_date, zone),
+            local_day_start(target_date + timedelta(days=1), zone),
+            exclude_kinds=tuple(excluded_kinds),
+            zone=zone
+        )
+    except Exception as exc:
+        logger.warning("Failed to compute free slots for %s on %s: %s", user.id, target_date, exc)
+        free_slots = None
+    cache_key = recommendation_cache_key(
+        user.id,
+        target_date,
+        tier,
+        payload.include_competitions is not False,
+        payload.include_training is not False,
+        build_event_context(events, target_date),
+        free_slots
+    )
+    if not payload.force_refresh:
+        cached = await load_cached_recommendation(db, user.id, target_date, cache_key)
+        if cached:
+            return cached
+    recommendation = await agenda_agent.generate(user.id, target_date, tier, events, free_slots)
+    await record_daily_recommendation(db, user.id, target_date, recommendation, cache_key)
     return recommendation
 
 
 @app.post("/api/coach/chat")
-async def coach_chat(payload: CoachChatRequest, user = Depends(get_current_user)):
+async def coach_chat(payload: CoachChatRequest, user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
     if payload.user_id and payload.user_id != user.id:
         raise HTTPException(status_code=403, detail="No autorizado para solicitar datos de otro usuario.")
     if not payload.messages:
         raise HTTPException(status_code=400, detail="Se requiere al menos un mensaje.")
 
-    tier = determine_subscription_tier(user.id)
-    ensure_chat_quota(user.id, tier)
-    apply_retention_policies(user.id)
-
     latest_user_message = next((m for m in reversed(payload.messages) if m.role == "user"), None)
-    chat_id = get_or_create_chat(user.id, payload.chat_id, title=latest_user_message.content[:80] if latest_user_message else None)
+    tier = await determine_subscription_tier(db, user.id)
+    await ensure_chat_quota(db, user.id, tier, reserve=latest_user_message is not None)
 
-    if latest_user_message:
-        record_chat_message(chat_id, user.id, "user", latest_user_message.content, {"source": "app"})
+    chat_id = await get_or_create_chat(db, user.id, payload.chat_id, title=latest_user_message.content[:80] if latest_user_message else None)
 
-    agent_result = chat_agent.generate_reply(payload.messages, payload.tone, payload.target_goal)
-    reply_text = agent_result.get("reply", "")
-    escalate_flag = bool(agent_result.get("escalate"))
-    habit_hint = agent_result.get("habit_hint")
-
-    metadata = {
-        "model": agent_result.get("model"),
-        "habit_hint": habit_hint,
-        "escalate": escalate_flag
-    }
-    record_chat_message(chat_id, user.id, "assistant", reply_text, metadata)
-
-    if escalate_flag:
-        escalation_payload = EscalationRequest(
-            user_id=user.id,
-            context={
-                "source": "chat",
-                "reason": "ai_flag",
-                "habit_hint": habit_hint,
-                "last_user_message": latest_user_message.content if latest_user_message else None
-            },
-            reason="ai_flag"
-        )
-        decision = EscalationResponse(
-            escalate=True,
-            booking_url=SPORTS_PSYCHOLOGY_BOOKING_URL,
-            message="Kai detectó marcadores de estrés elevado."
-        )
-        record_escalation(user.id, escalation_payload, decision)
+    outcome: Dict[str, Any] = {"reply": "", "escalate": False, "habit_hint": None, "model": None}
 
-    def iterator():
-        for chunk in chunk_text(reply_text, size=220):
+    async def iterator():
+        streamed: List[str] = []
+        try:
+            try:
+                async for event in chat_agent.stream_reply(payload.messages, payload.tone, payload.target_goal):
+                    if "delta" in event:
+                        streamed.append(event["delta"])
+                        yield (json.dumps({
+                            "chat_id": str(chat_id),
+                            "delta": event["delta"],
+                            "finished": False
+                        }) + "\n").encode("utf-8")
+                        continue
+                    final = event["final"]
+                    outcome.update({
+                        "reply": final.get("reply") or "".join(streamed),
+                        "escalate": bool(final.get("escalate")),
+                        "habit_hint": final.get("habit_hint"),
+                        "model": final.get("model")
+                    })
+            except Exception as exc:
+                # Finish the stream normally so persist_turn still stores the user's message
+                logger.error("Chat stream failed for %s: %s", user.id, exc)
+                outcome["escalate"] = False
+            outcome["reply"] = outcome["reply"] or "".join(streamed)
             yield (json.dumps({
                 "chat_id": str(chat_id),
-                "delta": chunk,
-                "finished": False
+                "finished": True,
+                "escalate": outcome["escalate"],
+                "habit_hint": outcome["habit_hint"],
+                "booking_url": SPORTS_PSYCHOLOGY_BOOKING_URL if outcome["escalate"] else None,
+                "model": outcome["model"]
             }) + "\n").encode("utf-8")
-        yield (json.dumps({
-            "chat_id": str(chat_id),
-            "finished": True,
-            "escalate": escalate_flag,
-            "habit_hint": habit_hint,
-            "booking_url": SPORTS_PSYCHOLOGY_BOOKING_URL if escalate_flag else None,
-            "model": agent_result.get("model")
-        }) + "\n").encode("utf-8")
+        finally:
+            # Also reached when the client disconnects mid-stream, where Starlette would skip a
+            # response background task; whatever was streamed so far is kept as the reply
+            outcome["reply"] = outcome["reply"] or "".join(streamed)
+            persist_in_background(persist_turn())
+
+    async def persist_turn():
+        turn_messages: List[Dict[str, Any]] = []
+        preview: Optional[str] = None
+        if latest_user_message:
+            turn_messages.append(build_chat_message(user.id, "user", latest_user_message.content, {"source": "app"}))
+            preview = build_chat_preview(latest_user_message.content)
+        if outcome["reply"]:
+            metadata = {
+                "model": outcome["model"],
+                "habit_hint": outcome["habit_hint"],
+                "escalate": outcome["escalate"]
+            }
+            turn_messages.append(build_chat_message(user.id, "assistant", outcome["reply"], metadata))
+            preview = build_chat_preview(outcome["reply"])
+        await record_chat_messages(db, chat_id, turn_messages, preview)
+
+        if outcome["escalate"]:
+            escalation_payload = EscalationRequest(
+                user_id=user.id,
+                context={
+                    "source": "chat",
+                    "reason": "ai_flag",
+                    "habit_hint": outcome["habit_hint"],
+                    "last_user_message": latest_user_message.content if latest_user_message else None
+                },
+                reason="ai_flag"
+            )
+            decision = EscalationResponse(
+                escalate=True,
+                booking_url=SPORTS_PSYCHOLOGY_BOOKING_URL,
+                message="Kai detectó marcadores de estrés elevado."
+            )
+            await record_escalation(db, user.id, escalation_payload, decision)
 
     headers = {"Cache-Control": "no-store"}
     return StreamingResponse(iterator(), media_type="application/json", headers=headers)
 
 
+@app.get("/api/coach/chats")
+async def list_chats(limit: int = 20, cursor: Optional[str] = None, user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
+    """Conversations by most recent message, from the chats row alone (idx_chats_user_last_message).
+
+    A chat that gets a new message while the user is paging moves to the top and may be missed
+    by later pages; the next refresh picks it up.
+    """
+    try:
+        query = db.table("chats") \
+            .select("id, title, last_message_at, message_count, last_message_preview, last_message_role, created_at") \
+            .eq("user_id", user.id) \
+            .eq("is_active", True)
+        chats, next_cursor = await fetch_keyset_page(query, "last_message_at", limit, cursor)
+        previews = await decrypt_contents([chat.get("last_message_preview") for chat in chats])
+        return {
+            "chats": [
+                {**chat, "last_message_preview": preview[:CHAT_PREVIEW_CHARS] if preview else preview}
+                for chat, preview in zip(chats, previews)
+            ],
+            "next_cursor": next_cursor
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+# Decrypted pages behind a cursor. Those only hold messages older than the cursor, which never
+# change, so entries need no invalidation; the newest page is always read fresh.
+chat_page_cache = TTLCache(CHAT_PAGE_CACHE_SIZE, CHAT_PAGE_CACHE_TTL_SECONDS)
+
+
+@app.get("/api/coach/chats/{chat_id}/messages")
+async def get_chat_messages(chat_id: UUID, limit: int = 50, cursor: Optional[str] = None,
+                            user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
+    """Newest messages first by page, chronological within a page; `next_cursor` pages further back."""
+    cache_key = (user.id, str(chat_id), cursor, limit)
+    if cursor:
+        cached = chat_page_cache.get(cache_key)
+        if cached is not None:
+            return cached
+    try:
+        query = db.table("chat_messages") \
+            .select("id, role, content, metadata, created_at") \
+            .eq("chat_id", str(chat_id)) \
+            .eq("user_id", user.id)
+        chat, (messages, next_cursor) = await asyncio.gather(
+            db.table("chats").select("id").eq("id", str(chat_id)).eq("user_id", user.id).limit(1).execute(),
+            fetch_keyset_page(query, "created_at", limit, cursor)
+        )
+        if not chat.data:
+            raise HTTPException(status_code=404, detail="Conversación no encontrada.")
+        
+        messages.reverse()
+        contents = await decrypt_contents([message.get("content") for message in messages])
+        page = {
+            "chat_id": str(chat_id),
+            "messages": [{**message, "content": content} for message, content in zip(messages, contents)],
+            "next_cursor": next_cursor
+        }
+        if cursor:
+            chat_page_cache.put(cache_key, page)
+        return page
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
 @app.post("/api/coach/habit-plan", response_model=HabitPlanResponse)
-async def generate_habit_plan_endpoint(payload: HabitPlanRequest, user = Depends(get_current_user)):
+async def generate_habit_plan_endpoint(payload: HabitPlanRequest, user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
     if payload.user_id and payload.user_id != user.id:
         raise HTTPException(status_code=403, detail="No autorizado para solicitar datos de otro usuario.")
-    tier = determine_subscription_tier(user.id)
-    enforce_habit_plan_cooldown(user.id, tier)
+    tier = await determine_subscription_tier(db, user.id)
+    await enforce_habit_plan_cooldown(db, user.id, tier)
     timeframe = payload.timeframe or "next 7 days"
     context = payload.context or {}
-    plan = habit_plan_agent.generate(timeframe, context, tier)
-    record_habit_plan(user.id, plan, timeframe)
+    plan = await habit_plan_agent.generate(timeframe, context, tier)
+    await record_habit_plan(db, user.id, plan, timeframe)
     return plan
 
 
 @app.post("/api/escalate", response_model=EscalationResponse)
-async def escalate(payload: EscalationRequest, user = Depends(get_current_user)):
+async def escalate(payload: EscalationRequest, user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
     if payload.user_id and payload.user_id != user.id:
         raise HTTPException(status_code=403, detail="No autorizado para solicitar datos de otro usuario.")
-    tier = determine_subscription_tier(user.id)
+    tier = await determine_subscription_tier(db, user.id)
     decision = escalation_agent.decide(payload, tier)
-    record_escalation(user.id, payload, decision)
+    await record_escalation(db, user.id, payload, decision)
     return decision
 
-# ============ SESSIONS ENDPOINTS ============
+# ============ ENTITLEMENT ENDPOINTS ============
 
-@app.get("/api/sessions/types")
-async def get_session_types():
+@app.post("/api/entitlements/refresh")
+async def refresh_entitlements(user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
+    invalidate_subscription_tier(user.id)
+    tier = await determine_subscription_tier(db, user.id)
+    return {"tier": tier}
+
+
+@app.post("/api/internal/entitlements/invalidate", dependencies=[Depends(require_internal_key)])
+async def invalidate_entitlements(payload: EntitlementInvalidationRequest):
+    invalidate_subscription_tier(payload.user_id)
+    return {"message": "Entitlement cache invalidated", "user_id": payload.user_id}
+
+
+@app.get("/api/internal/metrics", dependencies=[Depends(require_internal_key)])
+async def internal_metrics():
     return {
-        "types": [
-            {"id": "focus", "title": "Enfoque y Concentración", "duration": 15, "description": "Mejora tu concentración para entrenamientos y competencias"},
-            {"id": "calm", "title": "Calma y Relajación", "duration": 10, "description": "Reduce el estrés y encuentra equilibrio"},
-            {"id": "recovery", "title": "Recuperación Mental", "duration": 12, "description": "Optimiza tu descanso y regeneración"},
-            {"id": "pre_competition", "title": "Pre-Competencia", "duration": 8, "description": "Prepárate mentalmente antes de competir"},
-            {"id": "visualization", "title": "Visualización", "duration": 10, "description": "Visualiza tu éxito y rendimiento óptimo"}
-        ]
+        "caches": {
+            "subscription_tier": tier_cache.stats(),
+            "auth_token": token_cache.stats(),
+            "daily_recommendation": recommendation_cache.stats(),
+            "habit_streaks": habit_streaks.stats(),
+            "schedule_load": schedule_loads.stats(),
+            "diary_metrics": diary_metrics.stats(),
+            "agenda": agenda_cache.stats(),
+            "free_slots": free_slot_cache.stats(),
+            "user_context": user_context_cache.stats(),
+            "etag": etag_cache.stats(),
+            "chat_pages": chat_page_cache.stats(),
+        },
+        "llm": llm_executor.stats(),
+        "retention": retention_worker.stats(),
+        "analytics": analytics_buffer.stats()
     }
 
+
+@app.post("/api/internal/retention/run", dependencies=[Depends(require_internal_key)])
+async def run_retention():
+    purged = await retention_worker.run_once()
+    return {"purged": purged, "retention": retention_worker.stats()}
+
+
+@app.post("/api/internal/chats/backfill-previews", dependencies=[Depends(require_internal_key)])
+async def run_chat_preview_backfill():
+    try:
+        filled = await backfill_chat_previews(DataSession(data_backend, SUPABASE_SERVICE_ROLE_KEY))
+        return {"filled": filled}
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# ============ SESSIONS ENDPOINTS ============
+
+SESSION_TYPES = {
+    "types": [
+        {"id": "focus", "title": "Enfoque y Concentración", "duration": 15, "description": "Mejora tu concentración para entrenamientos y competencias"},
+        {"id": "calm", "title": "Calma y Relajación", "duration": 10, "description": "Reduce el estrés y encuentra equilibrio"},
+        {"id": "recovery", "title": "Recuperación Mental", "duration": 12, "description": "Optimiza tu descanso y regeneración"},
+        {"id": "pre_competition", "title": "Pre-Competencia", "duration": 8, "description": "Prepárate mentalmente antes de competir"},
+        {"id": "visualization", "title": "Visualización", "duration": 10, "description": "Visualiza tu éxito y rendimiento óptimo"}
+    ]
+}
+SESSION_TYPES_ETAG = payload_etag(SESSION_TYPES)
+
+@app.get("/api/sessions/types")
+async def get_session_types(if_none_match: Optional[str] = Header(None)):
+    headers = {"ETag": SESSION_TYPES_ETAG, "Cache-Control": "public, no-cache"}
+    if etag_matches(if_none_match, SESSION_TYPES_ETAG):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(SESSION_TYPES, headers=headers)
+
 @app.post("/api/sessions/complete")
-async def complete_session(completion: SessionCompletion, user = Depends(get_current_user)):
+async def complete_session(completion: SessionCompletion, user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
     try:
         session_data = completion.model_dump()
         session_data["user_id"] = user.id
         session_data["completed_at"] = datetime.now().isoformat()
         
-        result = supabase.table("session_completions").insert(session_data).execute()
+        result = await db.table("session_completions").insert(session_data).execute()
         
         return {"message": "Session completed", "session": result.data[0] if result.data else None}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.get("/api/sessions/history")
-async def get_session_history(limit: int = 20, user = Depends(get_current_user)):
+async def get_session_history(limit: int = 20, cursor: Optional[str] = None, user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
+    """Most recent first; pass `next_cursor` back as `cursor` for older sessions."""
     try:
-        result = supabase.table("session_completions").select("*").eq("user_id", user.id).order("completed_at", desc=True).limit(limit).execute()
-        return {"sessions": result.data}
+        query = db.table("session_completions") \
+            .select("id, session_type, duration, rating, notes, completed_at") \
+            .eq("user_id", user.id)
+        sessions, next_cursor = await fetch_keyset_page(query, "completed_at", limit, cursor)
+        return {"sessions": sessions, "next_cursor": next_cursor}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-# ============ AI COACH ENDPOINTS ============
+# ============ SYNC ENDPOINTS ============
 
-@app.post("/api/ai/recommendations")
-async def generate_recommendations(request: AIRecommendationRequest, user = Depends(get_current_user)):
+# Columns sent to the app for each synced table; every table carries a trigger-maintained updated_at
+SYNC_TABLES: Dict[str, str] = {
+    "diary_entries": "id, date, mood, energy, stress, notes, highlights, updated_at",
+    "habits": "id, title, description, frequency, category, target_days, active, updated_at",
+    "habit_tracking": "id, habit_id, date, completed, notes, updated_at",
+    "schedules": "id, day_of_week, start_time, end_time, type, title, notes, updated_at",
+    "session_completions": "id, session_type, duration, rating, notes, completed_at, updated_at",
+}
+
+# Model validating each queued mutation and the unique key its upsert resolves on
+SYNC_MUTATIONS: Dict[str, Tuple[Any, str]] = {
+    "diary_entries": (DiaryEntry, "user_id,date"),
+    "habit_tracking": (HabitTrackingBatchItem, "habit_id,date"),
+    "session_completions": (SyncedSessionCompletion, "id"),
+    "schedules": (SyncedScheduleBlock, "id"),
+}
+SYNC_DELETABLE_TABLES = {"schedules"}
+
+
+# A table's sync position: rows stamped at or after the timestamp, or strictly past (timestamp, id) mid-page
+SyncPosition = Tuple[str, Optional[str]]
+
+
+def encode_sync_cursor(positions: Dict[str, SyncPosition]) -> str:
+    return encode_opaque_cursor({table: list(position) for table, position in positions.items()})
+
+
+def decode_sync_cursor(cursor: str) -> Dict[str, SyncPosition]:
     try:
-        # Get user profile
-        profile = supabase.table("user_profiles").select("*").eq("user_id", user.id).execute()
-        profile_data = profile.data[0] if profile.data else {}
-        
-        # Get weekly schedule load
-        schedules = supabase.table("schedules").select("*").eq("user_id", user.id).execute()
-        total_hours = 0
-        training_hours = 0
-        academic_hours = 0
-        
-        for schedule in schedules.data:
-            start = datetime.strptime(schedule["start_time"], "%H:%M")
-            end = datetime.strptime(schedule["end_time"], "%H:%M")
-            duration = (end - start).seconds / 3600
-            total_hours += duration
-            
-            if schedule["type"] == "training":
-                training_hours += duration
+        payload = decode_opaque_cursor(cursor)
+        return {
+            str(table): (str(since), str(after_id) if after_id is not None else None)
+            for table, (since, after_id) in payload.items()
+        }
+    except (ValueError, TypeError, AttributeError) as exc:
+        raise HTTPException(status_code=400, detail="Invalid sync cursor") from exc
+
+
+async def fetch_sync_page(db: DataSession, user_id: str, table: str, columns: str, column: str,
+                          position: Optional[SyncPosition]) -> List[Dict[str, Any]]:
+    query = db.table(table).select(columns).eq("user_id", user_id)
+    if position is not None:
+        since, after_id = position
+        query = query.gte(column, since) if after_id is None else query.keyset_after(column, since, "id", after_id)
+    page = await query.order(column).order("id").limit(SYNC_PAGE_SIZE).execute()
+    return page.data
+
+
+async def database_now(db: DataSession) -> datetime:
+    """The database clock that stamps updated_at; this server's clock only when the RPC is missing."""
+    try:
+        result = await db.rpc("sync_clock").execute()
+    except DataAccessError as exc:
+        if exc.status_code != 404:
+            raise
+        logger.warning("sync_clock RPC unavailable; sync watermarks use the API server's clock.")
+        return utc_now()
+    return parse_utc_datetime(result.data[0] if result.data else None) or utc_now()
+
+
+def next_sync_position(rows: List[Dict[str, Any]], column: str, watermark: str) -> Tuple[SyncPosition, bool]:
+    """Where the next sync resumes for one table, and whether rows are still pending.
+
+    A drained table resumes from `watermark`, a little before now, so rows stamped by transactions
+    that were still open during this read are not skipped; re-sending them is harmless.
+    """
+    if len(rows) < SYNC_PAGE_SIZE:
+        return (watermark, None), False
+    return (str(rows[-1][column]), str(rows[-1]["id"])), True
+
+
+async def apply_sync_mutations(db: DataSession, user_id: str, mutations: List[SyncMutation]) -> List[Dict[str, Any]]:
+    """Writes queued mutations with one statement per table and operation; returns the rejected ones."""
+    pending: Dict[str, Dict[Tuple[str, ...], Tuple[int, Optional[Dict[str, Any]]]]] = {table: {} for table in SYNC_MUTATIONS}
+    rejected: List[Dict[str, Any]] = []
+    for index, mutation in enumerate(mutations):
+        model, conflict = SYNC_MUTATIONS[mutation.table]
+        if mutation.op == "delete":
+            if mutation.table not in SYNC_DELETABLE_TABLES or not mutation.data.get("id"):
+                rejected.append({"index": index, "error": f"Cannot delete from {mutation.table} without an id"})
             else:
-                academic_hours += duration
-        
-        # Get weekly mood summary
-        week_ago = (datetime.now() - timedelta(days=7)).date().isoformat()
-        diary_entries = supabase.table("diary_entries").select("*").eq("user_id", user.id).gte("date", week_ago).execute()
+                pending[mutation.table][(str(mutation.data["id"]),)] = (index, None)
+            continue
+        try:
+            row = model(**mutation.data).model_dump(mode="json")
+        except ValidationError as exc:
+            rejected.append({"index": index, "error": str(exc)})
+            continue
+        row["user_id"] = user_id
+        # A later mutation of the same row supersedes earlier ones, as replaying them in order would
+        pending[mutation.table][tuple(str(row[column]) for column in conflict.split(","))] = (index, row)
+
+    writes: List[Tuple[str, str, List[int]]] = []
+    statements = []
+    for table, entries in pending.items():
+        upserts = [(index, row) for index, row in entries.values() if row is not None]
+        deletes = [(index, key[0]) for key, (index, row) in entries.items() if row is None]
+        if upserts:
+            writes.append((table, "upsert", [index for index, _ in upserts]))
+            statements.append(db.table(table).upsert([row for _, row in upserts], on_conflict=SYNC_MUTATIONS[table][1]).execute())
+        if deletes:
+            writes.append((table, "delete", [index for index, _ in deletes]))
+            statements.append(db.table(table).delete().in_("id", [row_id for _, row_id in deletes]).eq("user_id", user_id).execute())
+
+    results = await asyncio.gather(*statements, return_exceptions=True)
+    changed = False
+    for (table, op, indexes), result in zip(writes, results):
+        if isinstance(result, Exception):
+            logger.warning("Sync %s on %s failed for %s: %s", op, table, user_id, result)
+            rejected.extend({"index": index, "error": str(result)} for index in indexes)
+            continue
+        changed = True
+        for row in result.data:
+            if table == "diary_entries":
+                diary_metrics.record(user_id, row)
+            elif table == "habit_tracking":
+                tracked_day = parse_date(row.get("date"))
+                if tracked_day is not None:
+                    habit_streaks.record(row["habit_id"], tracked_day, bool(row.get("completed")))
+            elif table == "schedules" and op == "delete":
+                schedule_loads.discard(user_id, row["id"])
+            elif table == "schedules":
+                schedule_loads.record(user_id, row)
+    if changed:
+        invalidate_user_context(user_id)
+        invalidate_etags(user_id, "schedules", "habits")
+    return sorted(rejected, key=lambda item: item["index"])
+
+
+@app.post("/api/sync")
+async def sync(request: SyncRequest, user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
+    """Applies the app's queued mutations, then returns rows changed since `cursor` (everything when absent).
+
+    Deletions arrive as tombstones and should be applied before `changes`. `reset` means the cursor is
+    older than tombstone retention, so the app should replace its local copy with the returned rows.
+    Call again with the new cursor while `has_more` is true.
+
+    updated_at is the writing transaction's start time (NOW()), so a row can become visible after
+    rows stamped later. A drained table therefore resumes from the database's clock, read before the
+    pages, minus SYNC_CURSOR_LAG_SECONDS: writes to synced tables are assumed to commit within that lag.
+    A longer transaction can have its rows skipped until they change again.
+    """
+    if len(request.mutations) > BULK_WRITE_MAX_ROWS:
+        raise HTTPException(status_code=413, detail=f"A sync can carry at most {BULK_WRITE_MAX_ROWS} mutations")
+    positions = decode_sync_cursor(request.cursor) if request.cursor else {}
+    try:
+        rejected = await apply_sync_mutations(db, user.id, request.mutations) if request.mutations else []
         
-        avg_mood = 3
-        avg_energy = 3
-        avg_stress = 3
+        # Taken before the reads, from the same clock that stamps updated_at
+        now = await database_now(db)
+        watermark = (now - timedelta(seconds=SYNC_CURSOR_LAG_SECONDS)).isoformat()
+        reset = False
+        if positions:
+            tombstones_since = parse_utc_datetime(positions.get("sync_tombstones", ("",))[0])
+            reset = tombstones_since is None or tombstones_since < now - timedelta(days=max(DATA_RETENTION_DAYS - 1, 0))
+            if reset:
+                positions = {}
         
-        if diary_entries.data:
-            avg_mood = sum(e["mood"] for e in diary_entries.data) / len(diary_entries.data)
-            avg_energy = sum(e["energy"] for e in diary_entries.data) / len(diary_entries.data)
-            avg_stress = sum(e["stress"] for e in diary_entries.data) / len(diary_entries.data)
+        sources = [(table, columns, "updated_at") for table, columns in SYNC_TABLES.items()]
+        if positions:
+            sources.append(("sync_tombstones", "id, table_name, row_id, deleted_at", "deleted_at"))
+        pages = await asyncio.gather(*(
+            fetch_sync_page(db, user.id, table, columns, column, positions.get(table))
+            for table, columns, column in sources
+        ))
         
-        # Get habit completion
-        habits = supabase.table("habits").select("*").eq("user_id", user.id).eq("active", True).execute()
-        habit_tracking = supabase.table("habit_tracking").select("*").eq("user_id", user.id).gte("date", week_ago).execute()
+        changes: Dict[str, List[Dict[str, Any]]] = {}
+        deleted: List[Dict[str, Any]] = []
+        next_positions: Dict[str, SyncPosition] = {"sync_tombstones": (watermark, None)}
+        has_more = False
+        for (table, _, column), rows in zip(sources, pages):
+            next_positions[table], more = next_sync_position(rows, column, watermark)
+            has_more = has_more or more
+            if table == "sync_tombstones":
+                deleted = [{"table": row["table_name"], "id": row["row_id"]} for row in rows]
+            else:
+                changes[table] = rows
         
-        habit_completion_rate = 0
-        if habits.data and habit_tracking.data:
-            completed = sum(1 for t in habit_tracking.data if t["completed"])
-            total_possible = len(habits.data) * 7
-            habit_completion_rate = (completed / total_possible * 100) if total_possible > 0 else 0
+        return {
+            "cursor": encode_sync_cursor(next_positions),
+            "has_more": has_more,
+            "reset": reset,
+            "changes": changes,
+            "deleted": deleted,
+            "applied": len(request.mutations) - len(rejected),
+            "rejected": rejected
+        }
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# ============ AI COACH ENDPOINTS ============
+
+@app.post("/api/ai/recommendations")
+async def generate_recommendations(request: AIRecommendationRequest, user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
+    try:
+        snapshot = await load_user_context(db, user.id)
         
         # Build AI context
+        profile_data = snapshot.profile
         sport = profile_data.get("sport", "deportista")
         level = profile_data.get("level", "universitario")
         goals = profile_data.get("goals", [])
         stress_factors = profile_data.get("stress_factors", [])
-        questionnaire = profile_data.get("questionnaire_data", {})
         
         # Create prompt
         prompt = f"""Eres un coach de bienestar mental especializado en deportistas universitarios.
@@ -1377,19 +4765,19 @@ Perfil del atleta:
 - Factores de estrés: {', '.join(stress_factors) if stress_factors else 'carga académica y competitiva'}
 
 Carga semanal actual:
-- Horas totales: {round(total_hours, 1)} horas
-- Entrenamiento: {round(training_hours, 1)} horas
-- Académico: {round(academic_hours, 1)} horas
-- Nivel de carga: {'alto' if total_hours > 40 else 'moderado' if total_hours > 30 else 'equilibrado'}
+- Horas totales: {round(snapshot.total_hours, 1)} horas
+- Entrenamiento: {round(snapshot.training_hours, 1)} horas
+- Académico: {round(snapshot.academic_hours, 1)} horas
+- Nivel de carga: {snapshot.load_level}
 
 Estado emocional (última semana):
-- Ánimo promedio: {round(avg_mood, 1)}/5
-- Energía promedio: {round(avg_energy, 1)}/5
-- Estrés promedio: {round(avg_stress, 1)}/5
-- Tendencia: {'positiva' if avg_mood > 3.5 else 'estable' if avg_mood > 2.5 else 'requiere atención'}
+- Ánimo promedio: {round(snapshot.avg_mood, 1)}/5
+- Energía promedio: {round(snapshot.avg_energy, 1)}/5
+- Estrés promedio: {round(snapshot.avg_stress, 1)}/5
+- Tendencia: {snapshot.mood_trend}
 
 Hábitos:
-- Tasa de cumplimiento: {round(habit_completion_rate, 1)}%
+- Tasa de cumplimiento: {round(snapshot.habit_completion_rate, 1)}%
 
 Contexto adicional: {request.context or 'N/A'}
 
@@ -1410,35 +4798,39 @@ Pasos recomendados:
 
 [Mensaje motivacional final]"""
         
-        # Call OpenAI
-        response = openai_client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "Eres un coach de bienestar mental empático y profesional especializado en deportistas universitarios. Tus recomendaciones son personalizadas, accionables y motivadoras."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7,
-            max_tokens=400
-        )
-        
-        recommendation_text = response.choices[0].message.content
+        # Call OpenAI, or fall back to the local heuristic when mocked or while the model is unavailable
+        model = "gpt-4o"
+        if USE_MOCK_AI or llm_executor.client is None:
+            recommendation_text = heuristic_recommendation(snapshot)
+            model = "mock-2024.11"
+        else:
+            try:
+                response = await llm_executor.run("gpt-4o", lambda client: client.chat.completions.create(
+                    model="gpt-4o",
+                    messages=[
+                        {"role": "system", "content": "Eres un coach de bienestar mental empático y profesional especializado en deportistas universitarios. Tus recomendaciones son personalizadas, accionables y motivadoras."},
+                        {"role": "user", "content": prompt}
+                    ],
+                    temperature=0.7,
+                    max_tokens=400
+                ))
+                recommendation_text = response.choices[0].message.content
+            except Exception as exc:
+                logger.error("AI recommendation failed for %s: %s", user.id, exc, exc_info=not isinstance(exc, CircuitOpenError))
+                recommendation_text = heuristic_recommendation(snapshot)
+                model = "fallback-heuristic"
         
         # Save recommendation
         rec_data = {
             "user_id": user.id,
             "recommendation": recommendation_text,
-            "context": {
-                "mood": avg_mood,
-                "energy": avg_energy,
-                "stress": avg_stress,
-                "total_hours": total_hours,
-                "habit_completion": habit_completion_rate
-            },
-            "model": "gpt-4o",
+            "context": snapshot.metrics(),
+            "model": model,
             "created_at": datetime.now().isoformat()
         }
         
-        supabase.table("ai_recommendations").insert(rec_data).execute()
+        await db.table("ai_recommendations").insert(rec_data).execute()
+        invalidate_etags(user.id, "recommendation_latest")
         
         return {
             "recommendation": recommendation_text,
@@ -1449,53 +4841,142 @@ Pasos recomendados:
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"AI recommendation failed: {str(e)}")
 
-@app.get("/api/ai/recommendations/latest")
-async def get_latest_recommendation(user = Depends(get_current_user)):
+@app.get("/api/ai/recommendations")
+async def list_recommendations(limit: int = 20, cursor: Optional[str] = None, user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
+    """Past recommendations, newest first; pass `next_cursor` back as `cursor` for older ones."""
     try:
-        result = supabase.table("ai_recommendations").select("*").eq("user_id", user.id).order("created_at", desc=True).limit(1).execute()
+        query = db.table("ai_recommendations") \
+            .select("id, recommendation, model, created_at") \
+            .eq("user_id", user.id)
+        recommendations, next_cursor = await fetch_keyset_page(query, "created_at", limit, cursor)
+        return {"recommendations": recommendations, "next_cursor": next_cursor}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/ai/recommendations/latest")
+async def get_latest_recommendation(if_none_match: Optional[str] = Header(None), user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
+    async def build() -> Dict[str, Any]:
+        result = await db.table("ai_recommendations").select("*").eq("user_id", user.id).order("created_at", desc=True).limit(1).execute()
         
         if result.data:
             return {"recommendation": result.data[0]}
         else:
             return {"recommendation": None}
+    
+    try:
+        return await conditional_json(if_none_match, user.id, "recommendation_latest", build)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 # ============ ANALYTICS ENDPOINTS ============
 
+def clamp_event_timestamp(timestamp: Optional[datetime]) -> datetime:
+    """Keeps client clocks inside [now - max age, now + skew] so events cannot land outside retention."""
+    now = utc_now()
+    if timestamp is None:
+        return now
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    earliest = now - timedelta(hours=ANALYTICS_MAX_EVENT_AGE_HOURS)
+    latest = now + timedelta(seconds=ANALYTICS_MAX_CLOCK_SKEW_SECONDS)
+    return min(max(timestamp, earliest), latest)
+
+
+def build_analytics_row(user_id: str, event: AnalyticsEvent) -> Dict[str, Any]:
+    return {
+        "user_id": user_id,
+        "event_type": event.event_type,
+        "event_data": event.event_data,
+        "timestamp": clamp_event_timestamp(event.timestamp).isoformat(),
+    }
+
+
+async def ingest_analytics(db: DataSession, rows: List[Dict[str, Any]]) -> int:
+    """Hands rows to the shared buffer, or writes them in one insert when buffering is off."""
+    if analytics_buffer.running:
+        return analytics_buffer.enqueue(rows)
+    await write_analytics_events(db, rows)
+    return len(rows)
+
+
 @app.post("/api/analytics/events")
-async def track_event(event: AnalyticsEvent, user = Depends(get_current_user)):
+async def track_event(event: AnalyticsEvent, user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
     try:
-        event_data = event.model_dump()
-        event_data["user_id"] = user.id
-        event_data["timestamp"] = datetime.now().isoformat()
-        
-        supabase.table("analytics_events").insert(event_data).execute()
-        
+        accepted = await ingest_analytics(db, [build_analytics_row(user.id, event)])
+        if not accepted:
+            return {"message": "Event tracking failed", "error": "Analytics buffer full"}
         return {"message": "Event tracked"}
     except Exception as e:
         # Don't fail on analytics errors
         return {"message": "Event tracking failed", "error": str(e)}
 
+@app.post("/api/analytics/events/batch")
+async def track_events_batch(batch: AnalyticsEventBatch, user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
+    if len(batch.events) > ANALYTICS_MAX_BATCH_EVENTS:
+        raise HTTPException(status_code=413, detail=f"A batch can hold at most {ANALYTICS_MAX_BATCH_EVENTS} events")
+    try:
+        rows = [build_analytics_row(user.id, event) for event in batch.events]
+        accepted = await ingest_analytics(db, rows) if rows else 0
+        return {"message": "Events tracked", "accepted": accepted, "dropped": len(rows) - accepted}
+    except Exception as e:
+        # Don't fail on analytics errors
+        return {"message": "Event tracking failed", "accepted": 0, "dropped": len(batch.events), "error": str(e)}
+
+async def load_analytics_rollups(db: DataSession, user_id: str, start_day: date) -> Dict[Tuple[str, str], int]:
+    """Daily counts keyed by (day, event_type), paged by day so long windows are not cut at the row limit."""
+    counts: Dict[Tuple[str, str], int] = {}
+    cursor: Optional[str] = None
+    strict = False
+    while True:
+        query = db.table("analytics_daily_rollups") \
+            .select("day, event_type, event_count") \
+            .eq("user_id", user_id)
+        if cursor is None:
+            query = query.gte("day", start_day.isoformat())
+        else:
+            query = query.gt("day", cursor) if strict else query.gte("day", cursor)
+        page = await query.order("day").limit(ANALYTICS_ROLLUP_PAGE_SIZE).execute()
+        for row in page.data:
+            counts[(str(row["day"])[:10], row["event_type"])] = row.get("event_count") or 0
+        if len(page.data) < ANALYTICS_ROLLUP_PAGE_SIZE:
+            return counts
+        # Pages overlap on their boundary day; rows are keyed, so re-reading them is harmless
+        last = str(page.data[-1]["day"])[:10]
+        strict = last == cursor
+        cursor = last
+
+
 @app.get("/api/analytics/summary")
-async def get_analytics_summary(days: int = 30, user = Depends(get_current_user)):
+async def get_analytics_summary(days: int = 30, series: bool = False, user = Depends(get_current_user), db: DataSession = Depends(get_data_session)):
     try:
-        start_date = (datetime.now() - timedelta(days=days)).isoformat()
-        
-        events = supabase.table("analytics_events").select("*").eq("user_id", user.id).gte("timestamp", start_date).execute()
+        # Rollup days are UTC dates, so the window has to be anchored in UTC as well
+        today = utc_today()
+        start_day = today - timedelta(days=max(days, 1) - 1)
+        rollups = await load_analytics_rollups(db, user.id, start_day)
         
-        event_counts = {}
-        for event in events.data:
-            event_type = event["event_type"]
-            event_counts[event_type] = event_counts.get(event_type, 0) + 1
+        event_counts: Dict[str, int] = {}
+        daily: Dict[str, Dict[str, int]] = {}
+        for (day, event_type), count in rollups.items():
+            event_counts[event_type] = event_counts.get(event_type, 0) + count
+            daily.setdefault(day, {})[event_type] = count
         
-        return {
-            "summary": {
-                "total_events": len(events.data),
-                "event_counts": event_counts,
-                "period_days": days
-            }
+        summary: Dict[str, Any] = {
+            "total_events": sum(event_counts.values()),
+            "event_counts": event_counts,
+            "period_days": days
         }
+        if series:
+            summary["series"] = [
+                {
+                    "date": day.isoformat(),
+                    "total": sum(daily.get(day.isoformat(), {}).values()),
+                    "event_counts": daily.get(day.isoformat(), {})
+                }
+                for day in (start_day + timedelta(days=offset) for offset in range((today - start_day).days + 1))
+            ]
+        return {"summary": summary}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -1518,6 +4999,24 @@ async def root():
         "docs": "/docs"
     }
 
+async def start_background_workers():
+    if DATA_BACKEND != "memory" and not SUPABASE_SERVICE_ROLE_KEY:
+        logger.warning("SUPABASE_SERVICE_ROLE_KEY not set; retention worker and analytics buffer disabled.")
+        return
+    if RETENTION_ENABLED:
+        retention_worker.start()
+    if ANALYTICS_BUFFER_ENABLED:
+        analytics_buffer.start()
+
+async def close_data_backend():
+    await retention_worker.stop()
+    if chat_turn_writes:
+        await asyncio.gather(*chat_turn_writes, return_exceptions=True)
+    if analytics_buffer.running:
+        await analytics_buffer.stop()
+    await data_backend.close()
+    decrypt_pool.shutdown(wait=False)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8001)
@@ -224,6 +224,15 @@ ALTER TABLE public.events
 
 CREATE INDEX IF NOT EXISTS idx_events_override_parent ON public.events(override_parent_id);
 
+-- Agenda range reads: events overlapping the requested range plus the recurring masters
+CREATE INDEX IF NOT EXISTS idx_events_user_ends ON public.events(user_id, ends_at);
+CREATE INDEX IF NOT EXISTS idx_events_user_masters ON public.events(user_id, starts_at)
+    WHERE frequency <> 'none' AND override_parent_id IS NULL;
+
+-- Agenda days are computed in the user's IANA time zone (NULL means UTC)
+ALTER TABLE user_profiles
+  ADD COLUMN IF NOT EXISTS timezone TEXT;
+
 -- Update assessments instrument constraint to include Self-Esteem
 ALTER TABLE IF EXISTS assessments
     DROP CONSTRAINT IF EXISTS assessments_instrument_check;
@@ -231,3 +240,167 @@ ALTER TABLE IF EXISTS assessments
 ALTER TABLE IF EXISTS assessments
     ADD CONSTRAINT assessments_instrument_check
     CHECK (instrument IN ('POMS', 'IDEP', 'BREVE', 'SELF_ESTEEM'));
+
+-- Delta sync (/api/sync): every synced table carries a server-stamped updated_at and leaves a
+-- tombstone when a row is deleted, so the app can ask for changes since its last cursor
+ALTER TABLE habit_tracking ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ DEFAULT NOW();
+ALTER TABLE session_completions ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ DEFAULT NOW();
+
+DROP POLICY IF EXISTS "Users can update own sessions" ON session_completions;
+CREATE POLICY "Users can update own sessions" ON session_completions
+    FOR UPDATE USING (auth.uid() = user_id);
+
+-- No foreign key: rows removed by an auth.users cascade still record their tombstone
+CREATE TABLE IF NOT EXISTS sync_tombstones (
+    id BIGSERIAL PRIMARY KEY,
+    user_id UUID NOT NULL,
+    table_name TEXT NOT NULL,
+    row_id UUID NOT NULL,
+    deleted_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+ALTER TABLE sync_tombstones ENABLE ROW LEVEL SECURITY;
+
+DROP POLICY IF EXISTS "Users can view own tombstones" ON sync_tombstones;
+CREATE POLICY "Users can view own tombstones" ON sync_tombstones
+    FOR SELECT USING (auth.uid() = user_id);
+
+CREATE INDEX IF NOT EXISTS idx_sync_tombstones_user_deleted ON sync_tombstones(user_id, deleted_at);
+CREATE INDEX IF NOT EXISTS idx_sync_tombstones_deleted ON sync_tombstones(deleted_at);
+
+CREATE OR REPLACE FUNCTION touch_updated_at() RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+BEGIN
+    NEW.updated_at := NOW();
+    RETURN NEW;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION record_sync_tombstone() RETURNS TRIGGER
+LANGUAGE plpgsql SECURITY DEFINER SET search_path = public AS $$
+BEGIN
+    INSERT INTO sync_tombstones (user_id, table_name, row_id) VALUES (OLD.user_id, TG_TABLE_NAME, OLD.id);
+    RETURN OLD;
+END;
+$$;
+
+DO $$
+DECLARE
+    synced TEXT;
+BEGIN
+    FOREACH synced IN ARRAY ARRAY['diary_entries', 'habits', 'habit_tracking', 'schedules', 'session_completions'] LOOP
+        EXECUTE format('DROP TRIGGER IF EXISTS touch_updated_at ON %I', synced);
+        EXECUTE format('CREATE TRIGGER touch_updated_at BEFORE INSERT OR UPDATE ON %I FOR EACH ROW EXECUTE FUNCTION touch_updated_at()', synced);
+        EXECUTE format('DROP TRIGGER IF EXISTS record_sync_tombstone ON %I', synced);
+        EXECUTE format('CREATE TRIGGER record_sync_tombstone AFTER DELETE ON %I FOR EACH ROW EXECUTE FUNCTION record_sync_tombstone()', synced);
+        EXECUTE format('CREATE INDEX IF NOT EXISTS %I ON %I (user_id, updated_at)', 'idx_' || synced || '_user_updated', synced);
+    END LOOP;
+END;
+$$;
+
+-- The database clock for /api/sync watermarks, since updated_at is stamped by NOW() here, not by the API server
+CREATE OR REPLACE FUNCTION sync_clock() RETURNS TIMESTAMPTZ
+LANGUAGE sql STABLE AS $$ SELECT NOW() $$;
+
+GRANT EXECUTE ON FUNCTION sync_clock() TO authenticated;
+
+-- Keyset pagination: each list endpoint walks one of these in (column, id) order per user
+CREATE INDEX IF NOT EXISTS idx_diary_entries_user_date_id ON diary_entries(user_id, date DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_session_completions_user_completed_id ON session_completions(user_id, completed_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_ai_recommendations_user_created_id ON ai_recommendations(user_id, created_at DESC, id DESC);
+
+-- Analytics daily rollups: per-user, per-day (UTC), per-event_type counters maintained at ingest so
+-- summaries never scan raw events. Users may only read them; counts change solely through the RPC below.
+CREATE TABLE IF NOT EXISTS analytics_daily_rollups (
+    user_id UUID NOT NULL REFERENCES auth.users(id) ON DELETE CASCADE,
+    day DATE NOT NULL,
+    event_type TEXT NOT NULL,
+    event_count INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (user_id, day, event_type)
+);
+
+ALTER TABLE analytics_daily_rollups ENABLE ROW LEVEL SECURITY;
+
+DROP POLICY IF EXISTS analytics_daily_rollups_crud ON analytics_daily_rollups;
+DROP POLICY IF EXISTS "Users can view own rollups" ON analytics_daily_rollups;
+CREATE POLICY "Users can view own rollups" ON analytics_daily_rollups
+    FOR SELECT USING (auth.uid() = user_id);
+
+-- Insert a batch of events and bump their rollups in one round trip (called by the backend's service role)
+CREATE OR REPLACE FUNCTION ingest_analytics_events(p_events JSONB) RETURNS INTEGER
+LANGUAGE plpgsql SECURITY INVOKER SET search_path = public AS $$
+BEGIN
+    WITH inserted AS (
+        INSERT INTO analytics_events (user_id, event_type, event_data, timestamp)
+        SELECT e.user_id, e.event_type, e.event_data, COALESCE(e.timestamp, NOW())
+        FROM jsonb_to_recordset(p_events) AS e(user_id UUID, event_type TEXT, event_data JSONB, timestamp TIMESTAMPTZ)
+        RETURNING user_id, event_type, timestamp
+    )
+    INSERT INTO analytics_daily_rollups AS r (user_id, day, event_type, event_count, updated_at)
+    SELECT user_id, (timestamp AT TIME ZONE 'utc')::DATE, event_type, COUNT(*), NOW()
+    FROM inserted
+    WHERE user_id IS NOT NULL
+    GROUP BY 1, 2, 3
+    ON CONFLICT (user_id, day, event_type)
+    DO UPDATE SET event_count = r.event_count + EXCLUDED.event_count, updated_at = NOW();
+
+    RETURN jsonb_array_length(p_events);
+END;
+$$;
+
+REVOKE EXECUTE ON FUNCTION ingest_analytics_events(JSONB) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION ingest_analytics_events(JSONB) TO service_role;
+
+-- Backfill from the raw events already stored
+INSERT INTO analytics_daily_rollups (user_id, day, event_type, event_count)
+SELECT user_id, (timestamp AT TIME ZONE 'utc')::DATE, event_type, COUNT(*)
+FROM analytics_events
+WHERE user_id IS NOT NULL
+GROUP BY 1, 2, 3
+ON CONFLICT (user_id, day, event_type) DO NOTHING;
+
+-- Habit tracking rows are upserted on (habit_id, date), so the habit itself must belong to the caller
+-- too. Replaces the original policies above; safe to re-run on databases that already have them.
+DROP POLICY IF EXISTS "Users can insert own habit tracking" ON habit_tracking;
+CREATE POLICY "Users can insert own habit tracking" ON habit_tracking
+    FOR INSERT WITH CHECK (
+        auth.uid() = user_id
+        AND EXISTS (SELECT 1 FROM habits WHERE habits.id = habit_id AND habits.user_id = auth.uid())
+    );
+
+DROP POLICY IF EXISTS "Users can update own habit tracking" ON habit_tracking;
+CREATE POLICY "Users can update own habit tracking" ON habit_tracking
+    FOR UPDATE USING (auth.uid() = user_id)
+    WITH CHECK (
+        auth.uid() = user_id
+        AND EXISTS (SELECT 1 FROM habits WHERE habits.id = habit_id AND habits.user_id = auth.uid())
+    );
+
+-- Leases for background jobs that every API worker starts but only one should run (retention).
+-- No policies: only the service role, which bypasses RLS, reads or takes them.
+CREATE TABLE IF NOT EXISTS worker_leases (
+    name TEXT PRIMARY KEY,
+    holder TEXT NOT NULL,
+    expires_at TIMESTAMPTZ NOT NULL
+);
+
+ALTER TABLE worker_leases ENABLE ROW LEVEL SECURITY;
+
+-- Takes or renews the lease; TRUE when p_holder holds it until now + p_ttl_seconds
+CREATE OR REPLACE FUNCTION try_acquire_worker_lease(p_name TEXT, p_holder TEXT, p_ttl_seconds INTEGER) RETURNS BOOLEAN
+LANGUAGE plpgsql SECURITY INVOKER SET search_path = public AS $$
+DECLARE
+    acquired TEXT;
+BEGIN
+    INSERT INTO worker_leases AS l (name, holder, expires_at)
+    VALUES (p_name, p_holder, NOW() + make_interval(secs => p_ttl_seconds))
+    ON CONFLICT (name) DO UPDATE SET holder = EXCLUDED.holder, expires_at = EXCLUDED.expires_at
+        WHERE l.holder = EXCLUDED.holder OR l.expires_at < NOW()
+    RETURNING holder INTO acquired;
+    RETURN acquired IS NOT NULL;
+END;
+$$;
+
+REVOKE EXECUTE ON FUNCTION try_acquire_worker_lease(TEXT, TEXT, INTEGER) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION try_acquire_worker_lease(TEXT, TEXT, INTEGER) TO service_role;
@@ -0,0 +1,22 @@
+"""Shared test setup: the server module runs against the in-memory data backend."""
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("SUPABASE_URL", "http://localhost")
+os.environ.setdefault("SUPABASE_ANON_KEY", "test")
+os.environ["DATA_BACKEND"] = "memory"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+
+@pytest.fixture
+def backend():
+    return server.InMemoryBackend()
+
+
+@pytest.fixture
+def db(backend):
+    return server.DataSession(backend, "token")
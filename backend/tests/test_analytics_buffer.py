@@ -0,0 +1,76 @@
+"""AnalyticsBuffer flushing, spill replay and client timestamp clamping."""
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+
+import server
+
+
+class FlakyBackend(server.InMemoryBackend):
+    """Fails the ingest RPC with the queued errors before behaving normally."""
+
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = list(failures)
+
+    async def call_rpc(self, function, params, access_token):
+        if function == "ingest_analytics_events" and self.failures:
+            raise self.failures.pop(0)
+        return await super().call_rpc(function, params, access_token)
+
+
+def make_buffer(backend, tmp_path, policy="drop"):
+    return server.AnalyticsBuffer(server.DataSession(backend, "service"), 2, 60, 100, policy,
+                                  str(tmp_path / "spill.jsonl"))
+
+
+def event(n):
+    return {"user_id": "u1", "event_type": f"e{n}", "event_data": {}, "timestamp": "2024-05-01T10:00:00+00:00"}
+
+
+def test_rejected_batch_is_dropped_and_later_batches_still_flush(tmp_path):
+    backend = FlakyBackend([server.DataAccessError(400, "invalid input syntax for type uuid")])
+    buffer = make_buffer(backend, tmp_path)
+    buffer.enqueue([event(n) for n in range(4)])
+
+    written = asyncio.run(buffer.flush())
+
+    assert written == 2
+    assert buffer.rejected == 2
+    assert [row["event_type"] for row in backend.tables["analytics_events"]] == ["e2", "e3"]
+
+
+def test_server_errors_requeue_the_batch(tmp_path):
+    backend = FlakyBackend([server.DataAccessError(503, "unavailable")])
+    buffer = make_buffer(backend, tmp_path)
+    buffer.enqueue([event(n) for n in range(4)])
+
+    assert asyncio.run(buffer.flush()) == 0
+    assert buffer.stats()["buffered"] == 4
+    assert asyncio.run(buffer.flush()) == 4
+    assert buffer.rejected == 0
+
+
+def test_spilled_events_are_replayed_after_a_flush(tmp_path):
+    backend = FlakyBackend([])
+    buffer = make_buffer(backend, tmp_path, policy="spill")
+    buffer._overflow([event(1), event(2)])
+
+    asyncio.run(buffer.flush())
+
+    assert [row["event_type"] for row in buffer._pending] == ["e1", "e2"]
+    assert buffer.spilled == 0
+    assert not os.path.exists(buffer.spill_path)
+    assert not os.path.exists(buffer.spill_path + ".replay")
+
+
+def test_client_timestamps_are_clamped_around_now():
+    now = server.utc_now()
+    future = server.clamp_event_timestamp(now + timedelta(days=400))
+    ancient = server.clamp_event_timestamp(datetime(2001, 1, 1))
+    recent = now - timedelta(hours=1)
+
+    assert future <= server.utc_now() + timedelta(seconds=server.ANALYTICS_MAX_CLOCK_SKEW_SECONDS)
+    assert ancient >= now - timedelta(hours=server.ANALYTICS_MAX_EVENT_AGE_HOURS)
+    assert ancient.tzinfo is not None
+    assert server.clamp_event_timestamp(recent) == recent.astimezone(timezone.utc)
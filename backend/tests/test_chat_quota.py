@@ -0,0 +1,34 @@
+"""ChatQuotaTracker seeding under concurrent requests for the same user."""
+import asyncio
+
+import server
+
+
+class CountingBackend(server.InMemoryBackend):
+    def __init__(self):
+        super().__init__()
+        self.selects = 0
+
+    async def execute(self, query, access_token):
+        if query.table == "chat_messages" and query.method == "select":
+            self.selects += 1
+            await asyncio.sleep(0.01)
+        return await super().execute(query, access_token)
+
+
+def test_concurrent_seeds_share_one_lock_and_one_count():
+    backend = CountingBackend()
+    today = server.utc_now().isoformat()
+    backend.tables["chat_messages"] = [
+        {"id": str(index), "user_id": "u1", "role": "user", "created_at": today} for index in range(3)
+    ]
+    db = server.DataSession(backend, "token")
+    tracker = server.ChatQuotaTracker(limit=20, max_users=10, resync_seconds=600)
+
+    async def scenario():
+        return await asyncio.gather(*(tracker.usage(db, "u1") for _ in range(5)))
+
+    assert asyncio.run(scenario()) == [3] * 5
+    assert backend.selects == 1
+    assert tracker._seed_locks == {}
+    assert tracker._seed_waiters == {}
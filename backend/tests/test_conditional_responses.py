@@ -0,0 +1,112 @@
+"""ETag / If-None-Match handling of polled read endpoints and its invalidation on writes."""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+
+BLOCK = {"day_of_week": 1, "start_time": "08:00", "end_time": "10:00", "type": "academic", "title": "Cálculo"}
+
+
+class CountingBackend(server.InMemoryBackend):
+    def __init__(self):
+        super().__init__()
+        self.reads = 0
+
+    async def execute(self, query, access_token):
+        if query.method == "select":
+            self.reads += 1
+        return await super().execute(query, access_token)
+
+
+@pytest.fixture
+def client(request):
+    backend = CountingBackend()
+    user = SimpleNamespace(id=f"user-{request.node.name}")
+    server.app.dependency_overrides[server.get_current_user] = lambda: user
+    server.app.dependency_overrides[server.get_data_session] = lambda: server.DataSession(backend, "token")
+    yield TestClient(server.app), backend
+    server.app.dependency_overrides.clear()
+
+
+def test_matching_etag_is_a_304_without_a_query(client):
+    http, backend = client
+    first = http.get("/api/schedules")
+    etag = first.headers["ETag"]
+    reads = backend.reads
+
+    second = http.get("/api/schedules", headers={"If-None-Match": etag})
+
+    assert first.status_code == 200
+    assert first.headers["Cache-Control"] == "private, no-cache"
+    assert second.status_code == 304
+    assert second.headers["ETag"] == etag
+    assert second.content == b""
+    assert backend.reads == reads
+
+
+@pytest.mark.parametrize("header", ['W/{etag}', '*', '"stale", {etag}', '"stale" , W/{etag}'])
+def test_weak_wildcard_and_list_forms_match(client, header):
+    http, _ = client
+    etag = http.get("/api/schedules").headers["ETag"]
+
+    assert http.get("/api/schedules", headers={"If-None-Match": header.format(etag=etag)}).status_code == 304
+
+
+def test_other_etags_get_the_body(client):
+    http, _ = client
+    http.get("/api/schedules")
+
+    response = http.get("/api/schedules", headers={"If-None-Match": '"stale", W/"other"'})
+
+    assert response.status_code == 200
+    assert response.json() == {"schedules": []}
+
+
+def test_writes_invalidate_the_etag(client):
+    http, _ = client
+    etag = http.get("/api/schedules").headers["ETag"]
+
+    created = http.post("/api/schedules", json=BLOCK)
+    after_create = http.get("/api/schedules", headers={"If-None-Match": etag})
+    schedule_id = created.json()["schedule"]["id"]
+    after_update = http.put(f"/api/schedules/{schedule_id}", json={"title": "Álgebra"})
+    stale = after_create.headers["ETag"]
+    refreshed = http.get("/api/schedules", headers={"If-None-Match": stale})
+
+    assert created.status_code == 200 and after_update.status_code == 200
+    assert after_create.status_code == 200
+    assert [row["title"] for row in after_create.json()["schedules"]] == ["Cálculo"]
+    assert refreshed.status_code == 200
+    assert [row["title"] for row in refreshed.json()["schedules"]] == ["Álgebra"]
+    assert http.get("/api/schedules", headers={"If-None-Match": refreshed.headers["ETag"]}).status_code == 304
+
+
+def test_etag_built_during_a_write_is_not_remembered():
+    user_id = "user-racing-write"
+
+    async def build():
+        server.invalidate_etags(user_id, "schedules")
+        return {"schedules": []}
+
+    response = asyncio.run(server.conditional_json(None, user_id, "schedules", build))
+
+    assert response.status_code == 200
+    assert server.etag_cache.get((user_id, "schedules")) is None
+
+
+def test_variant_change_skips_the_cached_etag():
+    user_id = "user-variant"
+    calls = []
+
+    async def build():
+        calls.append(1)
+        return {"day": len(calls)}
+
+    first = asyncio.run(server.conditional_json(None, user_id, "habits", build, variant="2024-05-01"))
+    second = asyncio.run(server.conditional_json(first.headers["ETag"], user_id, "habits", build, variant="2024-05-02"))
+
+    assert second.status_code == 200
+    assert len(calls) == 2
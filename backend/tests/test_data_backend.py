@@ -0,0 +1,143 @@
+"""InMemoryBackend and DataSession, the offline stand-in for PostgREST."""
+import asyncio
+
+import pytest
+
+import server
+
+
+def run(query):
+    return asyncio.run(query.execute())
+
+
+def seeded_session():
+    backend = server.InMemoryBackend()
+    backend.tables["diary_entries"] = [
+        {"id": "a", "user_id": "u1", "date": "2024-05-01", "mood": 2, "notes": "Día largo"},
+        {"id": "b", "user_id": "u1", "date": "2024-05-02", "mood": 4, "notes": None},
+        {"id": "c", "user_id": "u1", "date": "2024-05-02", "mood": 5, "notes": "Entreno"},
+        {"id": "d", "user_id": "u2", "date": "2024-05-03", "mood": 3, "notes": None},
+    ]
+    return server.DataSession(backend, "token")
+
+
+def ids(result):
+    return [row["id"] for row in result.data]
+
+
+def test_data_backend_is_abstract():
+    with pytest.raises(TypeError):
+        server.DataBackend()
+
+
+def test_comparison_and_membership_filters():
+    db = seeded_session()
+    entries = db.table("diary_entries")
+
+    assert ids(run(entries.select("id").eq("user_id", "u1").gte("date", "2024-05-02").order("id"))) == ["b", "c"]
+    assert ids(run(db.table("diary_entries").select("id").neq("user_id", "u1"))) == ["d"]
+    assert ids(run(db.table("diary_entries").select("id").in_("id", ["a", "d"]).order("id"))) == ["a", "d"]
+    assert ids(run(db.table("diary_entries").select("id").is_("notes", None).order("id"))) == ["b", "d"]
+    assert ids(run(db.table("diary_entries").select("id").ilike("notes", "%ENTRE%"))) == ["c"]
+
+
+def test_keyset_after_orders_ties_by_id():
+    db = seeded_session()
+
+    ascending = db.table("diary_entries").select("id").keyset_after("date", "2024-05-02", "id", "b") \
+        .order("date").order("id")
+    descending = db.table("diary_entries").select("id").keyset_after("date", "2024-05-02", "id", "c", desc=True) \
+        .order("date", desc=True).order("id", desc=True)
+
+    assert ids(run(ascending)) == ["c", "d"]
+    assert ids(run(descending)) == ["b", "a"]
+
+
+def test_projection_order_limit_and_count():
+    db = seeded_session()
+
+    result = run(db.table("diary_entries").select("id, mood", count="exact").eq("user_id", "u1").order("mood", desc=True).limit(2))
+
+    assert result.data == [{"id": "c", "mood": 5}, {"id": "b", "mood": 4}]
+    assert result.count == 3
+
+
+def test_upsert_merges_on_unique_key_and_keeps_created_at():
+    db = seeded_session()
+    first = run(db.table("habit_tracking").upsert({"habit_id": "h", "user_id": "u1", "date": "2024-05-01", "completed": False}))
+    second = run(db.table("habit_tracking").upsert({"habit_id": "h", "user_id": "u1", "date": "2024-05-01", "completed": True}))
+
+    rows = db.backend.tables["habit_tracking"]
+    assert len(rows) == 1
+    assert rows[0]["completed"] is True
+    assert second.data[0]["id"] == first.data[0]["id"]
+    assert second.data[0]["created_at"] == first.data[0]["created_at"]
+
+
+def test_upsert_honours_explicit_conflict_target_and_insert_rejects_duplicates():
+    db = seeded_session()
+    run(db.table("schedules").upsert({"id": "s1", "user_id": "u1", "title": "Cálculo"}, on_conflict="id"))
+    run(db.table("schedules").upsert({"id": "s1", "user_id": "u1", "title": "Álgebra"}, on_conflict="id"))
+
+    assert [row["title"] for row in db.backend.tables["schedules"]] == ["Álgebra"]
+    with pytest.raises(server.DataAccessError) as error:
+        run(db.table("diary_entries").insert({"user_id": "u1", "date": "2024-05-01", "mood": 1}))
+    assert error.value.status_code == 409
+
+
+def test_delete_of_versioned_table_leaves_tombstone():
+    db = seeded_session()
+
+    run(db.table("diary_entries").delete().eq("id", "a"))
+
+    assert ids(run(db.table("diary_entries").select("id").order("id"))) == ["b", "c", "d"]
+    tombstones = db.backend.tables["sync_tombstones"]
+    assert [(row["table_name"], row["row_id"], row["user_id"]) for row in tombstones] == [("diary_entries", "a", "u1")]
+
+
+def test_rpcs_run_registered_handlers_and_unknown_ones_404():
+    db = seeded_session()
+    db.backend.tables["chats"] = [{"id": "chat", "user_id": "u1", "message_count": 1}]
+    db.backend.register_rpc("echo", lambda backend, params: [params])
+
+    total = asyncio.run(db.rpc("append_chat_messages", {
+        "p_chat_id": "chat",
+        "p_messages": [{"user_id": "u1", "role": "user", "content": "hola"}],
+        "p_preview": "hola",
+    }).execute())
+
+    assert total.data == [2]
+    assert db.backend.tables["chats"][0]["last_message_preview"] == "hola"
+    assert asyncio.run(db.rpc("echo", {"x": 1}).execute()).data == [{"x": 1}]
+    with pytest.raises(server.DataAccessError) as error:
+        asyncio.run(db.rpc("missing").execute())
+    assert error.value.status_code == 404
+
+
+def test_in_filter_quotes_reserved_characters():
+    assert server.encode_filter_value("in", ["a", "b,c", "(x)", 'say "hi"']) == \
+        'in.(a,"b,c","(x)","say \\"hi\\"")'
+
+
+def test_postgrest_keyset_sends_index_bound_next_to_the_or():
+    class CapturingBackend(server.PostgrestBackend):
+        async def _send(self, method, url, params, headers, body=None):
+            self.sent = params
+            return server.httpx.Response(200, json=[])
+
+    backend = CapturingBackend("http://localhost", "key")
+    db = server.DataSession(backend, "token")
+    query = db.table("session_completions").select("id, completed_at").eq("user_id", "u1") \
+        .keyset_after("completed_at", "2024-05-02T10:00:00+00:00", "id", "b", desc=True) \
+        .order("completed_at", desc=True).order("id", desc=True).limit(21)
+
+    run(query)
+
+    assert backend.sent == [
+        ("user_id", "eq.u1"),
+        ("completed_at", "lte.2024-05-02T10:00:00+00:00"),
+        ("or", '(completed_at.lt."2024-05-02T10:00:00+00:00",and(completed_at.eq."2024-05-02T10:00:00+00:00",id.lt."b"))'),
+        ("select", "id, completed_at"),
+        ("order", "completed_at.desc,id.desc"),
+        ("limit", "21"),
+    ]
@@ -0,0 +1,97 @@
+"""DiaryMetrics sliding 7/30/90-day windows checked against a full recomputation."""
+import asyncio
+import random
+from datetime import date, timedelta
+
+import server
+
+START = date(2024, 1, 1)
+
+
+def brute_window(entries, today, width):
+    """window(width) recomputed from every entry, with the same rounding."""
+    def select(back):
+        last = today.toordinal() - back * width
+        return {ordinal: values for ordinal, values in entries.items() if last - width < ordinal <= last}
+
+    current, previous = select(0), select(1)
+    summary = {"entries_count": len(current)}
+    count = len(current)
+    xs = {ordinal: ordinal - server.DIARY_EPOCH for ordinal in current}
+    sx, sxx = sum(xs.values()), sum(x * x for x in xs.values())
+    denominator = count * sxx - sx * sx
+    for index, metric in enumerate(server.DIARY_METRICS):
+        sy = sum(values[index] for values in current.values())
+        sxy = sum(xs[ordinal] * values[index] for ordinal, values in current.items())
+        average = sy / count if count else None
+        previous_average = sum(values[index] for values in previous.values()) / len(previous) if previous else None
+        summary[f"avg_{metric}"] = round(average, 2) if count else None
+        summary[f"delta_{metric}"] = round(average - previous_average, 2) if count and previous else None
+        summary[f"slope_{metric}"] = round((count * sxy - sx * sy) / denominator, 3) if count >= 2 and denominator else None
+    return summary
+
+
+def random_values(rng):
+    return tuple(float(rng.randint(1, 5)) for _ in server.DIARY_METRICS)
+
+
+def test_windows_follow_writes_and_advances_of_any_length():
+    rng = random.Random(3)
+    today = START
+    metrics = server.DiaryMetrics(today, 0)
+    entries = {}
+    for _ in range(400):
+        roll = rng.random()
+        if roll < 0.6:
+            day = today - timedelta(days=rng.randint(-3, 200))
+            values = random_values(rng)
+            metrics.set_entry(day, values)
+            if day.toordinal() > today.toordinal() - server.DIARY_HORIZON_DAYS:
+                entries[day.toordinal()] = values
+        else:
+            # Mostly single days, sometimes past a whole window or the whole horizon
+            step = rng.choice([1, 1, 1, 2, 8, 31, 95, 200, 400])
+            today += timedelta(days=step)
+            metrics.advance(today)
+
+        for width in server.DIARY_WINDOWS:
+            assert metrics.window(width) == brute_window(entries, today, width)
+
+
+def test_advance_backwards_is_ignored():
+    metrics = server.DiaryMetrics(START, 0)
+    metrics.set_entry(START, (4.0, 3.0, 2.0))
+
+    metrics.advance(START - timedelta(days=10))
+
+    assert metrics.today == START
+    assert metrics.window(7)["entries_count"] == 1
+
+
+def test_slope_of_a_steady_rise():
+    metrics = server.DiaryMetrics(START, 0)
+    for offset in range(5):
+        metrics.set_entry(START - timedelta(days=offset), (5.0 - offset, 3.0, 1.0 + offset * 0.5))
+
+    week = metrics.window(7)
+
+    assert (week["slope_mood"], week["slope_energy"], week["slope_stress"]) == (1.0, 0.0, -0.5)
+    assert week["delta_mood"] is None
+    assert metrics.window(30)["avg_mood"] == 3.0
+
+
+def test_index_rebuilds_from_rows_and_patches_on_record(backend, db):
+    today = server.utc_today()
+    backend.tables["diary_entries"] = [
+        {"id": "a", "user_id": "u1", "date": (today - timedelta(days=1)).isoformat(), "mood": 2, "energy": 3, "stress": 4},
+        {"id": "b", "user_id": "u1", "date": (today - timedelta(days=400)).isoformat(), "mood": 5, "energy": 5, "stress": 5},
+    ]
+    index = server.DiaryMetricsIndex(10, 900)
+
+    metrics = asyncio.run(index.get(db, "u1"))
+    assert metrics.today == today
+    assert metrics.window(7)["entries_count"] == 1
+
+    index.record("u1", {"date": today.isoformat(), "mood": 4, "energy": 3, "stress": 2})
+    assert asyncio.run(index.get(db, "u1")).window(7)["avg_mood"] == 3.0
+    assert index.rebuilds == 1
@@ -0,0 +1,33 @@
+"""Free slot computation: local sleep windows and cache keys that follow sleep_prefs edits."""
+import asyncio
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+
+import server
+
+MADRID = ZoneInfo("Europe/Madrid")
+
+
+def test_sleep_ends_at_local_wake_time():
+    prefs = {"target_wake_time": "07:00", "cycles": 5}
+    start = server.local_day_start(datetime(2024, 7, 1).date(), MADRID)
+    end = server.local_day_start(datetime(2024, 7, 2).date(), MADRID)
+
+    windows = server.sleep_windows(prefs, start, end, MADRID)
+
+    assert (datetime(2024, 7, 1, 5, tzinfo=timezone.utc) - server.SLEEP_CYCLE * 5,
+            datetime(2024, 7, 1, 5, tzinfo=timezone.utc)) in windows
+
+
+def test_free_slot_cache_follows_sleep_pref_changes(backend, db):
+    server.free_slot_cache.clear()
+    backend.tables["sleep_prefs"] = [{"user_id": "u1", "target_wake_time": "07:00", "cycles": 5, "buffer_minutes": 0}]
+    start = server.local_day_start(datetime(2024, 7, 1).date(), MADRID)
+    end = server.local_day_start(datetime(2024, 7, 2).date(), MADRID)
+
+    before = asyncio.run(server.find_free_slots(db, "u1", start, end, zone=MADRID))
+    backend.tables["sleep_prefs"][0]["target_wake_time"] = "09:00"
+    after = asyncio.run(server.find_free_slots(db, "u1", start, end, zone=MADRID))
+
+    assert [slot[0] for slot in before] == [datetime(2024, 7, 1, 5, tzinfo=timezone.utc)]
+    assert datetime(2024, 7, 1, 7, tzinfo=timezone.utc) in [slot[0] for slot in after]
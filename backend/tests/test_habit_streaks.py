@@ -0,0 +1,116 @@
+"""HabitHistory bitset streaks and windows checked against a day-by-day reference."""
+import random
+from datetime import date, timedelta
+
+import pytest
+
+import server
+
+TODAY = date(2024, 6, 12)  # a Wednesday
+
+
+def reference_streaks(habit, completed_days, first, today):
+    """Current and longest streak by walking every slot from `first` to `today`."""
+    slots = []
+    if habit.get("frequency") != "weekly":
+        day = first
+        while day <= today:
+            slots.append(day in completed_days)
+            day += timedelta(days=1)
+    elif habit.get("target_days"):
+        day = first
+        while day <= today:
+            if day.weekday() in habit["target_days"]:
+                slots.append(day in completed_days)
+            day += timedelta(days=1)
+    else:
+        monday = first - timedelta(days=first.weekday())
+        while monday <= today:
+            week = [monday + timedelta(days=offset) for offset in range(7)]
+            slots.append(any(day in completed_days and day <= today for day in week))
+            monday += timedelta(days=7)
+    # Only the slot that contains today may still be open
+    open_today = habit.get("frequency") != "weekly" or not habit.get("target_days") or today.weekday() in habit["target_days"]
+    if slots and open_today and not slots[-1]:
+        slots.pop()
+    longest = run = 0
+    for done in slots:
+        run = run + 1 if done else 0
+        longest = max(longest, run)
+    return run, longest
+
+
+def history_of(days, today=TODAY):
+    history = server.HabitHistory(today, 0)
+    for day in days:
+        history.set_day(day, True)
+    return history
+
+
+@pytest.mark.parametrize("habit", [
+    {"frequency": "daily"},
+    {"frequency": "weekly", "target_days": [0, 2, 4]},
+    {"frequency": "weekly", "target_days": [6]},
+    {"frequency": "weekly"},
+])
+def test_streaks_match_a_day_by_day_walk(habit):
+    rng = random.Random(7)
+    for _ in range(60):
+        span = rng.randint(1, 400)
+        density = rng.random()
+        first = TODAY - timedelta(days=span - 1)
+        completed = {first + timedelta(days=offset) for offset in range(span) if rng.random() < density}
+        days = list(completed)
+        rng.shuffle(days)
+        history = history_of(days)
+
+        current, longest, _ = history.streaks(habit, TODAY)
+
+        assert (current, longest) == reference_streaks(habit, completed, first, TODAY)
+
+
+def test_daily_streak_carries_across_64_day_words():
+    days = [TODAY - timedelta(days=offset) for offset in range(130)]
+    history = history_of(days)
+
+    assert history.streaks({"frequency": "daily"}, TODAY)[:2] == (130, 130)
+    assert history.completed_between(TODAY - timedelta(days=69), TODAY) == 70
+
+
+def test_open_slot_today_does_not_break_the_streak():
+    history = history_of([TODAY - timedelta(days=offset) for offset in range(1, 4)])
+
+    assert history.streaks({"frequency": "daily"}, TODAY)[:2] == (3, 3)
+    history.set_day(TODAY - timedelta(days=2), False)
+    assert history.streaks({"frequency": "daily"}, TODAY)[:2] == (1, 1)
+
+
+def test_earlier_days_shift_the_origin_without_moving_later_bits():
+    history = history_of([TODAY])
+    origin = history.origin
+
+    history.set_day(TODAY - timedelta(days=200), True)
+
+    assert history.origin.weekday() == 0
+    assert history.origin < origin
+    assert history.completed_between(TODAY, TODAY) == 1
+    assert history.completed_between(TODAY - timedelta(days=200), TODAY - timedelta(days=200)) == 1
+    assert history.completed_between(TODAY - timedelta(days=199), TODAY - timedelta(days=1)) == 0
+
+
+def test_weekly_target_days_ignore_other_weekdays():
+    habit = {"frequency": "weekly", "target_days": [0, 2]}  # Monday and Wednesday
+    monday = TODAY - timedelta(days=TODAY.weekday())
+    history = history_of([monday, monday - timedelta(days=6), monday - timedelta(days=7), monday - timedelta(days=12)])
+
+    # Wednesday (today) is still open; last Wednesday was missed, Tuesday's completion does not count
+    assert history.streaks(habit, TODAY)[:2] == (1, 2)
+    assert history.summary(habit, TODAY)["streak_unit"] == "days"
+
+
+def test_weekly_without_target_days_counts_weeks():
+    habit = {"frequency": "weekly"}
+    monday = TODAY - timedelta(days=TODAY.weekday())
+    history = history_of([monday - timedelta(days=3), monday - timedelta(days=10), monday - timedelta(days=16)])
+
+    assert history.streaks(habit, TODAY) == (3, 3, "weeks")
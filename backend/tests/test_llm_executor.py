@@ -0,0 +1,181 @@
+"""LLMExecutor deadlines, retries and circuit breaker, driven by the fault simulator."""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import server
+
+
+def make_executor(simulator=None, timeout=0.05, max_retries=0, failure_threshold=2, reset_seconds=0.05):
+    return server.LLMExecutor(
+        None, 4, timeout, max_retries, 0, simulator,
+        failure_threshold=failure_threshold, reset_seconds=reset_seconds,
+    )
+
+
+async def slow(client):
+    await asyncio.sleep(1)
+
+
+def open_breaker(executor, model="m"):
+    executor.simulator = server.LLMFaultSimulator(failure_rate=1.0)
+    for _ in range(executor.failure_threshold):
+        with pytest.raises(server.SimulatedLLMFault):
+            asyncio.run(executor.run(model, lambda client: "ok"))
+    executor.simulator = server.LLMFaultSimulator()
+    return executor.breaker(model)
+
+
+def test_deadline_counts_as_a_failure():
+    executor = make_executor()
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(executor.run("m", slow))
+
+    assert executor.breaker("m").failures == 1
+
+
+def test_retries_transient_faults_until_success():
+    calls = []
+
+    def flaky(client):
+        calls.append(1)
+        if len(calls) < 3:
+            raise server.SimulatedLLMFault("boom")
+        return "ok"
+
+    executor = make_executor(max_retries=2)
+
+    assert asyncio.run(executor.run("m", flaky)) == "ok"
+    assert len(calls) == 3
+    assert executor.breaker("m").state == "closed"
+
+
+def test_non_retryable_errors_are_raised_once_and_do_not_trip_the_breaker():
+    calls = []
+
+    def broken(client):
+        calls.append(1)
+        raise ValueError("bad request")
+
+    executor = make_executor(max_retries=2)
+
+    with pytest.raises(ValueError):
+        asyncio.run(executor.run("m", broken))
+    assert len(calls) == 1
+    assert executor.breaker("m").failures == 0
+
+
+def test_open_breaker_rejects_calls_then_lets_one_trial_through():
+    executor = make_executor()
+    breaker = open_breaker(executor)
+
+    assert breaker.state == "open"
+    with pytest.raises(server.CircuitOpenError):
+        asyncio.run(executor.run("m", lambda client: "ok"))
+
+    asyncio.run(asyncio.sleep(0.06))
+    assert breaker.state == "half_open"
+    assert breaker.allow() is True
+    assert breaker.allow() is False
+    breaker.record_success()
+
+    assert breaker.state == "closed"
+    assert asyncio.run(executor.run("m", lambda client: "ok")) == "ok"
+
+
+def test_failed_trial_reopens_the_breaker():
+    executor = make_executor()
+    breaker = open_breaker(executor)
+    asyncio.run(asyncio.sleep(0.06))
+
+    executor.simulator = server.LLMFaultSimulator(failure_rate=1.0)
+    with pytest.raises(server.SimulatedLLMFault):
+        asyncio.run(executor.run("m", lambda client: "ok"))
+
+    assert breaker.state == "open"
+
+
+def test_cancelled_trial_frees_the_half_open_slot():
+    executor = make_executor(timeout=5)
+    breaker = open_breaker(executor)
+    asyncio.run(asyncio.sleep(0.06))
+
+    async def cancel_trial():
+        task = asyncio.create_task(executor.run("m", slow))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_trial())
+
+    assert breaker.state == "half_open"
+    assert asyncio.run(executor.run("m", lambda client: "ok")) == "ok"
+    assert breaker.state == "closed"
+
+
+def test_stream_closed_early_frees_the_half_open_slot():
+    async def events(client):
+        for index in range(3):
+            yield SimpleNamespace(index=index)
+
+    executor = make_executor()
+    breaker = open_breaker(executor)
+    asyncio.run(asyncio.sleep(0.06))
+
+    async def read_one_and_disconnect():
+        stream = executor.stream("m", events)
+        first = await stream.__anext__()
+        await stream.aclose()
+        return first.index
+
+    assert asyncio.run(read_one_and_disconnect()) == 0
+    assert breaker.allow() is True
+
+
+def test_stream_retries_before_the_first_event():
+    attempts = []
+
+    async def events(client):
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise server.SimulatedLLMFault("boom")
+        yield "a"
+        yield "b"
+
+    executor = make_executor(max_retries=1)
+
+    async def collect():
+        return [event async for event in executor.stream("m", events)]
+
+    assert asyncio.run(collect()) == ["a", "b"]
+    assert executor.breaker("m").state == "closed"
+
+
+def test_recommendations_use_the_heuristic_when_mocked(monkeypatch, backend, db):
+    monkeypatch.setattr(server, "USE_MOCK_AI", True)
+    backend.tables["user_profiles"] = [{"user_id": "u-mock", "sport": "natación"}]
+
+    result = asyncio.run(server.generate_recommendations(
+        server.AIRecommendationRequest(), user=SimpleNamespace(id="u-mock"), db=db,
+    ))
+
+    assert "Pasos recomendados:" in result["recommendation"]
+    assert backend.tables["ai_recommendations"][0]["model"] == "mock-2024.11"
+
+
+def test_recommendations_fall_back_while_the_breaker_is_open(monkeypatch, backend, db):
+    executor = make_executor()
+    executor.client = object()
+    open_breaker(executor, "gpt-4o")
+    monkeypatch.setattr(server, "USE_MOCK_AI", False)
+    monkeypatch.setattr(server, "llm_executor", executor)
+
+    result = asyncio.run(server.generate_recommendations(
+        server.AIRecommendationRequest(), user=SimpleNamespace(id="u-open"), db=db,
+    ))
+
+    assert "Pasos recomendados:" in result["recommendation"]
+    assert backend.tables["ai_recommendations"][0]["model"] == "fallback-heuristic"
@@ -0,0 +1,122 @@
+"""Recurrence expansion, mirroring Tests/AgendaRecurrenceTests.swift on iOS."""
+import asyncio
+from datetime import date, datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+import server
+
+
+def make_date(year, month, day, hour, minute=0):
+    return datetime(year, month, day, hour, minute, tzinfo=timezone.utc)
+
+
+def master_row(start, end, frequency, repeat_days, end_date, event_id="master"):
+    return {
+        "id": event_id,
+        "title": "Entrenamiento",
+        "kind": "entreno",
+        "starts_at": start.isoformat(),
+        "ends_at": end.isoformat(),
+        "notes": "Notas",
+        "frequency": frequency,
+        "repeat_days": repeat_days,
+        "end_date": end_date.isoformat() if end_date else None,
+    }
+
+
+def expand(row, window_start, window_end, zone=timezone.utc):
+    return server.expand_recurrence(server.normalize_event(row), window_start, window_end, zone)
+
+
+def test_weekly_recurrence_generates_occurrences():
+    start = make_date(2024, 4, 1, 9)
+    row = master_row(start, make_date(2024, 4, 1, 10), "weekly", ["Mon", "Wed"], start + timedelta(weeks=2))
+
+    generated = expand(row, start, start + timedelta(days=90))
+
+    assert len(generated) == 4
+    assert all(occurrence.weekday() in (0, 2) for occurrence in generated)
+    assert generated[0] == make_date(2024, 4, 3, 9)
+
+
+def test_biweekly_recurrence_skips_alternate_weeks():
+    start = make_date(2024, 6, 4, 18)
+    row = master_row(start, make_date(2024, 6, 4, 19), "biweekly", ["Tue"], start + timedelta(weeks=6))
+
+    generated = expand(row, start, start + timedelta(days=90))
+
+    assert len(generated) == 3
+    for index, occurrence in enumerate(generated):
+        assert occurrence - start == timedelta(weeks=2) * (index + 1)
+
+
+def test_monthly_recurrence_clamps_to_month_end():
+    start = make_date(2024, 1, 31, 7)
+    row = master_row(start, make_date(2024, 1, 31, 8), "monthly", [], make_date(2024, 4, 30, 23))
+
+    generated = expand(row, start, start + timedelta(days=120))
+
+    assert generated == [make_date(2024, 2, 29, 7), make_date(2024, 3, 31, 7), make_date(2024, 4, 30, 7)]
+
+
+def test_range_query_applies_overrides_and_spans_months():
+    start = make_date(2024, 4, 29, 9)
+    master = master_row(start, make_date(2024, 4, 29, 10), "daily", [], None)
+    moved = {
+        "id": "override",
+        "title": "Entrenamiento (movido)",
+        "kind": "entreno",
+        "starts_at": make_date(2024, 5, 1, 17).isoformat(),
+        "ends_at": make_date(2024, 5, 1, 18).isoformat(),
+        "override_parent_id": "master",
+        "is_override": True,
+    }
+    agenda = server.UserAgenda([master, moved])
+
+    occurrences = agenda.occurrences(make_date(2024, 4, 29, 0), make_date(2024, 5, 3, 0))
+
+    assert [occurrence["starts_at"] for occurrence in occurrences] == [
+        make_date(2024, 4, 29, 9),
+        make_date(2024, 4, 30, 9),
+        make_date(2024, 5, 1, 17),
+        make_date(2024, 5, 2, 9),
+    ]
+    assert occurrences[2]["is_override"] and not occurrences[2]["generated"]
+    assert all(occurrence["master_id"] == "master" for occurrence in occurrences)
+
+
+def test_evening_series_keeps_local_weekday_and_wall_clock():
+    new_york = ZoneInfo("America/New_York")
+    # Tuesday 20:00 in New York is already Wednesday in UTC; DST starts on 2024-03-10
+    start = datetime(2024, 3, 5, 20, tzinfo=new_york)
+    row = master_row(start, start + timedelta(hours=1), "biweekly", ["Tue"], start + timedelta(weeks=4))
+
+    generated = expand(row, start, start + timedelta(days=60), new_york)
+
+    assert [occurrence.astimezone(new_york) for occurrence in generated] == [
+        datetime(2024, 3, 19, 20, tzinfo=new_york),
+        datetime(2024, 4, 2, 20, tzinfo=new_york),
+    ]
+    assert generated[0] == datetime(2024, 3, 20, 0, tzinfo=timezone.utc)
+
+
+def test_agenda_load_is_bounded_by_range_but_keeps_masters(backend, db):
+    old_master = master_row(make_date(2024, 1, 1, 9), make_date(2024, 1, 1, 10), "weekly", ["Mon"], None)
+    backend.tables["events"] = [
+        {**old_master, "user_id": "u1"},
+        {"id": "old", "user_id": "u1", "title": "Examen", "kind": "examen",
+         "starts_at": make_date(2024, 1, 3, 9).isoformat(), "ends_at": make_date(2024, 1, 3, 11).isoformat()},
+        {"id": "open", "user_id": "u1", "title": "Recordatorio", "kind": "otro",
+         "starts_at": make_date(2024, 5, 7, 9).isoformat(), "ends_at": None},
+    ]
+    range_start, range_end = make_date(2024, 5, 6, 0), make_date(2024, 5, 13, 0)
+
+    agenda = asyncio.run(server.load_user_agenda(db, "u1", range_start, range_end))
+
+    assert {event["id"] for event in agenda.masters} == {"master"}
+    assert all(row["id"] != "old" for rows in agenda.concrete.values() for row in rows)
+    assert [occurrence["id"] for occurrence in agenda.occurrences(range_start, range_end)] == [
+        "master:2024-05-06T09:00:00+00:00",
+        "open",
+    ]
+    assert server.local_day_start(date(2024, 3, 10), ZoneInfo("America/New_York")) == make_date(2024, 3, 10, 5)
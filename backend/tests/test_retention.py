@@ -0,0 +1,71 @@
+"""RetentionWorker purges and the chat rows that summarize purged messages."""
+import asyncio
+from datetime import timedelta
+
+import server
+
+
+def days_ago(days):
+    return (server.utc_now() - timedelta(days=days)).isoformat()
+
+
+def make_worker(backend):
+    return server.RetentionWorker(server.DataSession(backend, "service"), 90, 500, 0, 10, 3600)
+
+
+def test_purged_messages_lower_counts_and_clear_stale_previews(backend):
+    backend.tables["chats"] = [
+        {"id": "old", "user_id": "u1", "message_count": 2, "last_message_at": days_ago(100), "last_message_preview": "adiós"},
+        {"id": "live", "user_id": "u1", "message_count": 3, "last_message_at": days_ago(1), "last_message_preview": "hola"},
+    ]
+    backend.tables["chat_messages"] = [
+        {"id": "m1", "chat_id": "old", "user_id": "u1", "role": "user", "content": "a", "created_at": days_ago(101)},
+        {"id": "m2", "chat_id": "old", "user_id": "u1", "role": "assistant", "content": "b", "created_at": days_ago(100)},
+        {"id": "m3", "chat_id": "live", "user_id": "u1", "role": "user", "content": "c", "created_at": days_ago(120)},
+        {"id": "m4", "chat_id": "live", "user_id": "u1", "role": "user", "content": "d", "created_at": days_ago(1)},
+    ]
+
+    purged = asyncio.run(make_worker(backend).run_once())
+
+    assert purged["chat_messages"] == 3
+    chats = {chat["id"]: chat for chat in backend.tables["chats"]}
+    assert (chats["old"]["message_count"], chats["old"]["last_message_preview"]) == (0, None)
+    assert (chats["live"]["message_count"], chats["live"]["last_message_preview"]) == (2, "hola")
+
+
+def test_preview_backfill_stores_truncated_preview(backend):
+    backend.tables["chats"] = [{"id": "c1", "user_id": "u1", "message_count": 1, "last_message_preview": None}]
+    backend.tables["chat_messages"] = [
+        {"id": "m1", "chat_id": "c1", "user_id": "u1", "role": "assistant", "content": "x" * 500, "created_at": days_ago(1)},
+    ]
+
+    filled = asyncio.run(server.backfill_chat_previews(server.DataSession(backend, "service")))
+
+    assert filled == 1
+    preview = backend.tables["chats"][0]["last_message_preview"]
+    assert server.encryption_helper.decrypt(preview) == "x" * server.CHAT_PREVIEW_CHARS
+
+
+def test_chunks_are_deleted_by_time_range_including_ties(backend):
+    old = [days_ago(200 - day) for day in range(4)]
+    backend.tables["analytics_events"] = [
+        {"id": f"e{n}", "user_id": "u1", "event_type": "x", "timestamp": old[n // 2]} for n in range(7)
+    ] + [{"id": "recent", "user_id": "u1", "event_type": "x", "timestamp": days_ago(1)}]
+    worker = server.RetentionWorker(server.DataSession(backend, "service"), 90, 3, 0, 10, 3600)
+
+    first = asyncio.run(worker._purge_chunk("analytics_events", "timestamp", days_ago(90)))
+    asyncio.run(worker.run_once())
+
+    # e0..e3 share two timestamps, so the first 3-row chunk also takes e3, tied with e2
+    assert first == 4
+    assert [row["id"] for row in backend.tables["analytics_events"]] == ["recent"]
+
+
+def test_only_the_lease_holder_runs(backend):
+    backend.tables["escalations"] = [{"id": "old", "user_id": "u1", "created_at": days_ago(200)}]
+    holder, other = make_worker(backend), make_worker(backend)
+
+    assert asyncio.run(holder.run_once())["escalations"] == 1
+    assert asyncio.run(other.run_once()) == {}
+    assert other.skipped_runs == 1
+    assert asyncio.run(holder.run_once())["escalations"] == 0
@@ -0,0 +1,136 @@
+"""WeeklyLoad day totals and sweep-line overlaps checked against minute-by-minute occupancy."""
+import random
+
+import server
+
+DAY = server.MINUTES_PER_DAY
+WEEK = server.MINUTES_PER_WEEK
+
+
+def block(block_id, day, start, end, kind="academic"):
+    return {"id": block_id, "day_of_week": day, "start_time": start, "end_time": end, "type": kind}
+
+
+def load_of(blocks):
+    load = server.WeeklyLoad(0)
+    for schedule in blocks:
+        load.upsert(schedule)
+    return load
+
+
+def occupancy(blocks):
+    """Which block ids cover each minute of the week."""
+    covered = [set() for _ in range(WEEK)]
+    for schedule in blocks:
+        for begin, finish in server.schedule_intervals(schedule):
+            for minute in range(begin, finish):
+                covered[minute].add(schedule["id"])
+    return covered
+
+
+def random_blocks(rng, count):
+    def clock():
+        return f"{rng.randint(0, 23):02d}:{rng.choice([0, 15, 30, 45]):02d}"
+    return [
+        block(f"b{index}", rng.randint(0, 6), clock(), rng.choice([clock(), "24:00"]), rng.choice(["academic", "training", "exam"]))
+        for index in range(count)
+    ]
+
+
+def test_day_totals_and_overlaps_match_minute_occupancy():
+    rng = random.Random(11)
+    for _ in range(25):
+        blocks = random_blocks(rng, rng.randint(0, 12))
+        load = load_of(blocks)
+        covered = occupancy(blocks)
+
+        kinds = {schedule["id"]: schedule["type"] if schedule["type"] in ("academic", "training") else "other" for schedule in blocks}
+        for kind in server.SCHEDULE_LOAD_TYPES:
+            expected = [0] * 7
+            for minute, ids in enumerate(covered):
+                expected[minute // DAY] += sum(1 for block_id in ids if kinds[block_id] == kind)
+            assert load.minutes[kind] == expected
+
+        overlaps = load.overlaps()
+        assert sum(region["minutes"] for region in overlaps) == sum(1 for ids in covered if len(ids) >= 2)
+        for region in overlaps:
+            begin = region["day_of_week"] * DAY + server.parse_clock(region["start_time"])
+            ids = set().union(*covered[begin:begin + region["minutes"]])
+            assert all(len(covered[minute]) >= 2 for minute in range(begin, begin + region["minutes"]))
+            assert set(region["schedule_ids"]) == ids
+
+
+def test_back_to_back_blocks_do_not_overlap():
+    load = load_of([block("a", 0, "08:00", "10:00"), block("b", 0, "10:00", "12:00", "training")])
+
+    assert load.overlaps() == []
+
+
+def test_three_way_overlap_is_one_region():
+    load = load_of([
+        block("a", 2, "08:00", "11:00"),
+        block("b", 2, "09:00", "10:00"),
+        block("c", 2, "09:30", "12:00", "training"),
+    ])
+
+    assert load.overlaps() == [{
+        "day_of_week": 2, "start_time": "09:00", "end_time": "11:00", "minutes": 120, "schedule_ids": ["a", "b", "c"],
+    }]
+
+
+def test_24_00_end_closes_the_block_at_midnight():
+    assert server.schedule_intervals(block("a", 1, "22:00", "24:00")) == [(DAY + 22 * 60, 2 * DAY)]
+    assert server.schedule_intervals(block("a", 1, "00:00", "24:00")) == [(DAY, 2 * DAY)]
+    assert load_of([block("a", 1, "00:00", "24:00")]).minutes["academic"] == [0, DAY, 0, 0, 0, 0, 0]
+
+
+def test_cross_midnight_blocks_count_on_both_days():
+    load = load_of([block("night", 2, "22:00", "02:00", "training")])
+
+    assert load.minutes["training"] == [0, 0, 120, 120, 0, 0, 0]
+
+
+def test_sunday_block_past_midnight_wraps_to_monday_and_overlaps_there():
+    sunday = block("sun", 6, "23:00", "01:30", "training")
+    monday = block("mon", 0, "00:30", "02:00")
+    load = load_of([sunday, monday])
+
+    assert server.schedule_intervals(sunday) == [(6 * DAY + 23 * 60, WEEK), (0, 90)]
+    assert load.minutes["training"] == [90, 0, 0, 0, 0, 0, 60]
+    assert load.overlaps() == [{
+        "day_of_week": 0, "start_time": "00:30", "end_time": "01:30", "minutes": 60, "schedule_ids": ["mon", "sun"],
+    }]
+
+
+def test_incremental_edits_match_a_fresh_build():
+    rng = random.Random(5)
+    blocks = {schedule["id"]: schedule for schedule in random_blocks(rng, 10)}
+    load = load_of(blocks.values())
+    assert load.overlaps() is load.overlaps()
+
+    for _ in range(40):
+        block_id = f"b{rng.randint(0, 12)}"
+        if rng.random() < 0.3:
+            blocks.pop(block_id, None)
+            load.remove(block_id)
+        else:
+            blocks[block_id] = {**random_blocks(rng, 1)[0], "id": block_id}
+            load.upsert(blocks[block_id])
+
+        fresh = load_of(blocks.values())
+        assert load.minutes == fresh.minutes
+        assert load.overlaps() == fresh.overlaps()
+
+
+def test_index_patches_cached_loads_on_record_and_discard():
+    index = server.ScheduleLoadIndex(10, 900)
+    load = server.WeeklyLoad(server.time.time())
+    index._loads["u1"] = load
+
+    index.record("u1", block("a", 0, "08:00", "10:00"))
+    index.record("u1", block("a", 0, "08:00", "09:00"))
+    assert load.hours("academic") == 1
+    index.discard("u1", "a")
+    assert load.hours("academic") == 0
+    index.record("u1", None)
+    assert "u1" not in index._loads
@@ -0,0 +1,115 @@
+"""/api/sync: per-table cursors, paging, resets, tombstones and mutation ownership."""
+import asyncio
+import uuid
+from types import SimpleNamespace
+
+import pytest
+
+import server
+
+USER = SimpleNamespace(id="u1")
+
+
+@pytest.fixture(autouse=True)
+def no_cursor_lag(monkeypatch):
+    monkeypatch.setattr(server, "SYNC_CURSOR_LAG_SECONDS", 0)
+
+
+def sync(db, cursor=None, mutations=()):
+    request = server.SyncRequest(cursor=cursor, mutations=[server.SyncMutation(**mutation) for mutation in mutations])
+    return asyncio.run(server.sync(request, user=USER, db=db))
+
+
+def diary(day, mood=3):
+    return {"table": "diary_entries", "data": {"date": day, "mood": mood, "energy": 3, "stress": 2}}
+
+
+def block(block_id, title="Cálculo"):
+    return {"table": "schedules", "data": {
+        "id": block_id, "day_of_week": 0, "start_time": "08:00", "end_time": "10:00", "type": "academic", "title": title,
+    }}
+
+
+def test_cursor_only_returns_tables_changed_since_it(db):
+    first = sync(db, mutations=[diary("2024-05-01"), block(str(uuid.uuid4()))])
+    assert first["applied"] == 2
+    assert [row["date"] for row in first["changes"]["diary_entries"]] == ["2024-05-01"]
+    assert len(first["changes"]["schedules"]) == 1
+
+    second = sync(db, cursor=first["cursor"], mutations=[diary("2024-05-02")])
+
+    assert [row["date"] for row in second["changes"]["diary_entries"]] == ["2024-05-02"]
+    assert second["changes"]["schedules"] == []
+    assert (second["has_more"], second["reset"], second["deleted"]) == (False, False, [])
+
+
+def test_has_more_pages_through_a_table(monkeypatch, db):
+    monkeypatch.setattr(server, "SYNC_PAGE_SIZE", 2)
+    db.backend.tables["diary_entries"] = [
+        {"id": f"d{day}", "user_id": "u1", "date": f"2024-05-0{day}", "updated_at": f"2024-05-0{day}T00:00:00+00:00"}
+        for day in (1, 2, 3)
+    ]
+    cursor = server.encode_sync_cursor({"sync_tombstones": (server.utc_now().isoformat(), None)})
+
+    first = sync(db, cursor=cursor)
+    second = sync(db, cursor=first["cursor"])
+
+    assert first["has_more"] is True
+    assert [row["id"] for row in first["changes"]["diary_entries"]] == ["d1", "d2"]
+    assert second["has_more"] is False
+    assert [row["id"] for row in second["changes"]["diary_entries"]] == ["d3"]
+
+
+def test_cursor_older_than_tombstone_retention_resets(db):
+    sync(db, mutations=[diary("2024-05-01")])
+    stale = server.encode_sync_cursor({
+        "sync_tombstones": ("2000-01-01T00:00:00+00:00", None),
+        "diary_entries": (server.utc_now().isoformat(), None),
+    })
+
+    result = sync(db, cursor=stale)
+
+    assert result["reset"] is True
+    assert [row["date"] for row in result["changes"]["diary_entries"]] == ["2024-05-01"]
+
+
+def test_deletes_come_back_as_tombstones(db):
+    block_id = str(uuid.uuid4())
+    first = sync(db, mutations=[block(block_id)])
+
+    second = sync(db, cursor=first["cursor"], mutations=[{"table": "schedules", "op": "delete", "data": {"id": block_id}}])
+
+    assert second["applied"] == 1
+    assert second["deleted"] == [{"table": "schedules", "id": block_id}]
+    assert db.backend.tables["schedules"] == []
+
+
+def test_deletes_are_only_allowed_on_deletable_tables(db):
+    result = sync(db, mutations=[{"table": "diary_entries", "op": "delete", "data": {"id": "x"}}])
+
+    assert result["applied"] == 0
+    assert result["rejected"][0]["index"] == 0
+
+
+def test_mutations_cannot_touch_another_users_rows(db):
+    foreign_id = str(uuid.uuid4())
+    db.backend.tables["schedules"] = [{
+        "id": foreign_id, "user_id": "u2", "day_of_week": 0, "start_time": "08:00", "end_time": "10:00",
+        "type": "training", "title": "Ajeno",
+    }]
+
+    upserted = sync(db, mutations=[diary("2024-05-01"), block(foreign_id, title="Robado")])
+    sync(db, mutations=[{"table": "schedules", "op": "delete", "data": {"id": foreign_id}}])
+
+    assert [item["index"] for item in upserted["rejected"]] == [1]
+    assert db.backend.tables["schedules"] == [{
+        "id": foreign_id, "user_id": "u2", "day_of_week": 0, "start_time": "08:00", "end_time": "10:00",
+        "type": "training", "title": "Ajeno",
+    }]
+    assert [row["user_id"] for row in db.backend.tables["diary_entries"]] == ["u1"]
+
+
+def test_bad_cursor_is_a_400(db):
+    with pytest.raises(server.HTTPException) as error:
+        sync(db, cursor="not-a-cursor")
+    assert error.value.status_code == 400
@@ -0,0 +1,50 @@
+"""Local bearer token verification and its algorithm allowlist."""
+import asyncio
+import base64
+import json
+import time
+
+import pytest
+from jose import JWTError, jwt
+
+import server
+
+CLAIMS = {"sub": "u1", "aud": "authenticated", "exp": int(time.time()) + 600}
+
+
+def unsigned_token(header):
+    def segment(value):
+        return base64.urlsafe_b64encode(json.dumps(value).encode()).rstrip(b"=").decode()
+    return f"{segment(header)}.{segment(CLAIMS)}.c2ln"
+
+
+def verify(verifier, token):
+    return asyncio.run(verifier.verify(token))
+
+
+def test_shared_secret_accepts_hs256_only():
+    verifier = server.TokenVerifier("secret", None, "authenticated")
+
+    assert verify(verifier, jwt.encode(CLAIMS, "secret", algorithm="HS256"))["sub"] == "u1"
+    with pytest.raises(JWTError):
+        verify(verifier, jwt.encode(CLAIMS, "secret", algorithm="HS512"))
+
+
+def test_jwks_key_pins_its_own_algorithm():
+    verifier = server.TokenVerifier(None, "http://localhost/jwks", "authenticated")
+    verifier._jwks = {"k1": {"kid": "k1", "kty": "RSA", "alg": "RS256", "n": "AQAB", "e": "AQAB"}}
+    verifier._jwks_fetched_at = time.time()
+
+    # An HS token naming a JWKS kid must not be checked against that key's public material
+    forged = jwt.encode(CLAIMS, "AQAB", algorithm="HS256", headers={"kid": "k1"})
+    assert verify(verifier, forged) is None
+
+    with pytest.raises(JWTError):
+        verify(verifier, unsigned_token({"alg": "RS512", "kid": "k1"}))
+
+def test_jwks_algorithm_falls_back_to_key_type():
+    verifier = server.TokenVerifier(None, "http://localhost/jwks", "authenticated")
+    verifier._jwks = {"k1": {"kid": "k1", "kty": "EC"}}
+    verifier._jwks_fetched_at = time.time()
+
+    assert asyncio.run(verifier._signing_key({"alg": "ES256", "kid": "k1"}))[1] == "ES256"
@@ -0,0 +1,29 @@
+-- Insert a chat turn and maintain chats.message_count/last_message_at in one round trip
+create or replace function public.append_chat_messages(p_chat_id uuid, p_messages jsonb)
+returns int4
+language plpgsql
+security invoker
+set search_path = public
+as $$
+declare
+  inserted int4;
+  total int4;
+begin
+  insert into public.chat_messages (chat_id, user_id, role, content, metadata, created_at)
+  select p_chat_id, m.user_id, m.role, m.content, m.metadata, coalesce(m.created_at, now())
+  from jsonb_to_recordset(p_messages) as m(user_id uuid, role text, content text, metadata jsonb, created_at timestamptz);
+
+  get diagnostics inserted = row_count;
+
+  update public.chats
+     set message_count = message_count + inserted,
+         last_message_at = now(),
+         updated_at = now()
+   where id = p_chat_id
+  returning message_count into total;
+
+  return total;
+end;
+$$;
+
+grant execute on function public.append_chat_messages(uuid, jsonb) to authenticated;
@@ -0,0 +1,3 @@
+-- Daily agenda recommendations are looked up by (user_id, context) as a response cache
+create index if not exists idx_recommendations_user_context
+  on public.recommendations (user_id, context, created_at desc);
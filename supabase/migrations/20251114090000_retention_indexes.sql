@@ -0,0 +1,4 @@
+-- Support the background retention worker, which scans each table by age across all users
+create index if not exists idx_chat_messages_created on public.chat_messages (created_at);
+create index if not exists idx_recommendations_created on public.recommendations (created_at);
+create index if not exists idx_escalations_created on public.escalations (created_at);
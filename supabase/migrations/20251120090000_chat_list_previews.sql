@@ -0,0 +1,55 @@
+-- Chat list: the last message's preview and role live on chats, so listing conversations never reads chat_messages
+alter table public.chats
+  add column if not exists last_message_preview text,
+  add column if not exists last_message_role text;
+
+update public.chats set last_message_at = created_at where last_message_at is null;
+alter table public.chats alter column last_message_at set not null;
+
+create index if not exists idx_chats_user_last_message on public.chats (user_id, last_message_at desc, id desc);
+
+-- Existing chats get the full ciphertext of their latest message; the API truncates after decrypting
+update public.chats c
+   set last_message_preview = m.content,
+       last_message_role = m.role
+  from (
+    select distinct on (chat_id) chat_id, content, role
+      from public.chat_messages
+     order by chat_id, created_at desc
+  ) m
+ where m.chat_id = c.id
+   and c.last_message_preview is null;
+
+-- p_preview is the encrypted, truncated text of the turn's last message, built by the API
+drop function if exists public.append_chat_messages(uuid, jsonb);
+
+create or replace function public.append_chat_messages(p_chat_id uuid, p_messages jsonb, p_preview text default null)
+returns int4
+language plpgsql
+security invoker
+set search_path = public
+as $$
+declare
+  inserted int4;
+  total int4;
+begin
+  insert into public.chat_messages (chat_id, user_id, role, content, metadata, created_at)
+  select p_chat_id, m.user_id, m.role, m.content, m.metadata, coalesce(m.created_at, now())
+  from jsonb_to_recordset(p_messages) as m(user_id uuid, role text, content text, metadata jsonb, created_at timestamptz);
+
+  get diagnostics inserted = row_count;
+
+  update public.chats
+     set message_count = message_count + inserted,
+         last_message_at = now(),
+         last_message_preview = coalesce(p_preview, last_message_preview),
+         last_message_role = coalesce(p_messages -> -1 ->> 'role', last_message_role),
+         updated_at = now()
+   where id = p_chat_id
+  returning message_count into total;
+
+  return total;
+end;
+$$;
+
+grant execute on function public.append_chat_messages(uuid, jsonb, text) to authenticated;
@@ -0,0 +1,8 @@
+-- Agenda days, weekdays and biweekly parity are computed in the user's IANA time zone
+alter table public.user_profiles
+  add column if not exists timezone text;
+
+-- The agenda reads only events overlapping the requested range, plus the recurring masters
+create index if not exists idx_events_user_ends on public.events (user_id, ends_at);
+create index if not exists idx_events_user_masters on public.events (user_id, starts_at)
+  where frequency <> 'none' and override_parent_id is null;
@@ -0,0 +1,32 @@
+-- The 20251120 backfill copied each chat's latest message ciphertext in full as its preview; clear those
+-- so the API backfill (POST /api/internal/chats/backfill-previews) stores a truncated, re-encrypted one.
+-- last_message_role from that backfill is correct and stays.
+update public.chats c
+   set last_message_preview = null
+  from public.chat_messages m
+ where m.chat_id = c.id
+   and m.content = c.last_message_preview;
+
+-- Retention purges old messages; this keeps the chat row in step (counts, and no preview of a purged message)
+create or replace function public.release_purged_chat_messages(p_counts jsonb, p_cutoff timestamptz)
+returns int4
+language plpgsql
+security invoker
+set search_path = public
+as $$
+declare
+  touched int4;
+begin
+  update public.chats c
+     set message_count = greatest(c.message_count - p.purged, 0),
+         last_message_preview = case when c.last_message_at < p_cutoff then null else c.last_message_preview end
+    from (select key::uuid as chat_id, value::int4 as purged from jsonb_each_text(p_counts)) p
+   where c.id = p.chat_id;
+
+  get diagnostics touched = row_count;
+  return touched;
+end;
+$$;
+
+revoke execute on function public.release_purged_chat_messages(jsonb, timestamptz) from public, anon, authenticated;
+grant execute on function public.release_purged_chat_messages(jsonb, timestamptz) to service_role;